@@ -15,11 +15,11 @@
 # limitations under the License.
 
 import argparse
+import asyncio
 import collections
 import os
 import re
 import sys
-import threading
 
 import bazelci
 
@@ -48,19 +48,18 @@ BAZEL_TEAM_OWNED_MODULES = frozenset([
 
 PROJECT = "module" if PIPELINE == "bcr-bazel-compatibility-test" else "project"
 
-MAX_LOG_FETCHER_THREADS = 10
-LOG_FETCHER_SEMAPHORE = threading.Semaphore(MAX_LOG_FETCHER_THREADS)
+MAX_CONCURRENT_LOG_FETCHES = 10
 
-class LogFetcher(threading.Thread):
-    def __init__(self, job, client):
-        threading.Thread.__init__(self)
-        self.job = job
-        self.client = client
-        self.log = None
 
-    def run(self):
-        with LOG_FETCHER_SEMAPHORE:
-            self.log = self.client.get_build_log(self.job, retries = 10)
+async def fetch_logs(jobs, client):
+    async_client = bazelci.AsyncBuildkiteClient(BUILDKITE_ORG, PIPELINE, client=client)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_LOG_FETCHES)
+
+    async def fetch_log(job):
+        async with semaphore:
+            return await async_client.get_build_log(job, retries = 10)
+
+    return await asyncio.gather(*(fetch_log(job) for job in jobs))
 
 
 def process_build_log(failed_jobs_per_flag, already_failing_jobs, log, job):
@@ -314,19 +313,12 @@ def analyze_logs(build_number, client):
     # dict(flag name -> dict(job id -> job))
     failed_jobs_per_flag = collections.defaultdict(dict)
 
-    threads = []
-    for job in build_info["jobs"]:
-        # Some irrelevant job has no "state" or "raw_log_url" field
-        if "state" in job and "raw_log_url" in job:
-            thread = LogFetcher(job, client)
-            threads.append(thread)
-            thread.start()
-
-    for thread in threads:
-        thread.join()
-        process_build_log(
-            failed_jobs_per_flag, already_failing_jobs, thread.log, thread.job
-        )
+    # Some irrelevant job has no "state" or "raw_log_url" field
+    jobs = [job for job in build_info["jobs"] if "state" in job and "raw_log_url" in job]
+    logs = asyncio.run(fetch_logs(jobs, client))
+
+    for job, log in zip(jobs, logs):
+        process_build_log(failed_jobs_per_flag, already_failing_jobs, log, job)
 
     return already_failing_jobs, failed_jobs_per_flag
 
@@ -359,7 +351,9 @@ def main(argv=None):
     args = parser.parse_args(argv)
     try:
         if args.build_number:
-            client = bazelci.BuildkiteClient(org=BUILDKITE_ORG, pipeline=PIPELINE)
+            client = bazelci.BuildkiteClient(
+                org=BUILDKITE_ORG, pipeline=PIPELINE, cache_dir=bazelci.BUILDKITE_API_CACHE_DIR
+            )
             already_failing_jobs, failed_jobs_per_flag = analyze_logs(
                 args.build_number, client
             )
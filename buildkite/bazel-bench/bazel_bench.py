@@ -276,7 +276,7 @@ def _ci_step_for_platform_and_commits(
     )
 
     commands = (
-        [bazelci.fetch_ci_scripts_command()]
+        [bazelci.fetch_ci_scripts_command(platform)]
         + _bazel_bench_env_setup_command(platform, ",".join(bazel_commits))
         + [bazel_bench_command, upload_output_files_storage_command, upload_to_big_query_command]
     )
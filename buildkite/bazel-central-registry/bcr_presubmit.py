@@ -170,7 +170,7 @@ def add_presubmit_jobs(module_name, module_version, task_configs, pipeline_steps
                 "--overwrite_bazel_version=%s" % overwrite_bazel_version if overwrite_bazel_version else ""
             )
         )
-        commands = [bazelci.fetch_ci_scripts_command(), fetch_bcr_presubmit_py_command(), command]
+        commands = [bazelci.fetch_ci_scripts_command(platform_name), fetch_bcr_presubmit_py_command(), command]
         queue = bazelci.PLATFORMS[platform_name].get("queue", "default")
         if CI_RESOURCE_PERCENTAGE == -1:
             concurrency = concurrency_group = None
@@ -509,7 +509,7 @@ def upload_jobs_to_pipeline(pipeline_steps):
         try:
             subprocess.run(
                 ["buildkite-agent", "pipeline", "upload"],
-                input=yaml.dump({"steps": batch}).encode(),
+                input=bazelci.dump_yaml({"steps": batch}).encode(),
                 check=True,
             )
         except subprocess.CalledProcessError as e:
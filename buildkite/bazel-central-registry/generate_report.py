@@ -81,7 +81,9 @@ def main(argv=None):
         parser.print_help()
         return 2
 
-    client = bazelci.BuildkiteClient(org=BUILDKITE_ORG, pipeline=PIPELINE)
+    client = bazelci.BuildkiteClient(
+        org=BUILDKITE_ORG, pipeline=PIPELINE, cache_dir=bazelci.BUILDKITE_API_CACHE_DIR
+    )
     build_info = client.get_build_info(args.build_number)
     failed_jobs_per_module = collections.defaultdict(list)
     for job in build_info["jobs"]:
@@ -37,6 +37,10 @@ COLORS = {
 DOWNSTREAM_PIPELINE_CLIENT = bazelci.BuildkiteClient(BUILDKITE_ORG, DOWNSTREAM_PIPELINE)
 CULPRIT_FINDER_PIPELINE_CLIENT = bazelci.BuildkiteClient(BUILDKITE_ORG, CULPRIT_FINDER_PIPELINE)
 
+# All analyzer threads wait for their builds and jobs through the same poller,
+# so that the build info of each build is only fetched once per poll.
+BUILD_POLLER = bazelci.BuildkitePoller()
+
 def print_info(context, style, info, append=True):
     info_str = "\n".join(info)
     bazelci.execute_command(
@@ -89,18 +93,19 @@ class BuildInfoAnalyzer(threading.Thread):
     success_log_lock = threading.Lock()
     success_log = []
 
-    def __init__(self, project, pipeline, downstream_result):
+    def __init__(self, project, pipeline, downstream_result, main_build_info = None):
         super().__init__()
         self.project = project
         self.pipeline = pipeline
         self.downstream_result = downstream_result
+        self.main_build_info = main_build_info
         self.main_result = None
         self.client = bazelci.BuildkiteClient(BUILDKITE_ORG, pipeline)
         self.analyze_log = [f"{COLORS['HEADER']}Analyzing {self.project}: {COLORS['ENDC']}"]
         self.broken_by_infra = False
 
 
-    def _get_main_build_result(self):
+    def _fetch_main_build_info(self):
         pipeline_info = self.client.get_pipeline_info()
         if not pipeline_info:
             error = f"Cannot find pipeline info for pipeline {self.pipeline}."
@@ -118,7 +123,11 @@ class BuildInfoAnalyzer(threading.Thread):
             error = f"Cannot find finished build for pipeline {self.pipeline}, please try to rerun the pipeline first."
             self._log("SERIOUS", error)
             raise bazelci.BuildkiteException(error)
-        main_build_info = build_info_list[0]
+        return build_info_list[0]
+
+
+    def _get_main_build_result(self):
+        main_build_info = self.main_build_info or self._fetch_main_build_info()
 
         self.main_result = {}
         self.main_result["commit"] = main_build_info["commit"]
@@ -215,8 +224,12 @@ class BuildInfoAnalyzer(threading.Thread):
         for task, info in build_result["tasks"].items():
             if info["state"] != "passed":
                 retry_per_failed_task[task] = buildkite_client.trigger_job_retry(build_result["build_number"], info["id"])
-        for task, job_info in retry_per_failed_task.items():
-            retry_per_failed_task[task] = buildkite_client.wait_job_to_finish(build_number = build_result["build_number"], job_id = job_info["id"], logger = self)
+        futures = {
+            task: BUILD_POLLER.wait_for_job(buildkite_client, build_result["build_number"], job_info["id"], logger = self)
+            for task, job_info in retry_per_failed_task.items()
+        }
+        for task, future in futures.items():
+            retry_per_failed_task[task] = future.result()
         return retry_per_failed_task
 
 
@@ -301,7 +314,7 @@ class BuildInfoAnalyzer(threading.Thread):
         # Do bisect for still failing jobs
         self._log("PASSED", f"Bisect for still failing tasks...")
         bisect_build = self._trigger_bisect(failing_task_names)
-        bisect_build = CULPRIT_FINDER_PIPELINE_CLIENT.wait_build_to_finish(build_number = bisect_build["number"], logger = self)
+        bisect_build = BUILD_POLLER.wait_for_build(CULPRIT_FINDER_PIPELINE_CLIENT, bisect_build["number"], logger = self).result()
         bisect_result_by_task = {}
         for task in failing_task_names:
             for job in bisect_build["jobs"]:
@@ -359,7 +372,7 @@ class BuildInfoAnalyzer(threading.Thread):
             # Rebuild the project at last green commit, check if the failure is caused by infra change.
             self._log("PASSED", f"Rebuild at last green commit {last_green_commit}...")
             build_info = self.client.trigger_new_build(last_green_commit, "Trigger build at last green commit.")
-            build_info = self.client.wait_build_to_finish(build_number = build_info["number"], logger = self)
+            build_info = BUILD_POLLER.wait_for_build(self.client, build_info["number"], logger = self).result()
 
             if build_info["state"] == "failed":
                 self.broken_by_infra = True
@@ -625,6 +638,17 @@ def get_downstream_result_by_project(downstream_build_info):
     return downstream_result
 
 
+# Get the latest finished build of each given pipeline with a few GraphQL requests,
+# instead of two REST requests per pipeline. If that fails, return an empty dict
+# so that every analyzer falls back to the REST API.
+def get_latest_main_builds(pipelines):
+    try:
+        return DOWNSTREAM_PIPELINE_CLIENT.get_latest_builds(pipelines)
+    except bazelci.BuildkiteException as e:
+        bazelci.eprint(f"Failed to fetch latest builds via GraphQL, falling back to REST: {e}")
+        return {}
+
+
 def get_project_name_from_job(job_info):
     # This is a bit of a hack that depends on how bazelci.create_label()
     # formats job names in downstream pipelines.
@@ -635,10 +659,17 @@ def main(argv=None):
     downstream_build_info = get_latest_downstream_build_info()
     downstream_result = get_downstream_result_by_project(downstream_build_info)
 
+    main_builds = get_latest_main_builds(
+        project_info["pipeline_slug"]
+        for project_name, project_info in bazelci.DOWNSTREAM_PROJECTS.items()
+        if project_name in downstream_result
+    )
+
     analyzers = []
     for project_name, project_info in bazelci.DOWNSTREAM_PROJECTS.items():
         if project_name in downstream_result:
-            analyzer = BuildInfoAnalyzer(project_name, project_info["pipeline_slug"], downstream_result[project_name])
+            pipeline = project_info["pipeline_slug"]
+            analyzer = BuildInfoAnalyzer(project_name, pipeline, downstream_result[project_name], main_builds.get(pipeline))
             analyzers.append(analyzer)
             analyzer.start()
 
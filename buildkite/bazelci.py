@@ -15,16 +15,24 @@
 # limitations under the License.
 
 import argparse
+import array
+import asyncio
 import base64
 import codecs
 import collections
 import concurrent.futures
+import contextlib
 import copy
+import csv
 import datetime
+import functools
 from glob import glob
+import gzip
 import hashlib
+import heapq
 import itertools
 import json
+import math
 import multiprocessing
 import os
 import os.path
@@ -34,14 +42,17 @@ import re
 import requests
 import shlex
 import shutil
+import sqlite3
 import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 from typing import List
 import urllib.error
+import urllib.parse
 import urllib.request
 import yaml
 
@@ -83,6 +94,12 @@ SCRIPT_URL = "https://raw.githubusercontent.com/bazelbuild/continuous-integratio
     GITHUB_REF
 )
 
+CI_SCRIPT_URL_TEMPLATE = (
+    "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{ref}/buildkite/{script}"
+)
+
+CI_COMMIT_API_URL = "https://api.github.com/repos/bazelbuild/continuous-integration/commits/{}"
+
 METRICS_SCRIPT_URL = "https://raw.githubusercontent.com/bazelbuild/continuous-integration/{}/buildkite/collect_metrics.py".format(
     GITHUB_REF
 )
@@ -685,6 +702,26 @@ USE_BAZEL_DIFF_ENV_VAR = "USE_BAZEL_DIFF"
 # DISABLE_BAZEL_DIFF wins, even if someone sets USE_BAZEL_DIFF (e.g. presubmit check).
 DISABLE_BAZEL_DIFF_ENV_VAR = "DISABLE_BAZEL_DIFF"
 
+# Path or URL of a JSON, CSV or SQLite file with historical test durations. If set together with
+# BAZELCI_TEST_DURATIONS_SHA256, test targets are distributed across shards by their expected
+# duration instead of round-robin.
+TEST_DURATIONS_FILE_ENV_VAR = "BAZELCI_TEST_DURATIONS_FILE"
+
+# SHA-256 of the content of BAZELCI_TEST_DURATIONS_FILE. Every shard computes the assignment on its
+# own, so this guarantees that they all read the same durations.
+TEST_DURATIONS_SHA256_ENV_VAR = "BAZELCI_TEST_DURATIONS_SHA256"
+
+# If set, the parallel jobs of a sharded step claim small batches of test targets from a shared
+# queue (see ShardQueue) instead of testing a fixed subset of targets.
+SHARD_QUEUE_ENV_VAR = "BAZELCI_SHARD_QUEUE"
+# Directory for a file-based shard queue, e.g. on a shared file system or for local runs. By
+# default the queue is stored in the meta-data of the build.
+SHARD_QUEUE_DIR_ENV_VAR = "BAZELCI_SHARD_QUEUE_DIR"
+
+# If set, only the first shard of a step resolves the test targets via bazel query, and the other
+# shards download the result.
+SHARE_TARGET_EXPANSION_ENV_VAR = "BAZELCI_SHARE_TARGET_EXPANSION"
+
 BAZEL_DIFF_ANNOTATION_CTX = "'diff'"
 
 # TODO(fweikert): Install bazel-diff on the Docker images and on the Mac machines
@@ -729,6 +766,53 @@ ESCAPED_BACKSLASH = "%5C"
 # This is to prevent accidentally creating too many tasks with the martix testing feature.
 MAX_TASK_NUMBER = 128
 
+# The maximum number of imported config files that are fetched in parallel.
+MAX_CONFIG_IMPORT_WORKERS = 8
+
+# The maximum number of downstream project configs that are fetched in parallel.
+MAX_DOWNSTREAM_CONFIG_WORKERS = 16
+
+# Records the commit of the last complete checkout in the .git directory of reused clones.
+GIT_CHECKOUT_STATE_FILE = "bazelci_checkout.json"
+
+# The maximum number of submodules that are fetched in parallel.
+GIT_SUBMODULE_MAX_JOBS = 16
+
+# Directories in which agents keep pinned CI scripts by their SHA-256, by platform family.
+# They are shared by all jobs on a machine (and mounted into Docker containers).
+CI_SCRIPT_CACHE_DIRS = {
+    "linux": "/var/lib/buildkite-agent/bazelci-scripts",
+    "macos": "/Users/buildkite/bazelci-scripts",
+}
+
+CI_SCRIPT_SHA256_COMMANDS = {"linux": "sha256sum", "macos": "shasum -a 256"}
+
+# Cached CI scripts are removed after this many days.
+CI_SCRIPT_CACHE_MAX_AGE_DAYS = 7
+
+# The number of batches per shard that queued test targets are split into.
+SHARD_QUEUE_BATCHES_PER_SHARD = 8
+
+# Buildkite meta-data values are limited in size, so long target lists are split into chunks.
+SHARD_QUEUE_CHUNK_SIZE = 64 * 1024
+
+# How long shards wait for another shard to publish the test targets before they publish them
+# themselves.
+SHARD_QUEUE_TIMEOUT_S = 30 * 60
+
+# How long a shard waits for a shard that is about to steal one of its batches to finish the
+# handshake, before it assumes that the other job died and tests the batch itself.
+SHARD_QUEUE_STEAL_TIMEOUT_S = 60
+
+# How long shards wait for the first shard to upload the resolved test targets.
+TARGET_EXPANSION_TIMEOUT_S = 10 * 60
+
+# Older test runs lose half of their weight in the duration history after this many seconds.
+TEST_DURATION_HALF_LIFE_S = 14 * 24 * 60 * 60
+
+# The number of recent durations per test that are kept to compute percentiles.
+TEST_DURATION_MAX_SAMPLES = 32
+
 _TEST_BEP_FILE = "test_bep.json"
 _BUILD_BEP_FILE = "build_bep.json"
 _SHARD_RE = re.compile(r"(.+) \(shard (\d+)\)")
@@ -747,6 +831,27 @@ _LOWERED_PRIORITY_PIPELINES = frozenset(
         "bazel/bazel-at-head-plus-downstream",
     ]
 )
+# Directory of an optional on-disk cache for immutable Buildkite API responses
+# (finished builds and job logs). Tools opt in by passing it to BuildkiteClient.
+BUILDKITE_API_CACHE_DIR = os.environ.get("BUILDKITE_API_CACHE_DIR")
+
+BUILDKITE_API_CACHE_MAX_BYTES = int(os.environ.get("BUILDKITE_API_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Directory of an optional on-disk cache for parsed and expanded CI configs, which is shared by
+# all invocations of this script on the same machine. It is only used if set.
+BAZELCI_CONFIG_CACHE_DIR = os.environ.get("BAZELCI_CONFIG_CACHE_DIR")
+
+BAZELCI_CONFIG_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Parsed configs by cache key. Lookups return copies, since callers modify configs.
+_CONFIG_MEMORY_CACHE = {}
+
+# Directory of an optional on-disk cache for the test targets that bazel query returned for a
+# clean checkout of the same Git tree.
+BAZELCI_QUERY_CACHE_DIR = os.environ.get("BAZELCI_QUERY_CACHE_DIR")
+
+BAZELCI_QUERY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
 _SENSITIVE_ENV_VAR_SUBSTRINGS = ["SUDO", "PAT", "TOKEN", "CREDENTIAL", "PASSWORD", "SECRET", "KEY", "CONNECTION_STRING"]
 
 
@@ -777,6 +882,166 @@ class BinaryUploadRaceException(Exception):
     pass
 
 
+class BuildkiteResponseCache(object):
+    """A size-bounded on-disk cache for Buildkite API responses that will never change.
+
+    Entries are stored gzip-compressed in a flat directory. When the total size exceeds
+    max_size_bytes, the least recently used entries (by mtime, which is refreshed on every
+    hit) are evicted. The cache can be shared by several processes and tools on the same
+    machine, since entries are written atomically.
+    """
+
+    def __init__(self, directory, max_size_bytes=BUILDKITE_API_CACHE_MAX_BYTES):
+        self._directory = directory
+        self._max_size_bytes = max_size_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".gz")
+
+    def get(self, key):
+        """Returns the cached bytes for the given key, or None."""
+        f = self.open(key)
+        if f is None:
+            return None
+        try:
+            with f:
+                return f.read()
+        except (OSError, EOFError):
+            return None
+
+    def open(self, key):
+        """Returns a binary file object for reading the cached entry, or None."""
+        path = self._path(key)
+        try:
+            f = gzip.open(path, "rb")
+            os.utime(path)
+            return f
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        """Stores the given bytes and evicts old entries if the cache has grown too large."""
+        with self.open_for_write(key) as f:
+            f.write(data)
+
+    @contextlib.contextmanager
+    def open_for_write(self, key):
+        """Yields a binary file object whose content is stored under the given key.
+
+        The entry only becomes visible if the block finishes without an exception.
+        """
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) as gz:
+                    yield gz
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self._directory):
+            if not entry.name.endswith(".gz"):
+                continue
+            try:
+                stat_result = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat_result.st_mtime, stat_result.st_size, entry.path))
+            total_size += stat_result.st_size
+
+        if total_size <= self._max_size_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            if total_size <= self._max_size_bytes:
+                return
+
+
+class BuildkiteRateLimiter(object):
+    """Paces requests to the Buildkite REST API across all threads and clients of the process.
+
+    Buildkite reports the state of the (per-organization) rate limit in the RateLimit-Remaining
+    and RateLimit-Reset headers of every response. As long as plenty of requests remain, the
+    limiter doesn't delay anything. Once fewer than a quarter of the limit remain, requests are
+    spread evenly over the rest of the window instead of all threads running into a 429 and
+    retrying at the same time.
+    """
+
+    _limiters = {}
+
+    _limiters_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limit = None
+        self._remaining = None
+        self._reset_at = 0.0
+        self._next_slot = 0.0
+
+    @classmethod
+    def get(cls, org):
+        """Returns the limiter that is shared by all clients for the given organization."""
+        with cls._limiters_lock:
+            if org not in cls._limiters:
+                cls._limiters[org] = cls()
+            return cls._limiters[org]
+
+    def acquire(self):
+        """Blocks until the next request may be sent."""
+        with self._lock:
+            now = time.time()
+            if self._remaining is None or now >= self._reset_at:
+                return
+            if self._remaining <= 0:
+                # Out of requests: everyone waits for the window to reset, but not in lockstep.
+                delay = self._reset_at - now + random.uniform(0, 1)
+            elif self._limit and self._remaining > self._limit / 4:
+                self._remaining -= 1
+                return
+            else:
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + (self._reset_at - now) / self._remaining
+                self._remaining -= 1
+                delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, headers):
+        """Records the rate limit state reported in the headers of a response."""
+        remaining = headers.get("RateLimit-Remaining")
+        reset = headers.get("RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        limit = headers.get("RateLimit-Limit")
+        with self._lock:
+            self._remaining = int(remaining)
+            self._reset_at = time.time() + int(reset)
+            if limit is not None:
+                self._limit = int(limit)
+
+    def backoff(self, attempt, headers):
+        """Returns the (jittered) number of seconds to wait before retrying a failed request."""
+        reset = headers.get("RateLimit-Reset")
+        if reset is not None:
+            with self._lock:
+                self._remaining = 0
+                self._reset_at = time.time() + int(reset)
+            return int(reset) + random.uniform(0, 1)
+        # Exponential backoff with full jitter if no RateLimit-Reset header
+        return random.uniform(0, min(2**attempt, 60))
+
+
 class BuildkiteClient(object):
 
     _BUILD_STATUS_URL_TEMPLATE = (
@@ -797,13 +1062,68 @@ class BuildkiteClient(object):
 
     _NEXT_PAGE_PATTERN = re.compile(r'<(?P<url>\S+)>; rel="next"', re.MULTILINE)
 
-    def __init__(self, org, pipeline=None):
+    _LAST_PAGE_PATTERN = re.compile(r'<\S+[?&]page=(?P<page>\d+)[^>]*>; rel="last"', re.MULTILINE)
+
+    # Number of keep-alive connections kept open per host by the shared session.
+    _DEFAULT_POOL_SIZE = int(os.environ.get("BUILDKITE_API_POOL_SIZE", "16"))
+
+    _shared_session = None
+
+    _shared_session_lock = threading.Lock()
+
+    # States after which neither a build nor the log of a job change anymore.
+    _FINISHED_BUILD_STATES = frozenset(["passed", "failed", "canceled", "skipped", "not_run"])
+
+    _FINISHED_JOB_STATES = frozenset(
+        ["passed", "failed", "canceled", "timed_out", "skipped", "broken", "expired", "finished"]
+    )
+
+    def __init__(self, org, pipeline=None, session=None, cache_dir=None):
         if org not in CLOUD_PROJECTS_PER_ORG:
             raise BuildkiteException(f"Unknown organization: {org}")
 
         self._org = org
         self._pipeline = pipeline
         self._token = self._get_buildkite_token()
+        self._session = session or BuildkiteClient.get_shared_session()
+        self._rate_limiter = BuildkiteRateLimiter.get(org)
+        # Note that a finished build can start running again if one of its jobs is retried,
+        # so only tools that don't retry jobs should enable the on-disk cache.
+        self._response_cache = BuildkiteResponseCache(cache_dir) if cache_dir else None
+        # Maps build numbers to (ETag, Last-Modified, build info) of the last full response.
+        self._build_info_cache = {}
+        self._build_info_cache_lock = threading.Lock()
+        # Number of get_build_info() calls that were answered with "304 Not Modified".
+        self.not_modified_count = 0
+
+    @staticmethod
+    def create_session(pool_size=_DEFAULT_POOL_SIZE):
+        """Returns a requests session that keeps up to pool_size connections alive per host."""
+        session = requests.Session()
+        # Only retry failures to (re-)establish a connection, e.g. when the server has closed
+        # an idle keep-alive connection. Read errors are not retried, so this is safe for POST/PUT.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=requests.adapters.Retry(total=3, read=False, redirect=False),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+        return session
+
+    @classmethod
+    def get_shared_session(cls):
+        """Returns the session that is shared by all clients in this process.
+
+        Sharing a single session means that all threads (and all clients for
+        different pipelines) reuse the same pool of TLS connections instead of
+        opening a new one for every request.
+        """
+        with cls._shared_session_lock:
+            if cls._shared_session is None:
+                cls._shared_session = cls.create_session()
+            return cls._shared_session
 
     def _get_buildkite_token(self):
         project = CLOUD_PROJECTS_PER_ORG[self._org]
@@ -820,33 +1140,44 @@ class BuildkiteClient(object):
             print_output=False,
         )
 
-    def _get_url_response(self, full_url, retries=5):
-        """Returns the urllib response for the given URL and query parameters."""
+    # Server errors that are usually transient and thus worth retrying.
+    _RETRIABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+    def _send(self, method, full_url, **kwargs):
+        """Sends a single request through the shared session and rate limiter."""
+        self._rate_limiter.acquire()
+        response = self._session.request(method, full_url, **kwargs)
+        self._rate_limiter.update(response.headers)
+        return response
+
+    def _request(self, method, full_url, retries=5, **kwargs):
+        """Sends a request through the shared session and returns the successful response."""
         for attempt in range(retries):
-            try:
-                response = urllib.request.urlopen(full_url)
-                return response.read().decode("utf-8", "ignore"), self._get_next_page_url(response.headers)
-            except urllib.error.HTTPError as ex:
-                # Handle specific error codes
-                if ex.code == 429:  # Too Many Requests
-                    retry_after = ex.headers.get("RateLimit-Reset")
-                    if retry_after:
-                        wait_time = int(retry_after)
-                    else:
-                        wait_time = 2**attempt  # Exponential backoff if no RateLimit-Reset header
-
-                    time.sleep(wait_time)
-                else:
-                    raise BuildkiteException(
-                        "Failed to open {}: {} - {}".format(
-                            self._strip_token(full_url), ex.code, ex.reason
-                        )
+            response = self._send(method, full_url, **kwargs)
+            if response.ok:
+                return response
+
+            # Handle specific error codes
+            if response.status_code in self._RETRIABLE_STATUS_CODES:
+                response.close()
+                headers = response.headers if response.status_code == 429 else {}
+                time.sleep(self._rate_limiter.backoff(attempt, headers))
+            else:
+                raise BuildkiteException(
+                    "Failed to open {}: {} - {}".format(
+                        self._strip_token(full_url), response.status_code, response.reason
                     )
+                )
 
         raise BuildkiteException(
             f"Failed to open {self._strip_token(full_url)} after {retries} retries."
         )
 
+    def _get_url_response(self, full_url, retries=5):
+        """Returns the decoded body and the next page URL for the given URL."""
+        response = self._request("GET", full_url, retries)
+        return response.content.decode("utf-8", "ignore"), self._get_next_page_url(response.headers)
+
     def _get_next_page_url(self, headers):
         """Parses the headers to determine if there are more pagination pages."""
         link_header = headers.get("Link")
@@ -855,6 +1186,14 @@ class BuildkiteClient(object):
         match = self._NEXT_PAGE_PATTERN.search(link_header)
         return match.group('url') if match else None
 
+    def _get_last_page_number(self, headers):
+        """Parses the headers to determine the number of the last pagination page."""
+        link_header = headers.get("Link")
+        if not link_header:
+            return None
+        match = self._LAST_PAGE_PATTERN.search(link_header)
+        return int(match.group("page")) if match else None
+
     def _strip_token(self, old_url):
         """Anonymizes the token in the given URL."""
         return old_url.replace(self._token, f"{self._token[:9]}[...]")
@@ -871,17 +1210,49 @@ class BuildkiteClient(object):
         url = self._build_url_with_params(url, params)
         return self._get_url_response(url, retries)[0]
 
-    def _fetch_all_pages_as_json(self, url, params=None, retries=5) -> List:
+    def _fetch_all_pages_as_json(self, url, params=None, retries=5, max_workers=1) -> List:
         """Fetch all items iteratively across all pages."""
+        return list(self._iter_all_pages_as_json(url, params, retries, max_workers))
+
+    def _iter_all_pages_as_json(self, url, params=None, retries=5, max_workers=1):
+        """Yields all items across all pages, one page at a time.
+
+        If max_workers is greater than 1, the first page is fetched on its own to read the
+        number of the last page from the Link header. The remaining pages are then fetched
+        concurrently on a thread pool of that size, with at most max_workers pages in flight.
+        Either way, items are yielded in page order.
+        """
         if params is None:
             params = []
-        next_url = self._build_url_with_params(url, params + [("per_page", "100")])
+        params = params + [("per_page", "100")]
+        next_url = self._build_url_with_params(url, params)
+
+        if max_workers > 1:
+            response = self._request("GET", next_url, retries)
+            last_page = self._get_last_page_number(response.headers)
+            next_url = self._get_next_page_url(response.headers)
+            yield from json.loads(response.content.decode("utf-8", "ignore"))
+
+            if last_page is not None:
+                page_urls = (
+                    self._build_url_with_params(url, params + [("page", str(page))])
+                    for page in range(2, last_page + 1)
+                )
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    pending = collections.deque()
+                    for page_url in page_urls:
+                        if len(pending) == max_workers:
+                            yield from json.loads(pending.popleft().result()[0])
+                        pending.append(executor.submit(self._get_url_response, page_url, retries))
+                    while pending:
+                        yield from json.loads(pending.popleft().result()[0])
+                return
+
+            # No hint about the last page, so fall back to following the "next" links.
 
-        all_items = []
         while next_url:
             response, next_url = self._get_url_response(next_url, retries)
-            all_items.extend(json.loads(response))
-        return all_items
+            yield from json.loads(response)
 
     def get_pipeline_info(self):
         """Get details for a pipeline given its organization slug
@@ -910,9 +1281,46 @@ class BuildkiteClient(object):
         dict
             the metadata for the build
         """
+        cache_key = f"build/{self._org}/{self._pipeline}/{build_number}"
+        if self._response_cache:
+            data = self._response_cache.get(cache_key)
+            if data is not None:
+                return json.loads(data)
+
         url = self._BUILD_STATUS_URL_TEMPLATE.format(self._org, self._pipeline, build_number)
-        output = self._fetch_data_as_text(url)
-        return json.loads(output)
+        with self._build_info_cache_lock:
+            cached = self._build_info_cache.get(build_number)
+
+        # Send a conditional request so that Buildkite doesn't have to send the whole
+        # build again (and doesn't count it against our rate limit) if nothing changed.
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = self._request("GET", self._build_url_with_params(url), headers=headers)
+        if response.status_code == 304 and cached:
+            with self._build_info_cache_lock:
+                self.not_modified_count += 1
+            return copy.deepcopy(cached[2])
+
+        build_info = json.loads(response.content.decode("utf-8", "ignore"))
+        if self._response_cache and build_info.get("state") in self._FINISHED_BUILD_STATES:
+            self._response_cache.put(cache_key, response.content)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            with self._build_info_cache_lock:
+                self._build_info_cache[build_number] = (
+                    etag,
+                    last_modified,
+                    copy.deepcopy(build_info),
+                )
+        return build_info
 
     def get_build_info_list(self, params):
         """Get a list of build infos for this pipeline
@@ -932,19 +1340,298 @@ class BuildkiteClient(object):
         return json.loads(output)
 
     def get_build_log(self, job, retries = 5):
-        return self._fetch_data_as_text(job["raw_log_url"], retries = retries)
+        cacheable = self._response_cache and job.get("state") in self._FINISHED_JOB_STATES
+        if cacheable:
+            cache_key = "log/" + job["raw_log_url"]
+            data = self._response_cache.get(cache_key)
+            if data is not None:
+                return data.decode("utf-8", "ignore")
+
+        log = self._fetch_data_as_text(job["raw_log_url"], retries = retries)
+        if cacheable:
+            self._response_cache.put(cache_key, log.encode("utf-8"))
+        return log
+
+    def iter_build_log_lines(
+        self, job, retries=5, chunk_size=64 * 1024, max_line_bytes=1024 * 1024
+    ):
+        """Yields the lines of the raw log of the given job without holding the whole log in memory.
+
+        Parameters
+        ----------
+        job : the job metadata, as returned in the "jobs" list of get_build_info()
+        retries : (optional) how often to retry if the request is rate limited
+        chunk_size : (optional) the number of bytes to read from the network at once
+        max_line_bytes : (optional) longer lines, such as progress output that only uses carriage
+            returns, are split into several lines of at most this many bytes
+
+        Returns
+        -------
+        iterator of str
+            the decoded lines of the log, without line endings
+        """
+        cacheable = self._response_cache and job.get("state") in self._FINISHED_JOB_STATES
+        if cacheable:
+            cache_key = "log/" + job["raw_log_url"]
+            cached = self._response_cache.open(cache_key)
+            if cached is not None:
+                with cached:
+                    chunks = iter(lambda: cached.read(chunk_size), b"")
+                    yield from self._split_log_lines(chunks, max_line_bytes)
+                return
+
+        url = self._build_url_with_params(job["raw_log_url"])
+        response = self._request("GET", url, retries, stream=True)
+        with response, contextlib.ExitStack() as stack:
+            cache_file = None
+            if cacheable:
+                cache_file = stack.enter_context(self._response_cache.open_for_write(cache_key))
+
+            def chunks():
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if cache_file:
+                        cache_file.write(chunk)
+                    yield chunk
+
+            yield from self._split_log_lines(chunks(), max_line_bytes)
 
-    def get_agents(self, retries=5):
+    @staticmethod
+    def _split_log_lines(chunks, max_line_bytes):
+        def decode(line):
+            if not line:
+                yield ""
+            for start in range(0, len(line), max_line_bytes):
+                yield line[start : start + max_line_bytes].rstrip(b"\r").decode("utf-8", "ignore")
+
+        # Chunks are only joined once a line is complete, or once it exceeds max_line_bytes.
+        pending, pending_size = [], 0
+        for chunk in chunks:
+            *lines, rest = chunk.split(b"\n")
+            for line in lines:
+                pending.append(line)
+                yield from decode(b"".join(pending))
+                pending, pending_size = [], 0
+            if rest:
+                pending.append(rest)
+                pending_size += len(rest)
+            if pending_size > max_line_bytes:
+                data = b"".join(pending)
+                # Keeps a non-empty remainder, so the result doesn't depend on the chunk size.
+                cut = (len(data) - 1) // max_line_bytes * max_line_bytes
+                yield from decode(data[:cut])
+                pending, pending_size = [data[cut:]], len(data) - cut
+        if pending:
+            yield from decode(b"".join(pending))
+
+    def get_agents(self, retries=5, max_workers=1):
+        return list(self.iter_agents(retries, max_workers))
+
+    def iter_agents(self, retries=5, max_workers=1):
+        """Yields all agents of the organization, fetching one page at a time.
+        See https://buildkite.com/docs/apis/rest-api/agents#list-agents
+        """
         url = self._AGENTS_URL_TEMPLATE.format(self._org)
-        return self._fetch_all_pages_as_json(url, retries=retries)
-
-    def get_active_builds(self, retries=5):
-        url = self._BUILDS_URL_TEMPLATE.format(self._org)
-        return self._fetch_all_pages_as_json(
-            url,
-            params=[("state[]", "scheduled"), ("state[]", "running")],
-            retries=retries
+        return self._iter_all_pages_as_json(url, retries=retries, max_workers=max_workers)
+
+    def get_active_builds(self, retries=5, max_workers=1):
+        return list(self.iter_active_builds(retries, max_workers))
+
+    def iter_active_builds(self, retries=5, max_workers=1):
+        """Yields all scheduled and running builds of the organization, fetching one page at a time."""
+        return self.iter_builds(
+            [("state[]", "scheduled"), ("state[]", "running")],
+            retries=retries,
+            max_workers=max_workers,
+            all_pipelines=True,
+        )
+
+    def iter_builds(self, params, retries=5, max_workers=1, all_pipelines=False):
+        """Yields all builds that match the given parameters, fetching one page at a time.
+        See https://buildkite.com/docs/apis/rest-api/builds#list-all-builds
+
+        Parameters
+        ----------
+        params : the parameters to filter the result
+        all_pipelines : (optional) whether to list the builds of all pipelines in the
+            organization instead of only the builds of this pipeline
+
+        Returns
+        -------
+        iterator of dict
+            the metadata for the builds
+        """
+        if all_pipelines or not self._pipeline:
+            url = self._BUILDS_URL_TEMPLATE.format(self._org)
+        else:
+            url = self._BUILD_STATUS_URL_TEMPLATE.format(self._org, self._pipeline, "")
+        return self._iter_all_pages_as_json(
+            url, params=params, retries=retries, max_workers=max_workers
+        )
+
+    _GRAPHQL_URL = "https://graphql.buildkite.com/v1"
+
+    # Maximum number of pipelines per GraphQL query, to stay below the query complexity limit.
+    _GRAPHQL_BATCH_SIZE = 20
+
+    _GRAPHQL_JOB_FIELDS = """
+        ... on JobTypeCommand {
+          uuid
+          label
+          command
+          state
+          passed
+          softFailed
+          url
+        }
+    """
+
+    _GRAPHQL_BUILD_FIELDS = """
+        number
+        state
+        commit
+        branch
+        url
+        jobs(first: 500) {
+          edges {
+            node {
+              %s
+            }
+          }
+        }
+    """ % _GRAPHQL_JOB_FIELDS
+
+    def _graphql(self, query, variables=None, retries=5):
+        """Runs a query against the Buildkite GraphQL API and returns its data."""
+        response = self._request(
+            "POST",
+            self._GRAPHQL_URL,
+            retries,
+            json={"query": query, "variables": variables or {}},
+            headers={"Authorization": f"Bearer {self._token}"},
+        )
+        result = json.loads(response.content.decode("utf-8", "ignore"))
+        if result.get("errors"):
+            raise BuildkiteException(
+                "GraphQL query failed: "
+                + "; ".join(error.get("message", str(error)) for error in result["errors"])
+            )
+        return result["data"]
+
+    @staticmethod
+    def _convert_graphql_job(node):
+        """Converts a GraphQL job node into the format of the REST API."""
+        state = node["state"].lower()
+        if state == "finished":
+            # Unlike the REST API, GraphQL doesn't encode the result in the state.
+            state = "passed" if node.get("passed") else "failed"
+        return {
+            "id": node["uuid"],
+            "name": node.get("label"),
+            "command": node.get("command"),
+            "state": state,
+            "soft_failed": node.get("softFailed", False),
+            "web_url": node.get("url"),
+        }
+
+    @staticmethod
+    def _convert_graphql_build(node):
+        """Converts a GraphQL build node into the format of the REST API."""
+        return {
+            "number": node["number"],
+            "state": node["state"].lower(),
+            "commit": node["commit"],
+            "branch": node["branch"],
+            "web_url": node["url"],
+            "jobs": [
+                BuildkiteClient._convert_graphql_job(edge["node"])
+                for edge in node["jobs"]["edges"]
+                # Wait steps, block steps etc. don't have any command job fields.
+                if edge["node"] and "uuid" in edge["node"]
+            ],
+        }
+
+    def get_latest_builds(self, pipelines, states=("passed", "failed"), branches=None):
+        """Get the latest build of each of the given pipelines, using as few requests as possible.
+        See https://buildkite.com/docs/apis/graphql-api
+
+        Parameters
+        ----------
+        pipelines : the slugs of the pipelines in this organization
+        states : (optional) only consider builds in one of these states
+        branches : (optional) a dict that maps pipeline slugs to the branch to consider,
+            defaults to the default branch of each pipeline
+
+        Returns
+        -------
+        dict
+            maps each pipeline slug to the metadata of its latest build in the REST API format
+            (only with the fields the sheriff needs), or None if there is no such build
+        """
+        pipelines = list(pipelines)
+        if branches is None:
+            branches = self._get_default_branches(pipelines)
+
+        latest_builds = {}
+        for i in range(0, len(pipelines), self._GRAPHQL_BATCH_SIZE):
+            batch = pipelines[i : i + self._GRAPHQL_BATCH_SIZE]
+            params = ", ".join(f"$slug{j}: ID!, $branch{j}: [String!]" for j in range(len(batch)))
+            fields = "\n".join(
+                f"""p{j}: pipeline(slug: $slug{j}) {{
+                      builds(first: 1, branch: $branch{j}, state: $states) {{
+                        edges {{ node {{ {self._GRAPHQL_BUILD_FIELDS} }} }}
+                      }}
+                    }}"""
+                for j in range(len(batch))
+            )
+            variables = {"states": [state.upper() for state in states]}
+            for j, pipeline in enumerate(batch):
+                variables[f"slug{j}"] = f"{self._org}/{pipeline}"
+                variables[f"branch{j}"] = [branches.get(pipeline) or "master"]
+
+            data = self._graphql(
+                f"query LatestBuilds($states: [BuildStates!], {params}) {{ {fields} }}", variables
+            )
+            for j, pipeline in enumerate(batch):
+                edges = (data.get(f"p{j}") or {}).get("builds", {}).get("edges", [])
+                latest_builds[pipeline] = (
+                    self._convert_graphql_build(edges[0]["node"]) if edges else None
+                )
+        return latest_builds
+
+    def _get_default_branches(self, pipelines):
+        """Returns a dict that maps the given pipeline slugs to their default branches."""
+        default_branches = {}
+        for i in range(0, len(pipelines), self._GRAPHQL_BATCH_SIZE):
+            batch = pipelines[i : i + self._GRAPHQL_BATCH_SIZE]
+            params = ", ".join(f"$slug{j}: ID!" for j in range(len(batch)))
+            fields = "\n".join(
+                f"p{j}: pipeline(slug: $slug{j}) {{ defaultBranch }}" for j in range(len(batch))
+            )
+            variables = {f"slug{j}": f"{self._org}/{pipeline}" for j, pipeline in enumerate(batch)}
+            data = self._graphql(f"query DefaultBranches({params}) {{ {fields} }}", variables)
+            for j, pipeline in enumerate(batch):
+                default_branches[pipeline] = (data.get(f"p{j}") or {}).get("defaultBranch")
+        return default_branches
+
+    def get_build_jobs(self, build_number):
+        """Get the command jobs of a build of this pipeline in a single GraphQL request.
+
+        Parameters
+        ----------
+        build_number : the build number
+
+        Returns
+        -------
+        list of dict
+            id, name, command, state, soft_failed and web_url of each job, in the REST API format
+        """
+        data = self._graphql(
+            f"query BuildJobs($slug: ID!) {{ build(slug: $slug) {{ {self._GRAPHQL_BUILD_FIELDS} }} }}",
+            {"slug": f"{self._org}/{self._pipeline}/{build_number}"},
         )
+        if not data.get("build"):
+            raise BuildkiteException(f"Cannot find build {build_number} of pipeline {self._pipeline}.")
+        return self._convert_graphql_build(data["build"])["jobs"]
 
     @staticmethod
     def _check_response(response, expected_status_code):
@@ -980,7 +1667,7 @@ class BuildkiteClient(object):
             "env": env,
             "ignore_pipeline_branch_filters": "true",
         }
-        response = requests.post(url + "?access_token=" + self._token, json=data)
+        response = self._send("POST", url + "?access_token=" + self._token, json=data)
         BuildkiteClient._check_response(response, requests.codes.created)
         return json.loads(response.text)
 
@@ -999,7 +1686,7 @@ class BuildkiteClient(object):
             the metadata for the job
         """
         url = self._RETRY_JOB_URL_TEMPLATE.format(self._org, self._pipeline, build_number, job_id)
-        response = requests.put(url + "?access_token=" + self._token)
+        response = self._send("PUT", url + "?access_token=" + self._token)
         BuildkiteClient._check_response(response, requests.codes.ok)
         return json.loads(response.text)
 
@@ -1064,6 +1751,276 @@ class BuildkiteClient(object):
         return build_info
 
 
+class AsyncBuildkiteClient(object):
+    """An asyncio counterpart of BuildkiteClient.
+
+    The blocking requests of the underlying BuildkiteClient run on a thread pool that is shared
+    by all instances in the process, so the number of concurrent requests (and thus threads and
+    open connections) is bounded by BUILDKITE_API_MAX_CONCURRENCY no matter how many coroutines
+    are waiting. Waiting for builds and jobs uses asyncio.sleep() and doesn't block a thread.
+    """
+
+    _MAX_CONCURRENT_REQUESTS = int(os.environ.get("BUILDKITE_API_MAX_CONCURRENCY", "16"))
+
+    _executor = None
+
+    _executor_lock = threading.Lock()
+
+    def __init__(self, org, pipeline=None, client=None):
+        self._client = client or BuildkiteClient(org, pipeline)
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=cls._MAX_CONCURRENT_REQUESTS,
+                    thread_name_prefix="buildkite-api",
+                )
+            return cls._executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs)
+        )
+
+    async def get_pipeline_info(self):
+        return await self._run(self._client.get_pipeline_info)
+
+    async def get_build_info(self, build_number):
+        return await self._run(self._client.get_build_info, build_number)
+
+    async def get_build_info_list(self, params):
+        return await self._run(self._client.get_build_info_list, params)
+
+    async def get_build_log(self, job, retries=5):
+        return await self._run(self._client.get_build_log, job, retries=retries)
+
+    async def scan_build_log(self, job, patterns, retries=5):
+        """Streams the log of the given job and returns all matches. See scan_lines()."""
+        return await self._run(
+            lambda: list(scan_lines(self._client.iter_build_log_lines(job, retries), patterns))
+        )
+
+    async def get_agents(self, retries=5):
+        return await self._run(self._client.get_agents, retries=retries)
+
+    async def get_active_builds(self, retries=5):
+        return await self._run(self._client.get_active_builds, retries=retries)
+
+    async def trigger_new_build(self, commit, message=None, env={}):
+        return await self._run(self._client.trigger_new_build, commit, message, env)
+
+    async def trigger_job_retry(self, build_number, job_id):
+        return await self._run(self._client.trigger_job_retry, build_number, job_id)
+
+    async def wait_job_to_finish(self, build_number, job_id, interval_time=30, logger=None):
+        """Wait a job to finish and return the job metadata. See BuildkiteClient.wait_job_to_finish."""
+        t = 0
+        build_info = await self.get_build_info(build_number)
+        while True:
+            for job in build_info["jobs"]:
+                if job["id"] == job_id:
+                    state = job["state"]
+                    if state != "scheduled" and state != "running" and state != "assigned":
+                        return job
+                    break
+            else:
+                raise BuildkiteException(
+                    f"job id {job_id} doesn't exist in build " + build_info["web_url"]
+                )
+            url = build_info["web_url"]
+            if logger:
+                logger.log(f"Waiting for {url}, waited {t} seconds...")
+            await asyncio.sleep(interval_time)
+            t += interval_time
+            build_info = await self.get_build_info(build_number)
+
+    async def wait_build_to_finish(self, build_number, interval_time=30, logger=None):
+        """Wait a build to finish and return the build metadata. See BuildkiteClient.wait_build_to_finish."""
+        t = 0
+        build_info = await self.get_build_info(build_number)
+        while build_info["state"] == "scheduled" or build_info["state"] == "running":
+            url = build_info["web_url"]
+            if logger:
+                logger.log(f"Waiting for {url}, waited {t} seconds...")
+            await asyncio.sleep(interval_time)
+            t += interval_time
+            build_info = await self.get_build_info(build_number)
+        return build_info
+
+
+class BuildkitePoller(object):
+    """Waits for many Buildkite builds and jobs at once on a single background thread.
+
+    All outstanding waits for the same build share one get_build_info() call per poll, and
+    each build is polled on its own schedule: the interval drops back to min_interval whenever
+    one of the awaited jobs changes its state and grows by _BACKOFF_FACTOR otherwise (up to
+    max_interval), so long queues are polled less and less often. For running jobs with a
+    known expected duration the next poll is never scheduled after the expected finish time.
+    """
+
+    _BACKOFF_FACTOR = 1.5
+
+    _PENDING_JOB_STATES = frozenset(["scheduled", "running", "assigned"])
+
+    _PENDING_BUILD_STATES = frozenset(["scheduled", "running"])
+
+    def __init__(self, min_interval=10, max_interval=120):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._condition = threading.Condition()
+        # Maps (org, pipeline, build number) to the state of the polled build.
+        self._builds = {}
+        self._thread = None
+        self.poll_count = 0
+
+    def wait_for_build(self, client, build_number, logger=None):
+        """Returns a future that resolves to the build metadata once the build has finished."""
+        return self._add_waiter(client, build_number, None, None, logger)
+
+    def wait_for_job(self, client, build_number, job_id, expected_duration=None, logger=None):
+        """Returns a future that resolves to the job metadata once the job has finished.
+
+        Parameters
+        ----------
+        client : the BuildkiteClient for the pipeline of the build
+        build_number : the number of the build that contains the job
+        job_id : the id of the job we want to wait for
+        expected_duration : (optional) the expected run time of the job in seconds
+        logger : (optional) a logger to report progress
+        """
+        return self._add_waiter(client, build_number, job_id, expected_duration, logger)
+
+    def _add_waiter(self, client, build_number, job_id, expected_duration, logger):
+        future = concurrent.futures.Future()
+        key = (client._org, client._pipeline, build_number)
+        with self._condition:
+            build = self._builds.get(key)
+            if not build:
+                build = self._builds[key] = {
+                    "client": client,
+                    "build_number": build_number,
+                    "waiters": [],
+                    "next_poll": time.time(),
+                    "interval": self._min_interval,
+                    "states": None,
+                    "first_poll": None,
+                }
+            else:
+                # Make sure that the new waiter doesn't have to wait for a long backoff.
+                build["next_poll"] = min(build["next_poll"], time.time())
+            build["waiters"].append((job_id, expected_duration, logger, future))
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._builds:
+                    self._thread = None
+                    return
+                now = time.time()
+                due = [b for b in self._builds.values() if b["next_poll"] <= now]
+                if not due:
+                    next_poll = min(b["next_poll"] for b in self._builds.values())
+                    self._condition.wait(next_poll - now)
+                    continue
+
+            for build in due:
+                self._poll(build)
+
+    def _poll(self, build):
+        try:
+            build_info = build["client"].get_build_info(build["build_number"])
+        except Exception as ex:
+            with self._condition:
+                waiters = build["waiters"]
+                self._remove(build)
+            for _, _, _, future in waiters:
+                future.set_exception(ex)
+            return
+
+        now = time.time()
+        jobs = {job["id"]: job for job in build_info.get("jobs", []) if "id" in job}
+        with self._condition:
+            self.poll_count += 1
+            if build["first_poll"] is None:
+                build["first_poll"] = now
+            remaining = []
+            resolved = []
+            states = []
+            next_expected_finish = None
+            for waiter in build["waiters"]:
+                job_id, expected_duration, logger, future = waiter
+                if job_id is None:
+                    state = build_info["state"]
+                    if state not in self._PENDING_BUILD_STATES:
+                        resolved.append((future, build_info, None))
+                        continue
+                else:
+                    job = jobs.get(job_id)
+                    if not job:
+                        resolved.append(
+                            (
+                                future,
+                                None,
+                                BuildkiteException(
+                                    f"job id {job_id} doesn't exist in build "
+                                    + build_info["web_url"]
+                                ),
+                            )
+                        )
+                        continue
+                    state = job["state"]
+                    if state not in self._PENDING_JOB_STATES:
+                        resolved.append((future, job, None))
+                        continue
+                    if state == "running" and expected_duration and job.get("started_at"):
+                        started_at = datetime.datetime.fromisoformat(
+                            job["started_at"].replace("Z", "+00:00")
+                        ).timestamp()
+                        finish = started_at + expected_duration
+                        if next_expected_finish is None or finish < next_expected_finish:
+                            next_expected_finish = finish
+                states.append((job_id, state))
+                remaining.append(waiter)
+
+            build["waiters"] = remaining
+            if not remaining:
+                self._remove(build)
+            else:
+                if states != build["states"]:
+                    interval = self._min_interval
+                else:
+                    interval = min(build["interval"] * self._BACKOFF_FACTOR, self._max_interval)
+                if next_expected_finish is not None:
+                    interval = min(interval, max(next_expected_finish - now, self._min_interval))
+                build["states"] = states
+                build["interval"] = interval
+                build["next_poll"] = now + interval
+                loggers = set(logger for _, _, logger, _ in remaining if logger)
+
+        for future, result, ex in resolved:
+            if ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+
+        if remaining:
+            waited = int(now - build["first_poll"])
+            for logger in loggers:
+                logger.log(f"Waiting for {build_info['web_url']}, waited {waited} seconds...")
+
+    def _remove(self, build):
+        key = (build["client"]._org, build["client"]._pipeline, build["build_number"])
+        self._builds.pop(key, None)
+
+
 def decrypt_token(encrypted_token, kms_key, project="bazel-untrusted"):
     try:
         result = subprocess.run(
@@ -1096,6 +2053,29 @@ def decrypt_token(encrypted_token, kms_key, project="bazel-untrusted"):
         raise BuildkiteException(f"Failed to decrypt token:\n{cause}")
 
 
+def scan_lines(lines, patterns):
+    """Applies a set of regular expressions to each of the given lines.
+
+    Since lines are consumed one at a time, this works in constant memory for
+    arbitrarily large logs, e.g. when combined with BuildkiteClient.iter_build_log_lines().
+
+    Parameters
+    ----------
+    lines : an iterable of strings
+    patterns : a dict that maps names to compiled regular expressions
+
+    Returns
+    -------
+    iterator of (str, re.Match)
+        the name of the pattern and the match, for every match in every line
+    """
+    patterns = list(patterns.items())
+    for line in lines:
+        for name, pattern in patterns:
+            for match in pattern.finditer(line):
+                yield name, match
+
+
 def eprint(*args, **kwargs):
     """
     Print to stderr and flush (just in case).
@@ -1131,14 +2111,6 @@ def match_matrix_attr_pattern(s):
     return re.match(r"^\${{\s*(\w+)\s*}}$", s)
 
 
-def substitute_matrix_attr_patterns(s, lookup):
-    return re.sub(
-        r"\${{\s*(\w+)\s*}}",
-        lambda match: str(lookup[match.group(1)].value),
-        s,
-    )
-
-
 def get_matrix_attributes_for_value(value):
     if isinstance(value, str):
         for attr in re.findall(r"\${{\s*(\w+)\s*}}", value):
@@ -1167,37 +2139,11 @@ def get_matrix_attributes(task):
     return sorted(attributes)
 
 
-def should_exclude_combination(combination, excludes):
-    """Check if a combination should be excluded based on the exclude rules.
+AttributeValue = collections.namedtuple("AttributeValue", ["value", "alias"])
 
-    Args:
-        combination: A tuple of (attribute, value) pairs representing a matrix combination.
-        excludes: A list of dicts, each representing an exclusion rule.
-                  For example: [{"platform": "windows", "compiler": "gcc"}]
 
-    Returns:
-        True if the combination matches any exclusion rule, False otherwise.
-    """
-    if not excludes:
-        return False
-
-    combination_dict = dict(combination)
-    none_attr = AttributeValue(value=None, alias=None)
-
-    for exclude in excludes:
-        # An exclusion matches if ALL attributes in the exclude rule match
-        if all(
-            combination_dict.get(key, none_attr).alias == value for key, value in exclude.items()
-        ):
-            return True
-    return False
-
-
-AttributeValue = collections.namedtuple("AttributeValue", ["value", "alias"])
-
-
-def get_combinations(matrix, attributes, excludes=None):
-    """Given a matrix and the wanted attributes, return all possible combinations.
+def get_combinations(matrix, attributes, excludes=None):
+    """Given a matrix and the wanted attributes, return all possible combinations.
 
     eg.
     With matrix = {'a': [1, 2], 'b': [1], 'c': [1]},
@@ -1205,6 +2151,20 @@ def get_combinations(matrix, attributes, excludes=None):
     if attributes = ['b', 'c'], then returns [[('b', 1), ('c', 1)]]
     if attributes = ['c'], then returns [[('c', 1)]]
     """
+    return list(iter_combinations(matrix, attributes, excludes))
+
+
+def iter_combinations(matrix, attributes, excludes=None):
+    """Lazily yield the combinations of get_combinations() in the same (sorted) order.
+
+    Combinations are generated attribute by attribute, and an exclude rule is checked as soon as
+    all of its attributes have a value, so that excluded combinations are pruned as a whole
+    instead of being generated and filtered one by one.
+
+    An exclude rule (eg. {"platform": "windows", "compiler": "gcc"}) matches a combination if the
+    aliases of ALL of its attributes match. Attributes that are not part of the combination only
+    match a None value.
+    """
     # Sort the attributes to make the output deterministic.
     attributes.sort()
     for attr in attributes:
@@ -1221,44 +2181,129 @@ def get_combinations(matrix, attributes, excludes=None):
                 [(attr, AttributeValue(value=value, alias=alias)) for alias, value in item.items()]
             )
 
-    all_combinations = sorted(itertools.product(*pairs))
+    # Walking the sorted values of every attribute yields the product in sorted order. Duplicate
+    # values are walked once, and the resulting combinations are repeated instead.
+    pairs = [
+        [(pair, len(list(group))) for pair, group in itertools.groupby(sorted(attr_pairs))]
+        for attr_pairs in pairs
+    ]
 
-    # Filter out excluded combinations
-    if excludes:
-        all_combinations = [
-            c for c in all_combinations if not should_exclude_combination(c, excludes)
-        ]
+    # Index the exclude rules by the position of the last attribute they refer to.
+    positions = {attr: pos for pos, attr in enumerate(attributes)}
+    excludes_by_position = collections.defaultdict(list)
+    for exclude in excludes or []:
+        conditions = []
+        for key, value in exclude.items():
+            if key in positions:
+                conditions.append((positions[key], value))
+            elif value is not None:
+                # This rule never matches.
+                break
+        else:
+            if not conditions:
+                # This rule matches every combination.
+                return
+            excludes_by_position[max(pos for pos, _ in conditions)].append(conditions)
+
+    combination = []
+
+    def walk(pos, repeat):
+        if pos == len(pairs):
+            for _ in range(repeat):
+                yield tuple(combination)
+            return
+        for pair, count in pairs[pos]:
+            combination.append(pair)
+            if not any(
+                all(combination[p][1].alias == value for p, value in conditions)
+                for conditions in excludes_by_position[pos]
+            ):
+                yield from walk(pos + 1, repeat * count)
+            combination.pop()
 
-    return all_combinations
+    yield from walk(0, 1)
 
 
-def expand_task_for_value(value, parent, parent_item, lookup):
+def compile_matrix_value(value):
+    """Compile a (sub)value of a task into a function that expands it for a given combination.
+
+    The returned function takes the original value and a lookup of attribute values, and returns
+    the expanded value. Only containers on the path to a `${{ attr }}` placeholder are copied,
+    everything else is shared with the original value. Returns None if the value does not contain
+    any placeholders.
+    """
     if isinstance(value, str):
         res = match_matrix_attr_pattern(value)
         if res:
             attr = res.groups()[0]
-            parent[parent_item] = lookup[attr].value
-        elif re.search(r"\${{\s*(\w+)\s*}}", value):
-            parent[parent_item] = substitute_matrix_attr_patterns(value, lookup)
-    elif isinstance(value, list):
-        for i, subvalue in enumerate(value):
-            expand_task_for_value(subvalue, parent[parent_item], i, lookup)
-    elif isinstance(value, dict):
-        for subkey, subvalue in value.items():
-            expand_task_for_value(subvalue, parent[parent_item], subkey, lookup)
+            return lambda _, lookup: lookup[attr].value
+
+        # re.split() with a capturing group alternates between literal text and attribute names.
+        parts = re.split(r"\${{\s*(\w+)\s*}}", value)
+        if len(parts) == 1:
+            return None
+        literals, attrs = parts[0::2], parts[1::2]
+
+        def expand_str(_, lookup):
+            expanded = [literals[0]]
+            for attr, literal in zip(attrs, literals[1:]):
+                expanded.append(str(lookup[attr].value))
+                expanded.append(literal)
+            return "".join(expanded)
+
+        return expand_str
+    elif isinstance(value, (list, dict)):
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        children = []
+        for key, subvalue in items:
+            expand_subvalue = compile_matrix_value(subvalue)
+            if expand_subvalue:
+                children.append((key, expand_subvalue))
+        if not children:
+            return None
+
+        def expand_container(original, lookup):
+            expanded = original.copy()
+            for key, expand_subvalue in children:
+                expanded[key] = expand_subvalue(original[key], lookup)
+            return expanded
+
+        return expand_container
+    return None
+
+
+class MatrixTaskTemplate:
+    """A task whose `${{ attr }}` placeholders have been located once, so that it can be expanded
+    for many combinations without copying and re-scanning the whole task each time.
+
+    Expanded tasks are new top-level dicts, but share all nested values without placeholders with
+    the original task (and with each other), so they must not be modified in place.
+    """
+
+    def __init__(self, task):
+        self._task = task
+        self._fields = []
+        for key, value in task.items():
+            expand_value = compile_matrix_value(value)
+            if expand_value:
+                self._fields.append((key, expand_value))
+
+    def expand(self, combination):
+        """Expand the task with the given combination of values of attributes."""
+        lookup = dict(combination)
+        expanded_task = dict(self._task)
+        for key, expand_value in self._fields:
+            expanded_task[key] = expand_value(self._task[key], lookup)
+
+        if "name" in expanded_task:
+            alias_combination = {k: a.alias for k, a in lookup.items()}
+            expanded_task["name"] = expanded_task.get("name", "").format(**alias_combination)
+        return expanded_task
 
 
 def get_expanded_task(task, combination):
     """Expand a task with the given combination of values of attributes."""
-    combination = dict(combination)
-    expanded_task = copy.deepcopy(task)
-    for key, value in task.items():
-        expand_task_for_value(value, expanded_task, key, combination)
-
-    if "name" in expanded_task:
-        alias_combination = {k: a.alias for k, a in combination.items()}
-        expanded_task["name"] = expanded_task.get("name", "").format(**alias_combination)
-    return expanded_task
+    return MatrixTaskTemplate(task).expand(combination)
 
 
 def fetch_configs(http_url, file_config, bazel_version=None):
@@ -1273,11 +2318,9 @@ def fetch_configs(http_url, file_config, bazel_version=None):
     return load_config(http_url, file_config, bazel_version=bazel_version)
 
 
-def expand_task_config(config):
+def expand_task_config(config, max_tasks=None):
     # Expand tasks that uses attributes defined in the matrix section.
     # The original task definition expands to multiple tasks for each possible combination.
-    tasks_to_expand = []
-    expanded_tasks = {}
     matrix = config.pop("matrix", {})
     excludes = matrix.pop("exclude", [])
     if excludes and not isinstance(excludes, list):
@@ -1289,23 +2332,41 @@ def expand_task_config(config):
         if type(key) is not str or type(value) not in (list, dict):
             raise BuildkiteException("Expect `matrix` is a map of str -> list | dict")
 
+    tasks_to_expand = {}
     for task in config["tasks"]:
         attributes = get_matrix_attributes(config["tasks"][task])
         if attributes:
-            tasks_to_expand.append(task)
-            count = 1
-            for combination in get_combinations(matrix, attributes, excludes):
-                expanded_task_name = "%s_config_%.2d" % (task, count)
-                count += 1
-                expanded_tasks[expanded_task_name] = get_expanded_task(
-                    config["tasks"][task], combination
-                )
+            tasks_to_expand[task] = attributes
+
+    # Stop as soon as there are too many tasks, instead of expanding the whole matrix first.
+    task_count = len(config["tasks"]) - len(tasks_to_expand)
+    expanded_tasks = {}
+    for expanded_task_name, expanded_task in iter_expanded_tasks(
+        config["tasks"], tasks_to_expand, matrix, excludes
+    ):
+        task_count += 1
+        if max_tasks is not None and task_count > max_tasks:
+            raise BuildkiteException(
+                "The number of tasks in one config file is limited to %s, found more than that!"
+                % max_tasks
+            )
+        expanded_tasks[expanded_task_name] = expanded_task
 
     for task in tasks_to_expand:
         config["tasks"].pop(task)
     config["tasks"].update(expanded_tasks)
 
 
+def iter_expanded_tasks(tasks, tasks_to_expand, matrix, excludes):
+    """Lazily yield (name, task) for every combination of the given tasks' matrix attributes."""
+    for task, attributes in tasks_to_expand.items():
+        template = MatrixTaskTemplate(tasks[task])
+        count = 1
+        for combination in iter_combinations(matrix, attributes, excludes):
+            yield "%s_config_%.2d" % (task, count), template.expand(combination)
+            count += 1
+
+
 def maybe_overwrite_bazel_version(bazel_version, config):
     if not bazel_version:
         return
@@ -1320,11 +2381,61 @@ def maybe_overwrite_bazel_version(bazel_version, config):
 
 def load_config(http_url, file_config, allow_imports=True, bazel_version=None):
     if http_url:
-        config = load_remote_yaml_file(http_url)
+        raw_config = fetch_remote_file(http_url)
     else:
         file_config = file_config or DEFAULT_PRESUBMIT_CONFIG_PATH
-        with open(file_config, "r") as fd:
-            config = yaml.safe_load(fd)
+        with open(file_config, "rb") as fd:
+            raw_config = fd.read()
+
+    config = parse_config(raw_config, bazel_version)
+
+    imports = config.pop("imports", None)
+    if imports:
+        if not allow_imports:
+            raise BuildkiteException("Nested imports are not allowed")
+
+        # Fetch all imports in parallel, but merge them in the order in which they were declared.
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(imports), MAX_CONFIG_IMPORT_WORKERS)
+        ) as executor:
+            for imported_tasks in executor.map(
+                lambda i: load_imported_tasks(i, http_url, file_config, bazel_version), imports
+            ):
+                config["tasks"].update(imported_tasks)
+
+    if len(config["tasks"]) > MAX_TASK_NUMBER:
+        raise BuildkiteException(
+            "The number of tasks in one config file is limited to %s, found %s!"
+            % (MAX_TASK_NUMBER, len(config["tasks"])),
+        )
+
+    return config
+
+
+def parse_config(raw_config, bazel_version=None):
+    """Parses the given YAML config and expands its matrix tasks.
+
+    Results are cached in memory and optionally in BAZELCI_CONFIG_CACHE_DIR, keyed by the content
+    of the config, the bazel_version override and this script, so that loading the same config
+    again skips parsing and expansion. Every call returns a new copy that may be modified by the
+    caller, and whose tasks don't share any values.
+    """
+    key = "config/%s/%s/%s" % (
+        get_script_digest(),
+        hashlib.sha256(raw_config).hexdigest(),
+        bazel_version or "",
+    )
+    config = _CONFIG_MEMORY_CACHE.get(key)
+    disk_cache = get_config_disk_cache(BAZELCI_CONFIG_CACHE_DIR)
+    if config is None and disk_cache:
+        # The cache directory may be writable by other jobs, so it only contains plain JSON.
+        data = disk_cache.get(key)
+        if data is not None:
+            config = _CONFIG_MEMORY_CACHE[key] = json.loads(data)
+    if config is not None:
+        return copy_config(config)
+
+    config = load_yaml(raw_config)
 
     # Legacy mode means that there is exactly one task per platform (e.g. ubuntu1604_nojdk),
     # which means that we can get away with using the platform name as task ID.
@@ -1337,30 +2448,63 @@ def load_config(http_url, file_config, allow_imports=True, bazel_version=None):
         config["tasks"] = {}
 
     maybe_overwrite_bazel_version(bazel_version, config)
-    expand_task_config(config)
+    expand_task_config(config, max_tasks=MAX_TASK_NUMBER)
 
-    imports = config.pop("imports", None)
-    if imports:
-        if not allow_imports:
-            raise BuildkiteException("Nested imports are not allowed")
+    _CONFIG_MEMORY_CACHE[key] = config
+    if disk_cache:
+        try:
+            data = json.dumps(config)
+            # Configs with values that JSON cannot represent exactly (e.g. dates or non-string
+            # keys) are not stored on disk.
+            if json.loads(data) == config:
+                disk_cache.put(key, data.encode("utf-8"))
+        except (OSError, TypeError, ValueError) as ex:
+            eprint("Failed to cache config in %s: %s" % (BAZELCI_CONFIG_CACHE_DIR, ex))
+    return copy_config(config)
 
-        for i in imports:
-            imported_tasks = load_imported_tasks(i, http_url, file_config, bazel_version)
-            config["tasks"].update(imported_tasks)
 
-    if len(config["tasks"]) > MAX_TASK_NUMBER:
-        raise BuildkiteException(
-            "The number of tasks in one config file is limited to %s, found %s!"
-            % (MAX_TASK_NUMBER, len(config["tasks"])),
-        )
+def copy_config(config):
+    """
+    Returns a deep copy of the given config. Unlike copy.deepcopy(), values that were shared by
+    several tasks (e.g. after matrix expansion or via YAML aliases) are copied for every task.
+    """
+    result = {k: copy.deepcopy(v) for k, v in config.items() if k != "tasks"}
+    result["tasks"] = {}
+    for name, task in config["tasks"].items():
+        if isinstance(task, dict):
+            result["tasks"][name] = {k: copy.deepcopy(v) for k, v in task.items()}
+        else:
+            result["tasks"][name] = copy.deepcopy(task)
+    return result
 
-    return config
+
+@functools.lru_cache(maxsize=None)
+def get_config_disk_cache(directory):
+    if not directory:
+        return None
+    try:
+        return BuildkiteResponseCache(directory, max_size_bytes=BAZELCI_CONFIG_CACHE_MAX_BYTES)
+    except OSError as ex:
+        eprint("Cannot use %s as config cache: %s" % (directory, ex))
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_script_digest():
+    # Cached configs are only valid for the version of this script that created them.
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def fetch_remote_file(http_url):
+    with urllib.request.urlopen(http_url) as resp:
+        return resp.read()
 
 
 def load_remote_yaml_file(http_url):
     with urllib.request.urlopen(http_url) as resp:
         reader = codecs.getreader("utf-8")
-        return yaml.safe_load(reader(resp))
+        return load_yaml(reader(resp))
 
 
 def load_imported_tasks(import_name, http_url, file_config, bazel_version):
@@ -1658,6 +2802,7 @@ def execute_commands(
         task_config, "test_flags", "test", tmpdir, test_env_vars
     )
 
+    shard_queue = get_shard_queue()
     build_targets, test_targets, coverage_targets, index_targets = calculate_targets(
         task_config,
         bazel_binary,
@@ -1667,6 +2812,7 @@ def execute_commands(
         PrepareRepoInCwd,
         git_commit,
         test_flags,
+        shard_queue=shard_queue,
     )
 
     if build_targets:
@@ -1746,19 +2892,37 @@ def execute_commands(
         # there is a race between when bazelci-agent starts to read the file and when Bazel creates the file.
         open(test_bep_file, "w").close()
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(
-                upload_test_logs_from_bep, test_bep_file, tmpdir, monitor_flaky_tests
+            # Queued batches are tested by separate Bazel invocations, whose logs are uploaded
+            # one after another.
+            future = (
+                None
+                if shard_queue
+                else executor.submit(
+                    upload_test_logs_from_bep, test_bep_file, tmpdir, monitor_flaky_tests
+                )
             )
             try:
-                execute_bazel_test(
-                    bazel_version,
-                    bazel_binary,
-                    platform,
-                    test_flags,
-                    test_targets,
-                    test_bep_file,
-                    monitor_flaky_tests,
-                )
+                if shard_queue:
+                    execute_queued_bazel_tests(
+                        shard_queue,
+                        bazel_version,
+                        bazel_binary,
+                        platform,
+                        test_flags,
+                        test_bep_file,
+                        tmpdir,
+                        monitor_flaky_tests,
+                    )
+                else:
+                    execute_bazel_test(
+                        bazel_version,
+                        bazel_binary,
+                        platform,
+                        test_flags,
+                        test_targets,
+                        test_bep_file,
+                        monitor_flaky_tests,
+                    )
             finally:
                 if json_profile_out_test:
                     upload_log_file(json_profile_out_test, tmpdir)
@@ -1783,7 +2947,8 @@ def execute_commands(
                     )
                 collect_metrics_if_enabled(build_bep_file, test_bep_file)
 
-            _ = future.result()
+            if future:
+                _ = future.result()
             # TODO: print results
 
     if coverage_targets:
@@ -2105,9 +3270,27 @@ def get_repositories_root():
 
 
 def clone_git_repository(git_repository, git_commit=None, suppress_stdout=False):
+    """Checks out the given commit of a repository in a clean clone that is reused across runs.
+
+    Every repository has one clone per agent. The commit of the last complete checkout is
+    recorded in the clone, so that cleaning, resetting and updating the submodules can be
+    skipped if the clone is still clean and at the wanted commit (e.g. during culprit finder
+    bisects or when several runners of the same project run on one agent).
+    """
+
     def execute_git_command(args):
         execute_command(args, print_output=not suppress_stdout, suppress_stdout=suppress_stdout)
 
+    timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0) + time.time() - start
+
     root = get_repositories_root()
     project_name = re.search(r"/([^/]+)\.git$", git_repository).group(1)
     clone_path = os.path.join(root, project_name)
@@ -2116,38 +3299,242 @@ def clone_git_repository(git_repository, git_commit=None, suppress_stdout=False)
             "Fetching %s sources at %s" % (project_name, git_commit if git_commit else "HEAD")
         )
 
-    mirror_path = get_mirror_root() + re.sub(r"[^0-9A-Za-z]", "-", git_repository)
+    mirror_path = get_mirror_path(git_repository)
 
-    if not os.path.exists(clone_path):
-        if os.path.exists(mirror_path):
-            execute_git_command(
-                ["git", "clone", "-v", "--reference", mirror_path, git_repository, clone_path]
-            )
-        else:
-            execute_git_command(["git", "clone", "-v", git_repository, clone_path])
+    with phase("clone"):
+        if not os.path.exists(clone_path):
+            if os.path.exists(mirror_path):
+                execute_git_command(
+                    ["git", "clone", "-v", "--reference", mirror_path, git_repository, clone_path]
+                )
+            else:
+                execute_git_command(["git", "clone", "-v", git_repository, clone_path])
 
     os.chdir(clone_path)
-    execute_git_command(["git", "remote", "set-url", "origin", git_repository])
-    execute_git_command(["git", "clean", "-fdqx"])
-    execute_git_command(["git", "submodule", "foreach", "--recursive", "git clean -fdqx"])
-    execute_git_command(["git", "fetch", "origin"])
-    if git_commit:
-        # sync to a specific commit of this repository
-        execute_git_command(["git", "reset", git_commit, "--hard"])
+    state_path = os.path.join(clone_path, ".git", GIT_CHECKOUT_STATE_FILE)
+    with phase("fetch"):
+        execute_git_command(["git", "remote", "set-url", "origin", git_repository])
+        # There is nothing to fetch if we want a commit that is already known locally.
+        if not (git_commit and is_local_git_commit(git_commit)):
+            execute_git_command(["git", "fetch", "origin"])
+        if git_commit:
+            target = git_commit
+        else:
+            # Sync to the latest commit of HEAD. Unlike git pull this also works after a force push.
+            target = (
+                subprocess.check_output(["git", "symbolic-ref", "refs/remotes/origin/HEAD"])
+                .decode("utf-8")
+                .rstrip()
+            )
+
+    with phase("check"):
+        target_commit = get_git_commit(target)
+        is_warm = (
+            target_commit is not None
+            and read_git_checkout_state(state_path) == target_commit
+            and get_git_commit("HEAD") == target_commit
+            and is_git_checkout_clean()
+        )
+
+    if is_warm:
+        eprint("%s is already at %s, skipping the checkout." % (clone_path, target))
+        with phase("clean"):
+            execute_git_command(["git", "clean", "-fdqx"])
+            execute_git_command(
+                ["git", "submodule", "foreach", "--quiet", "--recursive", "git clean -fdqx"]
+            )
     else:
-        # sync to the latest commit of HEAD. Unlikely git pull this also works after a force push.
-        remote_head = (
-            subprocess.check_output(["git", "symbolic-ref", "refs/remotes/origin/HEAD"])
+        # Forget the last checkout in case we fail in the middle of this one.
+        write_git_checkout_state(state_path, None)
+        with phase("reset"):
+            execute_git_command(["git", "reset", target, "--hard"])
+        with phase("submodules"):
+            update_git_submodules(execute_git_command)
+        with phase("clean"):
+            execute_git_command(["git", "clean", "-fdqx"])
+        write_git_checkout_state(state_path, get_git_commit("HEAD"))
+
+    eprint(
+        "Checkout of %s took %s"
+        % (project_name, ", ".join("%s: %.1fs" % (name, t) for name, t in timings.items()))
+    )
+    return clone_path
+
+
+def get_mirror_path(git_repository):
+    return get_mirror_root() + re.sub(r"[^0-9A-Za-z]", "-", git_repository)
+
+
+def update_git_submodules(execute_git_command):
+    """Checks out clean copies of all submodules of the current repository at their recorded
+    commits."""
+    execute_git_command(["git", "submodule", "sync", "--recursive"])
+
+    if use_submodule_mirrors():
+        # A submodule can only use a reference repository when it's cloned for the first time, and
+        # every submodule needs its own mirror.
+        for path, url in get_git_submodules():
+            mirror_path = get_mirror_path(url)
+            if os.path.exists(mirror_path) and not os.path.exists(os.path.join(path, ".git")):
+                execute_git_command(
+                    ["git", "submodule", "update", "--init", "--force"]
+                    + ["--reference", mirror_path, "--", path]
+                )
+
+    execute_git_command(
+        ["git", "submodule", "update", "--init", "--recursive", "--force"]
+        + ["--jobs=%d" % get_git_submodule_jobs()]
+    )
+    # Only fork one shell per submodule.
+    execute_git_command(
+        ["git", "submodule", "foreach", "--recursive", "git reset --hard && git clean -fdqx"]
+    )
+
+
+def get_git_submodule_jobs():
+    # Repositories are never cloned on RBE platforms, so this is the number of local CPUs.
+    return min(int(concurrent_jobs(platform="")), GIT_SUBMODULE_MAX_JOBS)
+
+
+def use_submodule_mirrors():
+    """
+    If BAZELCI_USE_SUBMODULE_MIRRORS is set, submodules are cloned with the local mirror of their
+    repository (if any) as reference.
+    """
+    return is_trueish(os.environ.get("BAZELCI_USE_SUBMODULE_MIRRORS"))
+
+
+def get_git_submodules():
+    """Returns (path, url) of all direct submodules of the current repository."""
+    if not os.path.exists(".gitmodules"):
+        return []
+    try:
+        output = subprocess.check_output(
+            ["git", "config", "-f", ".gitmodules", "--get-regexp", r"^submodule\..*\.(path|url)$"]
+        ).decode("utf-8")
+    except subprocess.CalledProcessError:
+        return []
+
+    submodules = collections.defaultdict(dict)
+    for line in output.splitlines():
+        key, _, value = line.partition(" ")
+        name, _, field = key[len("submodule.") :].rpartition(".")
+        submodules[name][field] = value
+    return [(s["path"], s["url"]) for s in submodules.values() if "path" in s and "url" in s]
+
+
+def is_local_git_commit(git_commit):
+    """Returns whether git_commit is a full commit hash that exists in the current repository."""
+    if not re.match(r"^[0-9a-f]{40}$", git_commit):
+        return False
+    return (
+        subprocess.run(
+            ["git", "cat-file", "-e", git_commit + "^{commit}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+
+
+def get_git_commit(rev):
+    """Returns the commit hash of the given revision in the current repository, or None."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--verify", "-q", rev + "^{commit}"], stderr=subprocess.DEVNULL
+            )
             .decode("utf-8")
-            .rstrip()
+            .strip()
         )
-        execute_git_command(["git", "reset", remote_head, "--hard"])
-    execute_git_command(["git", "submodule", "sync", "--recursive"])
-    execute_git_command(["git", "submodule", "update", "--init", "--recursive", "--force"])
-    execute_git_command(["git", "submodule", "foreach", "--recursive", "git reset --hard"])
-    execute_git_command(["git", "clean", "-fdqx"])
-    execute_git_command(["git", "submodule", "foreach", "--recursive", "git clean -fdqx"])
-    return clone_path
+    except subprocess.CalledProcessError:
+        return None
+
+
+def is_git_checkout_clean():
+    """Returns whether the current repository and its submodules have no modified or untracked
+    files. Ignored files (such as the bazel-* symlinks) don't count since `git clean` removes them
+    cheaply, while listing them can take a long time."""
+    status_commands = [
+        ["git", "status", "--porcelain", "--untracked-files=all"],
+        [
+            "git",
+            "submodule",
+            "foreach",
+            "--quiet",
+            "--recursive",
+            "git status --porcelain --untracked-files=all",
+        ],
+    ]
+    for args in status_commands:
+        try:
+            if subprocess.check_output(args, stderr=subprocess.DEVNULL).strip():
+                return False
+        except subprocess.CalledProcessError:
+            return False
+    return True
+
+
+def read_git_checkout_state(state_path):
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f).get("commit")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def write_git_checkout_state(state_path, commit):
+    try:
+        if commit:
+            with open(state_path, "w") as f:
+                json.dump({"commit": commit}, f)
+        elif os.path.exists(state_path):
+            os.remove(state_path)
+    except OSError as ex:
+        eprint("Failed to update %s: %s" % (state_path, ex))
+
+
+def fetch_git_config_files(git_repository, git_commit, config_dir, dest_dir):
+    """Fetches only the files in config_dir of a repository into dest_dir.
+
+    This uses a shallow, blobless fetch, so that neither the history nor the content of any other
+    file has to be downloaded. git_commit may be a commit, "origin/<branch>" or None for HEAD.
+    """
+    if not git_commit:
+        ref = "HEAD"
+    elif git_commit.startswith("origin/"):
+        ref = git_commit[len("origin/") :]
+    else:
+        ref = git_commit
+
+    def git(*args):
+        execute_command_and_get_output(["git", "-C", dest_dir] + list(args), print_output=False)
+
+    git("init", "-q")
+    git("remote", "add", "origin", git_repository)
+    git("fetch", "-q", "--depth=1", "--filter=blob:none", "origin", ref)
+    # Files directly in config_dir, which includes all configs that can be imported.
+    git("checkout", "-q", "FETCH_HEAD", "--", ":(glob)" + os.path.join(config_dir, "*"))
+
+
+def load_config_from_git(git_repository, git_commit, file_config):
+    """Loads a config file from a repository without cloning the repository.
+
+    Only the directory of the config file is fetched, which is enough since imported configs have
+    to live in the same directory. Returns None if the config could not be fetched this way, in
+    which case callers should fall back to clone_git_repository().
+    """
+    file_config = file_config or DEFAULT_PRESUBMIT_CONFIG_PATH
+    if os.path.isabs(file_config):
+        return None
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            fetch_git_config_files(git_repository, git_commit, os.path.dirname(file_config), tmpdir)
+            return fetch_configs(None, os.path.join(tmpdir, file_config))
+        except (subprocess.CalledProcessError, FileNotFoundError) as ex:
+            eprint("Could not fetch %s from %s: %s" % (file_config, git_repository, ex))
+            return None
 
 
 def execute_batch_commands(
@@ -2555,6 +3942,7 @@ def calculate_targets(
     ws_setup_func,
     git_commit,
     test_flags,
+    shard_queue=None,
 ):
     print_collapsed_group(":dart: Calculating targets")
 
@@ -2590,13 +3978,25 @@ def calculate_targets(
     shard_count = int(os.getenv("BUILDKITE_PARALLEL_JOB_COUNT", "-1"))
     sharding_enabled = shard_id > -1 and shard_count > -1
 
+    if shard_queue and test_targets:
+        queued_targets = shard_queue.load(timeout_s=0)
+        if queued_targets is None and not shard_queue.claim_publisher():
+            print_collapsed_group(":hourglass: Waiting for another shard to publish the targets")
+            queued_targets = shard_queue.load()
+            if queued_targets is None:
+                eprint("Timed out waiting for the test targets, publishing them from this job")
+        if queued_targets is not None:
+            return build_targets, queued_targets, coverage_targets, index_targets
+
     use_bazel_diff = not disable_bazel_diff and diffbase and can_use_bazel_diff(git_commit)
 
     # Skip target expansion if we don't need to calculate test targets
     if not use_bazel_diff and not sharding_enabled:
         return build_targets, test_targets, coverage_targets, index_targets
 
-    expanded_test_targets = expand_test_target_patterns(bazel_binary, test_targets, test_flags)
+    expanded_test_targets = get_shared_test_target_expansion(
+        bazel_binary, test_targets, test_flags, git_commit, shard_id
+    )
 
     actual_test_targets = (
         filter_unchanged_targets(
@@ -2611,17 +4011,22 @@ def calculate_targets(
         else expanded_test_targets
     )
 
+    if shard_queue and test_targets:
+        print_collapsed_group(":inbox_tray: Publishing test targets for all shards")
+        shard_queue.publish(sorted(actual_test_targets), get_test_durations_for_sharding())
+        return build_targets, actual_test_targets, coverage_targets, index_targets
+
     if sharding_enabled:
         print_collapsed_group(
             ":female-detective: Calculating targets for shard {}/{}".format(
                 shard_id + 1, shard_count
             )
         )
-        sorted_test_targets = sorted(actual_test_targets)
-        actual_test_targets = get_targets_for_shard(sorted_test_targets, shard_id, shard_count)
+        shards = get_shard_assignment(sorted(actual_test_targets), shard_count)
+        actual_test_targets = shards[shard_id]
 
         if shard_id == 0:
-            upload_shard_distribution(sorted_test_targets, shard_count)
+            upload_shard_distribution(shards)
 
     return build_targets, actual_test_targets, coverage_targets, index_targets
 
@@ -2647,11 +4052,91 @@ def expand_test_target_patterns(bazel_binary, test_targets, test_flags):
     if not test_targets:
         return []
 
+    cache = get_query_disk_cache(BAZELCI_QUERY_CACHE_DIR)
+    key = get_test_query_cache_key(bazel_binary, test_targets, test_flags) if cache else None
+    if key:
+        data = cache.get(key)
+        if data is not None:
+            print_collapsed_group(":ninja: Reusing test targets from a previous bazel query")
+            return json.loads(data)
+
     print_collapsed_group(":ninja: Resolving test targets via bazel query")
 
     output = execute_command_and_get_output(
-        [bazel_binary]
-        + common_startup_flags()
+        [bazel_binary] + get_test_query_args(test_targets, test_flags),
+        print_output=False,
+    ).strip()
+    targets = output.split("\n") if output else []
+
+    if key:
+        try:
+            cache.put(key, json.dumps(targets).encode("utf-8"))
+        except OSError as ex:
+            eprint("Failed to cache query result in %s: %s" % (BAZELCI_QUERY_CACHE_DIR, ex))
+    return targets
+
+
+@functools.lru_cache(maxsize=None)
+def get_query_disk_cache(directory):
+    if not directory:
+        return None
+    try:
+        return BuildkiteResponseCache(directory, max_size_bytes=BAZELCI_QUERY_CACHE_MAX_BYTES)
+    except OSError as ex:
+        eprint("Cannot use %s as query cache: %s" % (directory, ex))
+        return None
+
+
+def get_test_query_cache_key(bazel_binary, test_targets, test_flags):
+    """
+    Returns the cache key of the test target query in the current repository, or None if the
+    result must not be cached since the checkout has local modifications.
+    """
+    fingerprint = get_query_input_fingerprint()
+    if not fingerprint:
+        return None
+    data = json.dumps(
+        [
+            get_bazel_version_output(bazel_binary),
+            "cquery" if os.getenv("EXP_USE_CQUERY") else "query",
+            get_query_flags(test_flags),
+            get_test_query(test_targets, test_flags),
+            fingerprint,
+        ]
+    )
+    return "query/" + hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def get_query_input_fingerprint():
+    """
+    Returns the id of the Git tree of the checkout, or None if it has local modifications.
+
+    The whole tree is used since source files can change the result too, e.g. via glob() in BUILD
+    files or .bazelrc imports.
+    """
+    try:
+        modified = execute_command_and_get_output(
+            ["git", "status", "--porcelain", "--untracked-files=all"], print_output=False
+        )
+        if modified.strip():
+            return None
+        return execute_command_and_get_output(
+            ["git", "rev-parse", "HEAD^{tree}"], print_output=False
+        ).strip()
+    except (subprocess.CalledProcessError, OSError) as ex:
+        eprint("Cannot fingerprint the query inputs: %s" % ex)
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_bazel_version_output(bazel_binary):
+    # Bazelisk resolves the version from USE_BAZEL_VERSION, .bazelversion or the latest release.
+    return execute_command_and_get_output([bazel_binary, "--version"], print_output=False).strip()
+
+
+def get_test_query_args(test_targets, test_flags):
+    return (
+        common_startup_flags()
         + get_query_flags(test_flags)
         + [
             "--nosystem_rc",
@@ -2659,10 +4144,85 @@ def expand_test_target_patterns(bazel_binary, test_targets, test_flags):
             "cquery" if os.getenv("EXP_USE_CQUERY") else "query",
             "--lockfile_mode=off",
             get_test_query(test_targets, test_flags),
-        ],
-        print_output=False,
-    ).strip()
-    return output.split("\n") if output else []
+        ]
+    )
+
+
+def get_test_query_key(git_commit, test_targets, test_flags):
+    """Returns a digest of everything that determines the result of the test target query."""
+    # Startup flags are left out on purpose since they can differ between agents, e.g. the
+    # --output_user_root of Windows machines.
+    data = json.dumps(
+        [
+            git_commit,
+            os.getenv("USE_BAZEL_VERSION", ""),
+            "cquery" if os.getenv("EXP_USE_CQUERY") else "query",
+            get_query_flags(test_flags),
+            get_test_query(test_targets, test_flags),
+        ]
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def get_shared_test_target_expansion(bazel_binary, test_targets, test_flags, git_commit, shard_id):
+    """
+    Like expand_test_target_patterns(), but if BAZELCI_SHARE_TARGET_EXPANSION is set, only the
+    first shard runs the query and uploads its result as an artifact. The other shards download it
+    and only run the query themselves if the artifact doesn't appear in time.
+    """
+    if not test_targets or not is_trueish(os.getenv(SHARE_TARGET_EXPANSION_ENV_VAR)):
+        return expand_test_target_patterns(bazel_binary, test_targets, test_flags)
+
+    artifact = "bazelci-test-targets-{}.json".format(
+        get_test_query_key(git_commit, test_targets, test_flags)
+    )
+    if shard_id > 0:
+        print_collapsed_group(":hourglass: Waiting for shard 1 to resolve the test targets")
+        targets = download_json_artifact(artifact, TARGET_EXPANSION_TIMEOUT_S)
+        if targets is not None:
+            return targets
+        eprint(f"Could not download {artifact}, resolving test targets locally")
+
+    targets = sorted(expand_test_target_patterns(bazel_binary, test_targets, test_flags))
+    if shard_id == 0:
+        try:
+            upload_json_artifact(artifact, targets)
+        except (OSError, subprocess.CalledProcessError) as ex:
+            # The other shards will resolve the targets themselves.
+            eprint(f"Failed to upload {artifact}: {ex}")
+    return targets
+
+
+def upload_json_artifact(artifact, data):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, artifact), mode="w", encoding="utf-8") as fp:
+            json.dump(data, fp)
+        execute_command(["buildkite-agent", "artifact", "upload", artifact], cwd=tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def download_json_artifact(artifact, timeout_s, poll_interval_s=15):
+    """Waits until the given artifact of the current build exists and returns its content."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        deadline = time.time() + timeout_s
+        while True:
+            process = subprocess.run(
+                ["buildkite-agent", "artifact", "download", artifact, tmpdir],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            path = os.path.join(tmpdir, artifact)
+            if process.returncode == 0 and os.path.exists(path):
+                with open(path, mode="r", encoding="utf-8") as fp:
+                    return json.load(fp)
+            if time.time() > deadline:
+                return None
+            time.sleep(poll_interval_s)
+    finally:
+        shutil.rmtree(tmpdir)
 
 
 def get_test_query(test_targets, test_flags):
@@ -2834,13 +4394,10 @@ def filter_unchanged_targets(
     return remaining_targets
 
 
-def upload_shard_distribution(sorted_test_targets, shard_count):
+def upload_shard_distribution(shards):
     tmpdir = tempfile.mkdtemp()
     try:
-        data = {
-            s + 1: get_targets_for_shard(sorted_test_targets, s, shard_count)
-            for s in range(shard_count)
-        }
+        data = {s + 1: targets for s, targets in enumerate(shards)}
         base = f"{os.getenv('BUILDKITE_PIPELINE_SLUG')}_{os.getenv('BUILDKITE_BUILD_NUMBER')}_shards.json"
         path = os.path.join(tmpdir, base)
         with open(path, mode="w", encoding="utf-8") as fp:
@@ -2915,82 +4472,395 @@ def extract_archive(archive_path, dest_dir, strip_top_level_dir):
         raise BuildkiteInfraException("Failed to extract repository archive: {}".format(ex)) from ex
 
 
-def download_file(url, dest_dir, dest_filename):
-    local_path = os.path.join(dest_dir, dest_filename)
-    try:
-        execute_command(["curl", *CURL_FLAGS, url, "-o", local_path], capture_stderr=True)
-    except subprocess.CalledProcessError as ex:
-        raise BuildkiteInfraException("Failed to download {}: {}\n{}".format(url, ex, ex.stderr))
-    return local_path
+def download_file(url, dest_dir, dest_filename):
+    local_path = os.path.join(dest_dir, dest_filename)
+    try:
+        execute_command(["curl", *CURL_FLAGS, url, "-o", local_path], capture_stderr=True)
+    except subprocess.CalledProcessError as ex:
+        raise BuildkiteInfraException("Failed to download {}: {}\n{}".format(url, ex, ex.stderr))
+    return local_path
+
+
+def run_bazel_diff(bazel_diff_path, old_workspace_dir, new_workspace_dir, bazel_binary, data_dir):
+    before_json = os.path.join(data_dir, "before.json")
+    after_json = os.path.join(data_dir, "after.json")
+    targets_file = os.path.join(data_dir, "targets.txt")
+
+    try:
+        for repo_dir, json_path in (
+            (old_workspace_dir, before_json),
+            (new_workspace_dir, after_json),
+        ):
+            execute_command(
+                [
+                    "java",
+                    "-jar",
+                    bazel_diff_path,
+                    "generate-hashes",
+                    "--excludeExternalTargets",
+                    "-w",
+                    repo_dir,
+                    "-b",
+                    bazel_binary,
+                    "--bazelCommandOptions=--lockfile_mode=off",
+                    json_path,
+                ],
+                capture_stderr=True,
+            )
+
+        execute_command(
+            [
+                "java",
+                "-jar",
+                bazel_diff_path,
+                "get-impacted-targets",
+                "-sh",
+                before_json,
+                "-fh",
+                after_json,
+                "-o",
+                targets_file,
+            ],
+            capture_stderr=True,
+        )
+    except subprocess.CalledProcessError as ex:
+        raise BuildkiteInfraException("Failed to run bazel-diff: {}\n{}".format(ex, ex.stderr))
+
+    with open(targets_file, "rt") as f:
+        contents = f.read()
+
+    return contents.split("\n")
+
+
+def partition_list(items):
+    included, excluded, added_back = [], [], []
+    for i in items:
+        if i.startswith("-"):
+            excluded.append(i[1:])
+        elif i.startswith("+"):
+            added_back.append(i[1:])
+        else:
+            included.append(i)
+
+    return included, excluded, added_back
+
+
+def get_targets_for_shard(sorted_test_targets, shard_id, shard_count, durations=None):
+    if not durations:
+        return sorted_test_targets[shard_id::shard_count]
+    return assign_targets_to_shards(sorted_test_targets, shard_count, durations)[shard_id]
+
+
+def assign_targets_to_shards(sorted_test_targets, shard_count, durations):
+    """
+    Distributes targets across shards so that their expected durations are balanced.
+
+    Targets with a known duration are packed longest-processing-time-first: every target goes to
+    the shard with the lowest total so far, ties are broken by shard number. Targets without a
+    history are distributed round-robin afterwards.
+    """
+    shards = [[] for _ in range(shard_count)]
+    known = [t for t in sorted_test_targets if t in durations]
+    unknown = [t for t in sorted_test_targets if t not in durations]
+
+    loads = [(0.0, s) for s in range(shard_count)]
+    for target in sorted(known, key=lambda t: (-durations[t], t)):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(target)
+        heapq.heappush(loads, (load + durations[target], shard))
+
+    for i, target in enumerate(unknown):
+        shards[i % shard_count].append(target)
+
+    return [sorted(targets) for targets in shards]
+
+
+def load_test_durations(path):
+    """
+    Reads historical test durations in seconds by label.
+
+    JSON files contain either a {label: seconds} object or a list of objects with "label" and
+    "duration_s" keys (such as collect_metrics.TestTarget rows). CSV files need a header with
+    "label" and "duration_s" columns. SQLite files are read as a TestDurationStore.
+    """
+    if path.endswith((".db", ".sqlite")):
+        with TestDurationStore(path) as store:
+            return store.get_durations(pipeline=os.getenv("BUILDKITE_PIPELINE_SLUG"))
+
+    with open(path, "rt", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+
+    if isinstance(rows, dict):
+        return {label: float(duration) for label, duration in rows.items()}
+    return {row["label"]: float(row["duration_s"]) for row in rows}
+
+
+def get_shard_assignment(sorted_test_targets, shard_count):
+    """
+    Returns the test targets of every shard.
+
+    The result only depends on the targets and on the pinned durations snapshot, so all shards
+    compute the same assignment without having to wait for each other.
+    """
+    durations = get_test_durations_for_sharding()
+    if durations:
+        return assign_targets_to_shards(sorted_test_targets, shard_count, durations)
+    return [get_targets_for_shard(sorted_test_targets, s, shard_count) for s in range(shard_count)]
+
+
+def get_test_durations_for_sharding():
+    """
+    Returns the durations in BAZELCI_TEST_DURATIONS_FILE, or None if there are none.
+
+    The durations are only used if BAZELCI_TEST_DURATIONS_SHA256 pins their content. A shard that
+    cannot read exactly this content fails, since it cannot know which targets the other shards
+    test.
+    """
+    source = os.getenv(TEST_DURATIONS_FILE_ENV_VAR)
+    if not source:
+        return None
+    digest = os.getenv(TEST_DURATIONS_SHA256_ENV_VAR, "").lower()
+    if not digest:
+        eprint(
+            f"Ignoring {source} since {TEST_DURATIONS_SHA256_ENV_VAR} is not set, "
+            "falling back to round-robin"
+        )
+        return None
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if source.startswith(("http://", "https://")):
+            data = fetch_remote_file(source)
+            name = os.path.basename(urllib.parse.urlparse(source).path)
+        else:
+            with open(source, "rb") as f:
+                data = f.read()
+            name = os.path.basename(source)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"its SHA-256 is not {digest}")
+        # load_test_durations() picks the format by file extension.
+        path = os.path.join(tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return load_test_durations(path)
+    except (urllib.error.URLError, OSError, ValueError, KeyError, TypeError, sqlite3.Error) as ex:
+        raise BuildkiteException(f"Could not load test durations from {source}: {ex}")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def simulate_sharding(sorted_test_targets, shard_count, durations):
+    """
+    Returns the expected per-shard durations of round-robin and duration-aware sharding.
+
+    Targets without a history are assumed to take the median of the known durations.
+    """
+    known = sorted(durations[t] for t in sorted_test_targets if t in durations)
+    default = known[len(known) // 2] if known else 0.0
+
+    def loads(assignment):
+        return [sum(durations.get(t, default) for t in targets) for targets in assignment]
+
+    round_robin = loads(
+        [get_targets_for_shard(sorted_test_targets, s, shard_count) for s in range(shard_count)]
+    )
+    balanced = loads(assign_targets_to_shards(sorted_test_targets, shard_count, durations))
+    total = sum(round_robin)
+    longest = max((durations.get(t, default) for t in sorted_test_targets), default=0.0)
+    return {
+        "round_robin": round_robin,
+        "duration_aware": balanced,
+        # No assignment can finish faster than this.
+        "lower_bound": max(total / shard_count, longest),
+    }
+
+
+def print_sharding_simulation(durations_file, shard_count, targets_file=None):
+    durations = load_test_durations(durations_file)
+    if targets_file:
+        with open(targets_file, "rt", encoding="utf-8") as f:
+            targets = sorted(line.strip() for line in f if line.strip())
+    else:
+        targets = sorted(durations)
+
+    result = simulate_sharding(targets, shard_count, durations)
+    print(f"{len(targets)} targets on {shard_count} shards")
+    print(f"Lower bound: {result['lower_bound']:.1f}s")
+    for strategy in ("round_robin", "duration_aware"):
+        loads = result[strategy]
+        print(f"{strategy}: makespan {max(loads):.1f}s, fastest shard {min(loads):.1f}s")
+
+
+class BuildkiteMetaDataStore:
+    """Key-value store in the meta-data of the current build."""
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+
+    def get(self, key):
+        process = subprocess.run(
+            ["buildkite-agent", "meta-data", "get", self._prefix + key],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+        return process.stdout if process.returncode == 0 else None
+
+    def set(self, key, value):
+        execute_command(
+            ["buildkite-agent", "meta-data", "set", self._prefix + key, value], print_output=False
+        )
+
+
+class FileStore:
+    """Key-value store in a (possibly shared) directory."""
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self._directory, key), "rt", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        path = os.path.join(self._directory, key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wt", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp, path)
 
 
-def run_bazel_diff(bazel_diff_path, old_workspace_dir, new_workspace_dir, bazel_binary, data_dir):
-    before_json = os.path.join(data_dir, "before.json")
-    after_json = os.path.join(data_dir, "after.json")
-    targets_file = os.path.join(data_dir, "targets.txt")
+class ShardQueue:
+    """
+    Distributes the test targets of a sharded step among its parallel jobs at runtime.
 
-    try:
-        for repo_dir, json_path in (
-            (old_workspace_dir, before_json),
-            (new_workspace_dir, after_json),
-        ):
-            execute_command(
-                [
-                    "java",
-                    "-jar",
-                    bazel_diff_path,
-                    "generate-hashes",
-                    "--excludeExternalTargets",
-                    "-w",
-                    repo_dir,
-                    "-b",
-                    bazel_binary,
-                    "--bazelCommandOptions=--lockfile_mode=off",
-                    json_path,
-                ],
-                capture_stderr=True,
-            )
+    The first job to start publishes the targets. Batch n belongs to shard n % shard_count, which
+    tests its batches front to back. Once a job is done with its own batches, it steals batches of
+    the other shards from the back. Consequently all jobs finish within about one batch of each
+    other, even if some agents are slower or the durations of targets changed. A retried job tests
+    all batches that it had tested before, as well as any of its batches that weren't stolen.
 
-        execute_command(
-            [
-                "java",
-                "-jar",
-                bazel_diff_path,
-                "get-impacted-targets",
-                "-sh",
-                before_json,
-                "-fh",
-                after_json,
-                "-o",
-                targets_file,
-            ],
-            capture_stderr=True,
-        )
-    except subprocess.CalledProcessError as ex:
-        raise BuildkiteInfraException("Failed to run bazel-diff: {}\n{}".format(ex, ex.stderr))
+    Neither store supports atomic operations, so every key is only written by a single job: each
+    stealable batch has one designated thief, and the owner and the thief decide who tests the
+    batch with a handshake.
+    """
 
-    with open(targets_file, "rt") as f:
-        contents = f.read()
+    def __init__(self, store, shard_id, shard_count, retry=False):
+        self._store = store
+        self._shard_id = shard_id
+        self._shard_count = shard_count
+        self._retry = retry
+        self._targets = None
+        self._batch_size = None
 
-    return contents.split("\n")
+    def claim_publisher(self):
+        """
+        Returns whether this job should publish the targets. Two jobs that start at the same time
+        may both do so, which is harmless since they publish the same targets.
+        """
+        owner = str(self._shard_id)
+        publisher = self._store.get("publisher")
+        if publisher is None:
+            self._store.set("publisher", owner)
+            return True
+        return publisher == owner
+
+    def publish(self, targets, durations=None):
+        """Publishes the targets, with the longest known targets first if durations are given."""
+        if durations:
+            targets = sorted(targets, key=lambda t: (-durations.get(t, 0.0), t))
+        batch_count = self._shard_count * SHARD_QUEUE_BATCHES_PER_SHARD
+        batch_size = max(1, math.ceil(len(targets) / batch_count))
+        data = json.dumps({"targets": targets, "batch_size": batch_size})
+        chunks = [
+            data[i : i + SHARD_QUEUE_CHUNK_SIZE] for i in range(0, len(data), SHARD_QUEUE_CHUNK_SIZE)
+        ]
+        for i, chunk in enumerate(chunks):
+            self._store.set(f"targets-{i}", chunk)
+        # Written last since other jobs wait for it.
+        self._store.set("chunks", str(len(chunks)))
+        self._targets, self._batch_size = targets, batch_size
+
+    def load(self, timeout_s=None, poll_interval_s=5):
+        """Waits until the targets have been published and returns them, or None on timeout."""
+        deadline = time.time() + (SHARD_QUEUE_TIMEOUT_S if timeout_s is None else timeout_s)
+        while True:
+            chunks = self._store.get("chunks")
+            if chunks:
+                break
+            if time.time() >= deadline:
+                return None
+            time.sleep(poll_interval_s)
+
+        data = json.loads("".join(self._store.get(f"targets-{i}") for i in range(int(chunks))))
+        self._targets, self._batch_size = data["targets"], data["batch_size"]
+        return self._targets
+
+    def claim_batches(self):
+        """Yields batches of targets that this job should test, until the queue is drained."""
+        for number in self._get_batch_numbers(self._shard_id):
+            # Owner half of the handshake: announce the batch, then check for a thief.
+            self._store.set(f"owner-{number}", "1")
+            if self._wait_for_thief(number) != "2":
+                yield self._get_batch(number)
+
+        for offset in range(1, self._shard_count):
+            victim = (self._shard_id + offset) % self._shard_count
+            numbers = self._get_batch_numbers(victim)[::-1]
+            # The batches of a shard are stolen by all other shards in turn, starting at the back.
+            for number in numbers[offset - 1 :: self._shard_count - 1]:
+                state = self._store.get(f"thief-{number}") if self._retry else None
+                if state in (None, "1"):
+                    # Thief half: the batch is only stolen if its owner hasn't announced it yet.
+                    self._store.set(f"thief-{number}", "1")
+                    state = "0" if self._store.get(f"owner-{number}") else "2"
+                    self._store.set(f"thief-{number}", state)
+                if state != "2":
+                    # The owner got here first, and will also test all batches in front of it.
+                    break
+                yield self._get_batch(number)
 
+    def _get_batch_numbers(self, shard_id):
+        batch_count = math.ceil(len(self._targets) / self._batch_size)
+        return list(range(shard_id, batch_count, self._shard_count))
 
-def partition_list(items):
-    included, excluded, added_back = [], [], []
-    for i in items:
-        if i.startswith("-"):
-            excluded.append(i[1:])
-        elif i.startswith("+"):
-            added_back.append(i[1:])
-        else:
-            included.append(i)
+    def _get_batch(self, number):
+        start = number * self._batch_size
+        return self._targets[start : start + self._batch_size]
 
-    return included, excluded, added_back
+    def _wait_for_thief(self, number):
+        # If the thief announced the batch before it saw our announcement, it decides.
+        deadline = time.time() + SHARD_QUEUE_STEAL_TIMEOUT_S
+        while True:
+            state = self._store.get(f"thief-{number}")
+            if state != "1" or time.time() > deadline:
+                return state
+            time.sleep(1)
 
 
-def get_targets_for_shard(sorted_test_targets, shard_id, shard_count):
-    # TODO(fweikert): implement a more sophisticated algorithm
-    return sorted_test_targets[shard_id::shard_count]
+def get_shard_queue():
+    """Returns the ShardQueue of the current job if the step uses one."""
+    shard_id = int(os.getenv("BUILDKITE_PARALLEL_JOB", "-1"))
+    shard_count = int(os.getenv("BUILDKITE_PARALLEL_JOB_COUNT", "-1"))
+    if not is_trueish(os.getenv(SHARD_QUEUE_ENV_VAR)) or shard_id < 0 or shard_count < 0:
+        return None
+
+    # All parallel jobs of a step share its id.
+    step_id = os.getenv("BUILDKITE_STEP_ID", "local")
+    directory = os.getenv(SHARD_QUEUE_DIR_ENV_VAR)
+    if directory:
+        store = FileStore(os.path.join(directory, step_id))
+    else:
+        store = BuildkiteMetaDataStore(f"bazelci-shard-queue-{step_id}-")
+    retry = int(os.getenv("BUILDKITE_RETRY_COUNT", "0")) > 0
+    return ShardQueue(store, shard_id, shard_count, retry=retry)
 
 
 def execute_bazel_test(
@@ -3035,6 +4905,52 @@ def execute_bazel_test(
         handle_bazel_failure(e, "test")
 
 
+def execute_queued_bazel_tests(
+    shard_queue,
+    bazel_version,
+    bazel_binary,
+    platform,
+    flags,
+    bep_file,
+    tmpdir,
+    monitor_flaky_tests,
+):
+    """
+    Tests batches from the shard queue until it is drained, and collects all results in bep_file.
+    Test failures are only reported once there are no batches left.
+    """
+    failure = None
+    for number, batch in enumerate(shard_queue.claim_batches(), 1):
+        batch_bep_file = os.path.join(tmpdir, f"test_bep_{number}.json")
+        try:
+            execute_bazel_test(
+                bazel_version,
+                bazel_binary,
+                platform,
+                flags,
+                batch,
+                batch_bep_file,
+                monitor_flaky_tests,
+            )
+        except BuildkiteException as ex:
+            failure = failure or ex
+        finally:
+            if os.path.exists(batch_bep_file):
+                upload_test_logs_from_bep(batch_bep_file, tmpdir, monitor_flaky_tests)
+                with open(batch_bep_file, "rb") as src, open(bep_file, "ab") as dest:
+                    shutil.copyfileobj(src, dest)
+
+    # The shard summary and the metrics expect a single BEP file per job. Both can parse the
+    # concatenated streams of all batches, whereas the test logs were uploaded per batch above.
+    if not local_run_only():
+        execute_command(
+            ["buildkite-agent", "artifact", "upload", os.path.basename(bep_file)],
+            cwd=os.path.dirname(bep_file),
+        )
+    if failure:
+        raise failure
+
+
 def execute_bazel_coverage(bazel_version, bazel_binary, platform, flags, targets):
     aggregated_flags = [
         "--build_tests_only",
@@ -3290,12 +5206,40 @@ def print_project_pipeline(
     use_but=False,
     notify=False,
     print_shard_summary=False,
+):
+    pipeline_steps = create_project_pipeline_steps(
+        configs,
+        project_name,
+        http_config,
+        file_config,
+        git_repository,
+        git_commit=git_commit,
+        monitor_flaky_tests=monitor_flaky_tests,
+        use_but=use_but,
+        notify=notify,
+        print_shard_summary=print_shard_summary,
+    )
+    print_pipeline_steps(pipeline_steps, handle_emergencies=not is_downstream_pipeline())
+
+
+def create_project_pipeline_steps(
+    configs,
+    project_name,
+    http_config,
+    file_config,
+    git_repository,
+    git_commit=None,
+    monitor_flaky_tests=False,
+    use_but=False,
+    notify=False,
+    print_shard_summary=False,
+    include_initial_steps=True,
 ):
     task_configs = configs.get("tasks", None)
     if not task_configs:
         raise BuildkiteException("{0} pipeline configuration is empty.".format(project_name))
 
-    pipeline_steps = create_initial_steps()
+    pipeline_steps = create_initial_steps() if include_initial_steps else []
     # If the repository is hosted on Git-on-borg, we show the link to the commit Gerrit review
     buildkite_repo = os.getenv("BUILDKITE_REPO")
     if is_git_on_borg_repo(buildkite_repo):
@@ -3432,7 +5376,7 @@ def print_project_pipeline(
             create_step(
                 label="Try Update Last Green Commit",
                 commands=[
-                    fetch_ci_scripts_command(),
+                    fetch_ci_scripts_command(DEFAULT_PLATFORM),
                     PLATFORMS[DEFAULT_PLATFORM]["python"]
                     + " bazelci.py try_update_last_green_commit",
                 ],
@@ -3457,25 +5401,19 @@ def print_project_pipeline(
             create_step(
                 label="Print Test Summary for Shards",
                 commands=[
-                    fetch_ci_scripts_command(),
+                    fetch_ci_scripts_command(DEFAULT_PLATFORM),
                     PLATFORMS[DEFAULT_PLATFORM]["python"] + " bazelci.py print_shard_summary",
                 ],
                 platform=DEFAULT_PLATFORM,
             )
         )
 
-    print_pipeline_steps(pipeline_steps, handle_emergencies=not is_downstream_pipeline())
+    return pipeline_steps
 
 
 def create_initial_steps():
     steps = []
-    default_branch = os.getenv("BUILDKITE_PIPELINE_DEFAULT_BRANCH")
-    if (
-        THIS_IS_TRUSTED
-        or os.getenv("BUILDKITE_BRANCH") == default_branch
-        or RELEASE_BRANCH_RE.fullmatch(os.getenv("BUILDKITE_BRANCH"))
-        or has_presubmit_auto_run_label()
-    ):
+    if not should_block_modified_config_files():
         return steps
 
     modified_files = get_modified_files(os.getenv("BUILDKITE_COMMIT"))
@@ -3499,6 +5437,26 @@ def create_initial_steps():
     return steps
 
 
+def should_block_modified_config_files():
+    default_branch = os.getenv("BUILDKITE_PIPELINE_DEFAULT_BRANCH")
+    return not (
+        THIS_IS_TRUSTED
+        or os.getenv("BUILDKITE_BRANCH") == default_branch
+        or RELEASE_BRANCH_RE.fullmatch(os.getenv("BUILDKITE_BRANCH"))
+        or has_presubmit_auto_run_label()
+    )
+
+
+def project_pipeline_needs_git_checkout(configs, include_initial_steps=True):
+    """
+    Returns whether creating the project pipeline runs Git commands to find modified files,
+    which requires the project repository as working directory.
+    """
+    if include_initial_steps and should_block_modified_config_files():
+        return True
+    return "validate_config" in configs and not is_downstream_pipeline()
+
+
 def has_presubmit_auto_run_label():
     return any(
         label in PRESUBMIT_AUTO_RUN_LABELS
@@ -3619,7 +5577,7 @@ def create_config_validation_steps(git_commit):
         create_step(
             label=":cop: Validate {}".format(f),
             commands=[
-                fetch_ci_scripts_command(),
+                fetch_ci_scripts_command(DEFAULT_PLATFORM),
                 "{} bazelci.py project_pipeline --file_config={}".format(
                     PLATFORMS[DEFAULT_PLATFORM]["python"], f
                 ),
@@ -3654,7 +5612,7 @@ def print_pipeline_steps(pipeline_steps, handle_emergencies=True):
         if emergency_step:
             pipeline_steps.insert(0, emergency_step)
 
-    print(yaml.dump({"steps": pipeline_steps}))
+    print(dump_yaml({"steps": pipeline_steps}))
 
 
 def create_emergency_announcement_step_if_necessary():
@@ -3721,7 +5679,7 @@ def runner_step(
     if use_but:
         command += " --use_but"
     label = create_label(platform, project_name, task_name=task_name)
-    commands = [fetch_ci_scripts_command(), command]
+    commands = [fetch_ci_scripts_command(platform), command]
     if "macos" in platform:
         commands = [f"which {py}", f"{py} -V"] + commands
     return create_step(
@@ -3733,13 +5691,97 @@ def runner_step(
     )
 
 
-def fetch_ci_scripts_command():
-    return [
-        curl_download_command("{0}?{1}".format(SCRIPT_URL, int(time.time())), "bazelci.py"),
-        curl_download_command(
-            "{0}?{1}".format(METRICS_SCRIPT_URL, int(time.time())), "collect_metrics.py"
-        ),
-    ]
+def fetch_ci_scripts_command(platform):
+    scripts = ("bazelci.py", "collect_metrics.py")
+    commit = resolve_ci_script_commit(GITHUB_REF) if use_pinned_ci_scripts() else None
+    digests = get_ci_script_digests(commit, scripts) if commit else None
+    if not digests:
+        return [
+            curl_download_command("{0}?{1}".format(SCRIPT_URL, int(time.time())), "bazelci.py"),
+            curl_download_command(
+                "{0}?{1}".format(METRICS_SCRIPT_URL, int(time.time())), "collect_metrics.py"
+            ),
+        ]
+
+    # URLs that contain a commit never change, so there's no need to bypass caches.
+    urls = {s: CI_SCRIPT_URL_TEMPLATE.format(ref=commit, script=s) for s in scripts}
+    family = get_ci_script_cache_family(platform)
+    if not family:
+        return [curl_download_command(urls[s], s) for s in scripts]
+    return [cached_ci_script_command(urls[s], s, digests[s], family) for s in scripts]
+
+
+def use_pinned_ci_scripts():
+    """
+    If BAZELCI_PIN_CI_SCRIPTS is set, steps download the CI scripts of the commit that GITHUB_REF
+    currently points to, and agents keep them in a cache that is addressed by their content.
+    """
+    return is_trueish(os.environ.get("BAZELCI_PIN_CI_SCRIPTS"))
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_ci_script_commit(ref):
+    """Returns the commit that the given ref points to, or None if it cannot be resolved."""
+    if re.fullmatch(r"[0-9a-f]{40}", ref):
+        return ref
+    request = urllib.request.Request(
+        CI_COMMIT_API_URL.format(urllib.parse.quote(ref, safe="")),
+        headers={"Accept": "application/vnd.github.sha"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            commit = resp.read().decode("utf-8").strip()
+    except (urllib.error.URLError, OSError) as ex:
+        eprint(f"Could not resolve {ref} of the CI scripts, falling back to unpinned scripts: {ex}")
+        return None
+    return commit if re.fullmatch(r"[0-9a-f]{40}", commit) else None
+
+
+@functools.lru_cache(maxsize=None)
+def get_ci_script_digests(commit, scripts):
+    """Returns the SHA-256 of the given scripts at the given commit, or None on failure."""
+    try:
+        return {
+            s: hashlib.sha256(
+                fetch_remote_file(CI_SCRIPT_URL_TEMPLATE.format(ref=commit, script=s))
+            ).hexdigest()
+            for s in scripts
+        }
+    except (urllib.error.URLError, OSError) as ex:
+        eprint(f"Could not fetch the CI scripts at {commit}, falling back to unpinned scripts: {ex}")
+        return None
+
+
+def get_ci_script_cache_family(platform):
+    if "windows" in platform:
+        # Windows steps are not run by a POSIX shell.
+        return None
+    return "macos" if "macos" in platform else "linux"
+
+
+def cached_ci_script_command(url, script, digest, family):
+    """
+    Returns a shell command that copies the given script from the agent's cache and only downloads
+    it if it's missing. Cache entries are addressed by the SHA-256 of their content, which is
+    checked on every use since other jobs on the machine can write to the cache.
+
+    New entries are published under a job specific name and then renamed, so that concurrent jobs
+    never read partial files. Entries that were created more than CI_SCRIPT_CACHE_MAX_AGE_DAYS ago
+    are removed whenever a script is downloaded.
+    """
+    root = CI_SCRIPT_CACHE_DIRS[family]
+    cache_dir = f"{root}/{digest}"
+    cached = f"{cache_dir}/{script}"
+    # "$$" stops `buildkite-agent pipeline upload` from interpolating the variable.
+    tmp = f"{cached}.$${{BUILDKITE_JOB_ID:-tmp}}"
+    verify = f"echo '{digest}  {script}' | {CI_SCRIPT_SHA256_COMMANDS[family]} -c -"
+    evict = f"find {root} -mindepth 1 -maxdepth 1 -mtime +{CI_SCRIPT_CACHE_MAX_AGE_DAYS}"
+    return (
+        f"{{ cp {cached} {script} && {verify}; }} >/dev/null 2>&1 || "
+        f"{{ {curl_download_command(url, script)} && {verify} && "
+        f"{{ {{ {evict} -exec rm -rf {{}} + ; mkdir -p {cache_dir} && cp {script} {tmp} && "
+        f"mv -f {tmp} {cached}; }} >/dev/null 2>&1 || true; }}; }}"
+    )
 
 
 def fetch_aggregate_incompatible_flags_test_result_command():
@@ -3765,7 +5807,7 @@ def upload_project_pipeline_step(
 
     return create_step(
         label="Setup {0}".format(project_name),
-        commands=[fetch_ci_scripts_command(), pipeline_command],
+        commands=[fetch_ci_scripts_command(DEFAULT_PLATFORM), pipeline_command],
         platform=DEFAULT_PLATFORM,
     )
 
@@ -3821,7 +5863,7 @@ def bazel_build_step(
 
     step = create_step(
         label=create_label(platform, project_name, build_only, test_only),
-        commands=[fetch_ci_scripts_command(), pipeline_command],
+        commands=[fetch_ci_scripts_command(platform), pipeline_command],
         platform=platform,
     )
     # Always try to automatically retry the bazel build step, this will make
@@ -3943,7 +5985,7 @@ def print_bazel_publish_binaries_pipeline(task_configs, http_config, file_config
         create_step(
             label="Publish Bazel Binaries",
             commands=[
-                fetch_ci_scripts_command(),
+                fetch_ci_scripts_command(DEFAULT_PLATFORM),
                 PLATFORMS[DEFAULT_PLATFORM]["python"] + " bazelci.py publish_binaries",
             ],
             platform=DEFAULT_PLATFORM,
@@ -3957,7 +5999,7 @@ def print_bazel_publish_binaries_pipeline(task_configs, http_config, file_config
             create_step(
                 label="Update last green commit for Bazel",
                 commands=[
-                    fetch_ci_scripts_command(),
+                    fetch_ci_scripts_command(DEFAULT_PLATFORM),
                     PLATFORMS[DEFAULT_PLATFORM]["python"]
                     + " bazelci.py try_update_last_green_commit",
                 ],
@@ -4049,7 +6091,12 @@ def fetch_incompatible_flags():
 
 
 def print_bazel_downstream_pipeline(
-    task_configs, http_config, file_config, test_disabled_projects, notify
+    task_configs,
+    http_config,
+    file_config,
+    test_disabled_projects,
+    notify,
+    inline_project_pipelines=False,
 ):
     pipeline_steps = create_initial_steps()
 
@@ -4091,6 +6138,7 @@ def print_bazel_downstream_pipeline(
         if info_box_step is not None:
             pipeline_steps.append(info_box_step)
 
+    projects = []
     for project, config in DOWNSTREAM_PROJECTS.items():
         disabled_reason = config.get("disabled_reason", None)
         # If test_disabled_projects is true, we add configs for disabled projects.
@@ -4098,18 +6146,12 @@ def print_bazel_downstream_pipeline(
         if (test_disabled_projects and disabled_reason) or (
             not test_disabled_projects and not disabled_reason
         ):
-            git_commit = (
-                "origin/" + config["git_branch"] if "git_branch" in config else None
-            )
-            pipeline_steps.append(
-                upload_project_pipeline_step(
-                    project_name=project,
-                    git_repository=config["git_repository"],
-                    http_config=config.get("http_config", None),
-                    file_config=config.get("file_config", None),
-                    git_commit=git_commit,
-                )
-            )
+            projects.append(project)
+
+    if inline_project_pipelines:
+        pipeline_steps += create_downstream_project_steps(projects)
+    else:
+        pipeline_steps += [create_downstream_setup_step(project) for project in projects]
 
     if use_bazelisk_migrate():
         current_build_number = os.environ.get("BUILDKITE_BUILD_NUMBER", None)
@@ -4129,7 +6171,7 @@ def print_bazel_downstream_pipeline(
             create_step(
                 label="Try Update Last Green Downstream Commit",
                 commands=[
-                    fetch_ci_scripts_command(),
+                    fetch_ci_scripts_command(DEFAULT_PLATFORM),
                     PLATFORMS[DEFAULT_PLATFORM]["python"]
                     + " bazelci.py try_update_last_green_downstream_commit",
                 ],
@@ -4140,6 +6182,80 @@ def print_bazel_downstream_pipeline(
     print_pipeline_steps(pipeline_steps)
 
 
+def create_downstream_setup_step(project_name):
+    """Returns a step that generates and uploads the pipeline of the given downstream project."""
+    config = DOWNSTREAM_PROJECTS[project_name]
+    return upload_project_pipeline_step(
+        project_name=project_name,
+        git_repository=config["git_repository"],
+        http_config=config.get("http_config", None),
+        file_config=config.get("file_config", None),
+        git_commit=get_downstream_git_commit(project_name),
+    )
+
+
+def get_downstream_git_commit(project_name):
+    config = DOWNSTREAM_PROJECTS[project_name]
+    return "origin/" + config["git_branch"] if "git_branch" in config else None
+
+
+def create_downstream_project_steps(projects):
+    """Generates the pipelines of the given downstream projects in this process.
+
+    Instead of uploading one "Setup" job per project (each of which has to wait for an agent,
+    clone the project and run `project_pipeline`), this fetches the configs of all projects
+    concurrently and returns their steps directly. The steps of every project are wrapped in a
+    group, so that a wait step in one project doesn't block the others. Projects whose config
+    cannot be loaded fall back to a "Setup" job.
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_DOWNSTREAM_CONFIG_WORKERS
+    ) as executor:
+        futures = [executor.submit(load_downstream_project_config, p) for p in projects]
+
+    pipeline_steps = []
+    for project, future in zip(projects, futures):
+        config = DOWNSTREAM_PROJECTS[project]
+        try:
+            configs, git_commit = future.result()
+            if project_pipeline_needs_git_checkout(configs, include_initial_steps=False):
+                raise BuildkiteException("the pipeline needs a checkout of the repository")
+            project_steps = create_project_pipeline_steps(
+                configs=configs,
+                project_name=project,
+                http_config=config.get("http_config", None),
+                file_config=config.get("file_config", None),
+                git_repository=config["git_repository"],
+                git_commit=git_commit,
+                use_but=True,
+                include_initial_steps=False,
+            )
+        except Exception as ex:
+            eprint("Failed to generate the pipeline of %s in-process: %s" % (project, ex))
+            pipeline_steps.append(create_downstream_setup_step(project))
+            continue
+
+        pipeline_steps.append({"group": project, "steps": project_steps})
+
+    return pipeline_steps
+
+
+def load_downstream_project_config(project_name):
+    """Returns the config of a downstream project at the commit that will be tested."""
+    config = DOWNSTREAM_PROJECTS[project_name]
+    git_commit = get_downstream_git_commit(project_name) or get_last_green_commit(project_name)
+    http_config = config.get("http_config", None)
+    if http_config:
+        return fetch_configs(http_config, None), git_commit
+
+    configs = load_config_from_git(
+        config["git_repository"], git_commit, config.get("file_config", None)
+    )
+    if configs is None:
+        raise BuildkiteException("Could not fetch the config of %s" % project_name)
+    return configs, git_commit
+
+
 def get_steps_for_aggregating_migration_results(current_build_number, notify):
     parts = [
         PLATFORMS[DEFAULT_PLATFORM]["python"],
@@ -4153,7 +6269,7 @@ def get_steps_for_aggregating_migration_results(current_build_number, notify):
         create_step(
             label="Aggregate incompatible flags test result",
             commands=[
-                fetch_ci_scripts_command(),
+                fetch_ci_scripts_command(DEFAULT_PLATFORM),
                 fetch_aggregate_incompatible_flags_test_result_command(),
                 " ".join(parts),
             ],
@@ -4438,13 +6554,30 @@ def print_shard_summary():
         shutil.rmtree(tmpdir)
 
 
-class NoAliasDumper(yaml.Dumper):
+# Use the libyaml bindings if PyYAML was built with them, since they are an order of magnitude
+# faster than the pure Python implementation.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class YamlDumper(getattr(yaml, "CDumper", yaml.Dumper)):
+    pass
+
+
+class NoAliasDumper(YamlDumper):
     def ignore_aliases(self, _data):
         return True
 
 
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def dump_yaml(data, Dumper=YamlDumper, **kwargs):
+    return yaml.dump(data, Dumper=Dumper, **kwargs)
+
+
 def print_configs(configs):
-    print(yaml.dump(configs, Dumper=NoAliasDumper))
+    print(dump_yaml(configs, Dumper=NoAliasDumper))
 
 
 def get_log_path_for_label(label, shard, total_shards, attempt, total_attempts, is_windows):
@@ -4764,6 +6897,227 @@ def get_test_results_from_bep(path):
                     )
 
 
+TestDurationStats = collections.namedtuple(
+    "TestDurationStats",
+    ["label", "pipeline", "task", "runs", "flakes", "failures", "mean_s", "p90_s", "updated_at"],
+)
+
+
+class TestDurationStore:
+    """
+    Persistent history of test durations and flakiness per (pipeline, task, label).
+
+    The data is stored in SQLite, with the label as first key column so that lookups by label are
+    fast even for millions of rows. Means decay exponentially with the age of a run. The p90 is
+    computed from the most recent durations. Stores that were filled independently (e.g. by the
+    shards of a build) can be merged without loss.
+    """
+
+    _COLUMNS = [
+        "label",
+        "pipeline",
+        "task",
+        "runs",
+        "flakes",
+        "failures",
+        "weighted_sum",
+        "weight",
+        "updated_at",
+        "mean_s",
+        "p90_s",
+        "samples",
+    ]
+
+    def __init__(
+        self,
+        path,
+        half_life_s=TEST_DURATION_HALF_LIFE_S,
+        max_samples=TEST_DURATION_MAX_SAMPLES,
+    ):
+        self._half_life_s = half_life_s
+        self._max_samples = max_samples
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS test_durations (
+                    label TEXT NOT NULL,
+                    pipeline TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    runs INTEGER NOT NULL,
+                    flakes INTEGER NOT NULL,
+                    failures INTEGER NOT NULL,
+                    weighted_sum REAL NOT NULL,
+                    weight REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    mean_s REAL,
+                    p90_s REAL,
+                    samples BLOB NOT NULL,
+                    PRIMARY KEY (label, pipeline, task)
+                ) WITHOUT ROWID
+                """
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def ingest_bep(self, bep_path, pipeline, task, timestamp=None):
+        """Adds all test results of a BEP file and returns the number of tests."""
+        results = []
+        for execution in parse_bep(bep_path):
+            # Shards run in parallel, while the attempts of a shard run one after another.
+            millis = max(sum(s.attempt_millis) for s in execution.shards)
+            results.append((execution.label, millis / 1000.0, execution.overall_status))
+        self.add_results(pipeline, task, results, timestamp)
+        return len(results)
+
+    def add_results(self, pipeline, task, results, timestamp=None):
+        """Adds (label, duration in seconds, status) tuples of a single build."""
+        ts = time.time() if timestamp is None else timestamp
+        rows = []
+        for label, duration_s, status in results:
+            # Targets that failed to build don't have a meaningful duration.
+            samples = [(ts, duration_s)] if duration_s > 0 else []
+            rows.append(
+                self._make_row(
+                    label,
+                    pipeline,
+                    task,
+                    runs=1,
+                    flakes=int(status == "FLAKY"),
+                    failures=int(status not in ("PASSED", "FLAKY")),
+                    weighted_sum=sum(d for _, d in samples),
+                    weight=float(len(samples)),
+                    updated_at=ts,
+                    samples=samples,
+                )
+            )
+
+        self._conn.execute("CREATE TEMP TABLE incoming AS SELECT * FROM test_durations LIMIT 0")
+        try:
+            self._conn.executemany(
+                f"INSERT INTO temp.incoming VALUES ({self._placeholders()})", rows
+            )
+            self._merge_table("temp.incoming")
+        finally:
+            self._conn.execute("DROP TABLE temp.incoming")
+
+    def merge(self, other_path):
+        """Adds all runs from another store, which must not share any runs with this one."""
+        self._conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+        try:
+            self._merge_table("other.test_durations")
+        finally:
+            self._conn.execute("DETACH DATABASE other")
+
+    def _merge_table(self, table):
+        theirs = ", ".join(f"o.{c}" for c in self._COLUMNS)
+        ours = ", ".join(f"m.{c}" for c in self._COLUMNS)
+        width = len(self._COLUMNS)
+        cursor = self._conn.execute(
+            f"SELECT {theirs}, {ours} FROM {table} AS o "
+            "JOIN main.test_durations AS m USING (label, pipeline, task)"
+        )
+        combined = [self._combine(row[width:], row[:width]) for row in cursor]
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO main.test_durations VALUES ({self._placeholders()})",
+                combined,
+            )
+            # Tests that weren't known yet are copied without a round trip through Python.
+            self._conn.execute(f"INSERT OR IGNORE INTO main.test_durations SELECT * FROM {table}")
+
+    def lookup(self, label):
+        """Returns the TestDurationStats of the given label in all pipelines and tasks."""
+        cursor = self._conn.execute(
+            "SELECT label, pipeline, task, runs, flakes, failures, mean_s, p90_s, updated_at "
+            "FROM test_durations WHERE label = ? ORDER BY pipeline, task",
+            (label,),
+        )
+        return [TestDurationStats(*row) for row in cursor]
+
+    def get_durations(self, pipeline=None, task=None, percentile=False):
+        """Returns the expected duration in seconds by label, optionally limited to a pipeline."""
+        column = "p90_s" if percentile else "mean_s"
+        conditions, params = ["mean_s IS NOT NULL"], []
+        if pipeline is not None:
+            conditions.append("pipeline = ?")
+            params.append(pipeline)
+        if task is not None:
+            conditions.append("task = ?")
+            params.append(task)
+        cursor = self._conn.execute(
+            f"SELECT label, MAX({column}) FROM test_durations "
+            f"WHERE {' AND '.join(conditions)} GROUP BY label",
+            params,
+        )
+        return dict(cursor)
+
+    def _make_row(
+        self, label, pipeline, task, runs, flakes, failures, weighted_sum, weight, updated_at, samples
+    ):
+        durations = sorted(d for _, d in samples)
+        return (
+            label,
+            pipeline,
+            task,
+            runs,
+            flakes,
+            failures,
+            weighted_sum,
+            weight,
+            updated_at,
+            weighted_sum / weight if weight else None,
+            durations[math.ceil(0.9 * len(durations)) - 1] if durations else None,
+            array.array("d", itertools.chain.from_iterable(samples)).tobytes(),
+        )
+
+    def _combine(self, a, b):
+        a, b = dict(zip(self._COLUMNS, a)), dict(zip(self._COLUMNS, b))
+        updated_at = max(a["updated_at"], b["updated_at"])
+        decay_a = 0.5 ** ((updated_at - a["updated_at"]) / self._half_life_s)
+        decay_b = 0.5 ** ((updated_at - b["updated_at"]) / self._half_life_s)
+        samples = sorted(self._unpack_samples(a["samples"]) + self._unpack_samples(b["samples"]))
+        return self._make_row(
+            a["label"],
+            a["pipeline"],
+            a["task"],
+            runs=a["runs"] + b["runs"],
+            flakes=a["flakes"] + b["flakes"],
+            failures=a["failures"] + b["failures"],
+            weighted_sum=a["weighted_sum"] * decay_a + b["weighted_sum"] * decay_b,
+            weight=a["weight"] * decay_a + b["weight"] * decay_b,
+            updated_at=updated_at,
+            samples=samples[-self._max_samples :],
+        )
+
+    @staticmethod
+    def _unpack_samples(packed):
+        values = array.array("d")
+        values.frombytes(packed)
+        return list(zip(values[::2], values[1::2]))
+
+    def _placeholders(self):
+        return ", ".join("?" for _ in self._COLUMNS)
+
+
+def update_test_durations(store_path, pipeline, task, bep_files=(), merge_paths=()):
+    with TestDurationStore(store_path) as store:
+        for path in merge_paths:
+            store.merge(path)
+        for path in bep_files:
+            count = store.ingest_bep(path, pipeline, task)
+            eprint(f"Added {count} tests from {path}")
+
+
 def get_root_cause(bep_event):
     for c in bep_event.get("children", ()):
         for v in c.values():
@@ -4983,7 +7337,7 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
-    yaml.add_representer(str, str_presenter)
+    yaml.add_representer(str, str_presenter, Dumper=YamlDumper)
 
     parser = argparse.ArgumentParser(description="Bazel Continuous Integration Script")
     parser.add_argument("--script", type=str)
@@ -5003,6 +7357,9 @@ def main(argv=None):
         "--test_disabled_projects", type=bool, nargs="?", const=True
     )
     bazel_downstream_pipeline.add_argument("--notify", type=bool, nargs="?", const=True)
+    bazel_downstream_pipeline.add_argument(
+        "--inline_project_pipelines", type=bool, nargs="?", const=True
+    )
 
     project_pipeline = subparsers.add_parser("project_pipeline")
     project_pipeline.add_argument("--project_name", type=str)
@@ -5047,6 +7404,30 @@ def main(argv=None):
     subparsers.add_parser("try_update_last_green_downstream_commit")
     subparsers.add_parser("print_shard_summary")
 
+    update_test_durations_parser = subparsers.add_parser("update_test_durations")
+    update_test_durations_parser.add_argument("--store", type=str, required=True)
+    update_test_durations_parser.add_argument(
+        "--pipeline", type=str, default=os.getenv("BUILDKITE_PIPELINE_SLUG", "")
+    )
+    update_test_durations_parser.add_argument("--task", type=str, default="")
+    update_test_durations_parser.add_argument(
+        "--bep_file", type=str, action="append", default=[], help="Can be specified repeatedly."
+    )
+    update_test_durations_parser.add_argument(
+        "--merge",
+        type=str,
+        action="append",
+        default=[],
+        help="Path of another store whose runs should be added. Can be specified repeatedly.",
+    )
+
+    simulate_sharding_parser = subparsers.add_parser("simulate_sharding")
+    simulate_sharding_parser.add_argument("--durations_file", type=str, required=True)
+    simulate_sharding_parser.add_argument("--shards", type=int, required=True)
+    simulate_sharding_parser.add_argument(
+        "--targets_file", type=str, help="One target per line. Defaults to all known targets."
+    )
+
     print_tasks = subparsers.add_parser("print_tasks")
     print_tasks.add_argument("--file_config", type=str)
 
@@ -5076,10 +7457,12 @@ def main(argv=None):
                 file_config=args.file_config,
                 test_disabled_projects=args.test_disabled_projects,
                 notify=args.notify,
+                inline_project_pipelines=args.inline_project_pipelines,
             )
         elif args.subparsers_name == "project_pipeline":
+            configs = None
             # Fetch the repo in case we need to use file_config.
-            if args.git_repository:
+            if args.git_repository and not args.http_config:
                 git_commit = (
                     args.git_commit
                     if args.git_commit
@@ -5089,9 +7472,15 @@ def main(argv=None):
                         else None
                     )
                 )
-                clone_git_repository(args.git_repository, git_commit, suppress_stdout=True)
-
-            configs = fetch_configs(args.http_config, args.file_config)
+                # Try to only fetch the config files before cloning the whole repository.
+                configs = load_config_from_git(args.git_repository, git_commit, args.file_config)
+                if configs is not None and project_pipeline_needs_git_checkout(configs):
+                    configs = None
+                if configs is None:
+                    clone_git_repository(args.git_repository, git_commit, suppress_stdout=True)
+
+            if configs is None:
+                configs = fetch_configs(args.http_config, args.file_config)
             print_project_pipeline(
                 configs=configs,
                 project_name=args.project_name,
@@ -5163,6 +7552,12 @@ def main(argv=None):
             try_update_last_green_downstream_commit()
         elif args.subparsers_name == "print_shard_summary":
             print_shard_summary()
+        elif args.subparsers_name == "update_test_durations":
+            update_test_durations(
+                args.store, args.pipeline, args.task, bep_files=args.bep_file, merge_paths=args.merge
+            )
+        elif args.subparsers_name == "simulate_sharding":
+            print_sharding_simulation(args.durations_file, args.shards, args.targets_file)
         elif args.subparsers_name == "print_tasks":
             print_configs(fetch_configs(None, args.file_config))
         else:
@@ -19,14 +19,90 @@ import os
 os.environ["BUILDKITE_ORGANIZATION_SLUG"] = "bazel"
 os.environ["BUILDKITE_PIPELINE_SLUG"] = "test"
 
+import asyncio
 import bazelci
+import contextlib
+import gzip
+import http.server
+import io
+import json
 import shlex
+import shutil
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 import yaml
 
 
+class FakeBuildkiteServer(http.server.ThreadingHTTPServer):
+    """A local stand-in for the Buildkite REST API.
+
+    `handler` is called with (path, request_headers) and returns a tuple of
+    (status, response_headers, body).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.connections = 0
+        self.requests = []
+        self.bodies = []
+        super().__init__(("127.0.0.1", 0), _FakeBuildkiteRequestHandler)
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.01,), daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeBuildkiteRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _respond(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        length = int(self.headers.get("Content-Length") or 0)
+        self.server.bodies.append(self.rfile.read(length) if length else b"")
+        status, headers, body = self.server.handler(self.path, self.headers)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+def create_test_client(pipeline="test", **kwargs):
+    with mock.patch.object(bazelci.BuildkiteClient, "_get_buildkite_token", return_value="token"):
+        client = bazelci.BuildkiteClient("bazel", pipeline, **kwargs)
+    # Don't share rate limit state between tests.
+    client._rate_limiter = bazelci.BuildkiteRateLimiter()
+    return client
+
+
 class CalculateFlags(unittest.TestCase):
     _CONFIGS = yaml.safe_load(
         """
@@ -221,6 +297,536 @@ tasks:
             "-//bad/three",
         ])
 
+def make_fake_buildkite_agent(tmp):
+    """Creates a buildkite-agent that stores artifacts of the fake build in a local directory."""
+    artifacts = os.path.join(tmp, "artifacts")
+    bin_dir = os.path.join(tmp, "bin")
+    os.makedirs(artifacts)
+    os.makedirs(bin_dir)
+    agent = os.path.join(bin_dir, "buildkite-agent")
+    with open(agent, "w") as f:
+        f.write(
+            "#!/bin/sh\n"
+            'case "$2" in\n'
+            f'  upload) cp "$3" {artifacts}/ ;;\n'
+            f'  download) cp {artifacts}/"$3" "$4" ;;\n'
+            "esac\n"
+        )
+    os.chmod(agent, 0o755)
+    return bin_dir, artifacts
+
+
+class DurationAwareSharding(unittest.TestCase):
+    DURATIONS = {"//:a": 10.0, "//:b": 9.0, "//:c": 8.0, "//:d": 2.0, "//:e": 1.0, "//:f": 1.0}
+
+    def test_round_robin_without_history(self):
+        targets = ["//:a", "//:b", "//:c", "//:d"]
+        self.assertEqual(bazelci.get_targets_for_shard(targets, 1, 2), ["//:b", "//:d"])
+        self.assertEqual(bazelci.get_targets_for_shard(targets, 1, 2, {}), ["//:b", "//:d"])
+
+    def test_longest_targets_first(self):
+        targets = sorted(self.DURATIONS) + ["//:new1", "//:new2"]
+        shards = bazelci.assign_targets_to_shards(targets, 3, self.DURATIONS)
+        self.assertEqual(
+            shards,
+            [["//:a", "//:f", "//:new1"], ["//:b", "//:e", "//:new2"], ["//:c", "//:d"]],
+        )
+        for s in range(3):
+            self.assertEqual(
+                bazelci.get_targets_for_shard(targets, s, 3, self.DURATIONS), shards[s]
+            )
+
+    def test_load_json_and_csv(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, "durations.json")
+            with open(json_path, "w") as f:
+                json.dump([{"label": "//:a", "duration_s": 1.5, "status": "PASSED"}], f)
+            csv_path = os.path.join(tmp, "durations.csv")
+            with open(csv_path, "w") as f:
+                f.write("label,duration_s\n//:b,2\n")
+
+            self.assertEqual(bazelci.load_test_durations(json_path), {"//:a": 1.5})
+            self.assertEqual(bazelci.load_test_durations(csv_path), {"//:b": 2.0})
+
+            with mock.patch.dict(
+                os.environ, {"BAZELCI_TEST_DURATIONS_FILE": os.path.join(tmp, "missing.json")}
+            ):
+                self.assertIsNone(bazelci.get_test_durations_for_sharding())
+
+    def test_assignment_uses_pinned_durations(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            durations_file = os.path.join(tmp, "durations.json")
+            with open(durations_file, "w") as f:
+                json.dump(self.DURATIONS, f)
+            with open(durations_file, "rb") as f:
+                digest = bazelci.hashlib.sha256(f.read()).hexdigest()
+            targets = sorted(self.DURATIONS)
+            round_robin = [targets[0::2], targets[1::2]]
+            balanced = bazelci.assign_targets_to_shards(targets, 2, self.DURATIONS)
+
+            def get_shards(**env):
+                with mock.patch.dict(
+                    os.environ,
+                    dict({"BAZELCI_TEST_DURATIONS_FILE": durations_file}, **env),
+                ):
+                    return bazelci.get_shard_assignment(targets, 2)
+
+            # Without a digest, shards cannot know whether they read the same durations.
+            self.assertEqual(get_shards(BAZELCI_TEST_DURATIONS_SHA256=""), round_robin)
+            self.assertEqual(get_shards(BAZELCI_TEST_DURATIONS_SHA256=digest), balanced)
+            self.assertEqual(get_shards(BAZELCI_TEST_DURATIONS_SHA256=digest.upper()), balanced)
+
+            with self.assertRaises(bazelci.BuildkiteException):
+                get_shards(BAZELCI_TEST_DURATIONS_SHA256="0" * 64)
+            with self.assertRaises(bazelci.BuildkiteException):
+                get_shards(
+                    BAZELCI_TEST_DURATIONS_SHA256=digest,
+                    BAZELCI_TEST_DURATIONS_FILE=os.path.join(tmp, "missing.json"),
+                )
+
+            with mock.patch.object(
+                bazelci, "fetch_remote_file", return_value=json.dumps(self.DURATIONS).encode()
+            ) as fetch, mock.patch.dict(
+                os.environ,
+                {
+                    "BAZELCI_TEST_DURATIONS_FILE": "https://example.com/durations.json",
+                    "BAZELCI_TEST_DURATIONS_SHA256": bazelci.hashlib.sha256(
+                        json.dumps(self.DURATIONS).encode()
+                    ).hexdigest(),
+                },
+            ):
+                self.assertEqual(bazelci.get_shard_assignment(targets, 2), balanced)
+            fetch.assert_called_once_with("https://example.com/durations.json")
+
+    def test_round_robin_without_durations_file(self):
+        with mock.patch.dict(os.environ, {"BAZELCI_TEST_DURATIONS_FILE": ""}):
+            self.assertEqual(
+                bazelci.get_shard_assignment(["//:a", "//:b", "//:c"], 2),
+                [["//:a", "//:c"], ["//:b"]],
+            )
+
+    def test_simulation(self):
+        result = bazelci.simulate_sharding(sorted(self.DURATIONS), 2, self.DURATIONS)
+        self.assertEqual(result["round_robin"], [19.0, 12.0])
+        self.assertEqual(result["duration_aware"], [14.0, 17.0])
+        self.assertEqual(result["lower_bound"], 15.5)
+
+
+class ShardQueueTest(unittest.TestCase):
+    TARGETS = [f"//:t{i:02}" for i in range(50)]
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.store = bazelci.FileStore(self._tmp.name)
+
+    def test_all_batches_are_claimed_once(self):
+        with mock.patch.object(bazelci, "SHARD_QUEUE_CHUNK_SIZE", 100):
+            bazelci.ShardQueue(self.store, 0, 3).publish(self.TARGETS)
+            queues = [bazelci.ShardQueue(self.store, s, 3) for s in range(3)]
+            for q in queues:
+                self.assertEqual(q.load(timeout_s=0), self.TARGETS)
+
+        claimed = [[] for _ in queues]
+        barrier = threading.Barrier(len(queues))
+
+        def work(shard):
+            barrier.wait()
+            for batch in queues[shard].claim_batches():
+                self.assertLessEqual(len(batch), 3)
+                claimed[shard].extend(batch)
+
+        threads = [threading.Thread(target=work, args=(s,)) for s in range(len(queues))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(sum(claimed, [])), self.TARGETS)
+
+        # A retried job tests the batches it claimed before.
+        retried = bazelci.ShardQueue(self.store, 1, 3, retry=True)
+        retried.load(timeout_s=0)
+        self.assertEqual(sum(retried.claim_batches(), []), claimed[1])
+
+    def test_late_shards_find_their_batches_stolen(self):
+        queues = [bazelci.ShardQueue(self.store, s, 2) for s in range(2)]
+        queues[1].publish(self.TARGETS)
+        queues[0].load(timeout_s=0)
+
+        # Shard 2 steals all batches of shard 1, which hasn't started yet.
+        self.assertEqual(sorted(sum(queues[1].claim_batches(), [])), self.TARGETS)
+        self.assertEqual(list(queues[0].claim_batches()), [])
+
+    def test_steal_stops_at_owner(self):
+        queues = [bazelci.ShardQueue(self.store, s, 2) for s in range(2)]
+        queues[0].publish(self.TARGETS)
+        queues[1].load(timeout_s=0)
+
+        owner = queues[0].claim_batches()
+        first = next(owner)
+        self.assertEqual(first, self.TARGETS[:4])
+        # Shard 2 tests its own batches and steals all of shard 1's batches from the back, until
+        # it reaches the one that shard 1 is testing.
+        self.assertEqual(sorted(sum(queues[1].claim_batches(), [])), self.TARGETS[4:])
+        self.assertEqual(list(owner), [])
+
+    def test_owner_waits_for_thief(self):
+        queue = bazelci.ShardQueue(self.store, 0, 1)
+        queue.publish(self.TARGETS[:4])
+        # The thief announced the first batch before it saw the owner's announcement.
+        self.store.set("thief-0", "1")
+
+        def steal(seconds):
+            self.store.set("thief-0", "2")
+
+        with mock.patch.object(bazelci.time, "sleep", side_effect=steal) as sleep:
+            self.assertEqual(sum(queue.claim_batches(), []), self.TARGETS[1:4])
+        sleep.assert_called_once()
+
+    def test_longest_targets_first(self):
+        queue = bazelci.ShardQueue(self.store, 0, 1)
+        queue.publish(["//:a", "//:b", "//:c"], durations={"//:c": 5.0, "//:b": 1.0})
+        self.assertEqual(
+            bazelci.ShardQueue(self.store, 0, 1).load(timeout_s=0), ["//:c", "//:b", "//:a"]
+        )
+
+    def test_load_times_out(self):
+        self.assertIsNone(bazelci.ShardQueue(self.store, 1, 2).load(timeout_s=0))
+
+    def test_calculate_targets(self):
+        env = {
+            "BAZELCI_SHARD_QUEUE": "1",
+            "BAZELCI_SHARD_QUEUE_DIR": self._tmp.name,
+            "BUILDKITE_STEP_ID": "step",
+            "BUILDKITE_PARALLEL_JOB_COUNT": "2",
+        }
+
+        def calculate_targets(shard):
+            with mock.patch.dict(os.environ, dict(env, BUILDKITE_PARALLEL_JOB=str(shard))):
+                return bazelci.calculate_targets(
+                    {"test_targets": ["//..."]},
+                    "bazel",
+                    build_only=False,
+                    test_only=False,
+                    workspace_dir="/tmp",
+                    ws_setup_func=None,
+                    git_commit="abcd",
+                    test_flags=[],
+                    shard_queue=bazelci.get_shard_queue(),
+                )[1]
+
+        with mock.patch.object(
+            bazelci, "expand_test_target_patterns", return_value=["//:b", "//:a"]
+        ) as expand:
+            # The first job to start publishes the targets, even if it isn't shard 1.
+            self.assertEqual(calculate_targets(1), ["//:b", "//:a"])
+            self.assertEqual(calculate_targets(0), ["//:a", "//:b"])
+        expand.assert_called_once()
+
+        # If the publisher never publishes, the other jobs eventually publish the targets.
+        for name in os.listdir(os.path.join(self._tmp.name, "step")):
+            if name != "publisher":
+                os.remove(os.path.join(self._tmp.name, "step", name))
+        with mock.patch.object(
+            bazelci, "expand_test_target_patterns", return_value=["//:c"]
+        ), mock.patch.object(bazelci, "SHARD_QUEUE_TIMEOUT_S", 0):
+            self.assertEqual(calculate_targets(0), ["//:c"])
+
+    def test_queued_tests_run_until_drained(self):
+        queue = bazelci.ShardQueue(self.store, 0, 2)
+        queue.publish(self.TARGETS)
+        bep_file = os.path.join(self._tmp.name, "test_bep.json")
+        tested = []
+
+        def fake_test(version, binary, platform, flags, targets, batch_bep_file, monitor):
+            tested.extend(targets)
+            with open(batch_bep_file, "w") as f:
+                for t in targets:
+                    event = {
+                        "id": {"testResult": {"label": t, "shard": 1, "attempt": 1}},
+                        "testResult": {"status": "PASSED", "testAttemptDurationMillis": "10"},
+                    }
+                    f.write(json.dumps(event) + "\n")
+                f.write(json.dumps({"id": {"buildFinished": {}}, "finished": {}}) + "\n")
+            if "//:t00" in targets:
+                raise bazelci.BuildkiteException("bazel test failed with exit code 3")
+
+        with mock.patch.object(
+            bazelci, "execute_bazel_test", side_effect=fake_test
+        ), mock.patch.dict(os.environ, {"BAZELCI_LOCAL_RUN": "1"}):
+            with self.assertRaises(bazelci.BuildkiteException):
+                bazelci.execute_queued_bazel_tests(
+                    queue, "latest", "bazel", "ubuntu2004", [], bep_file, self._tmp.name, False
+                )
+
+        self.assertEqual(sorted(tested), self.TARGETS)
+        # The shard summary parses the concatenated BEP streams of all batches.
+        executions = bazelci.parse_bep(bep_file)
+        self.assertEqual(sorted(e.label for e in executions), self.TARGETS)
+        self.assertTrue(all(len(e.shards) == 1 for e in executions))
+        self.assertTrue(all(len(e.shards[0].attempts) == 1 for e in executions))
+
+
+class SharedTargetExpansion(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        bin_dir, self.artifacts = make_fake_buildkite_agent(self._tmp.name)
+        for patcher in (
+            mock.patch.dict(
+                os.environ,
+                {
+                    "PATH": bin_dir + os.pathsep + os.environ["PATH"],
+                    "BAZELCI_SHARE_TARGET_EXPANSION": "1",
+                },
+            ),
+            mock.patch.object(bazelci, "TARGET_EXPANSION_TIMEOUT_S", 0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def expand(self, shard_id, commit="abcd", test_flags=()):
+        return bazelci.get_shared_test_target_expansion(
+            "bazel", ["//..."], list(test_flags), commit, shard_id
+        )
+
+    def test_only_first_shard_runs_query(self):
+        with mock.patch.object(
+            bazelci, "expand_test_target_patterns", return_value=["//:b", "//:a"]
+        ) as expand:
+            self.assertEqual(self.expand(0), ["//:a", "//:b"])
+            self.assertEqual(self.expand(1), ["//:a", "//:b"])
+            self.assertEqual(self.expand(2), ["//:a", "//:b"])
+        expand.assert_called_once()
+        self.assertEqual(len(os.listdir(self.artifacts)), 1)
+
+    def test_fallback_to_local_query(self):
+        with mock.patch.object(
+            bazelci, "expand_test_target_patterns", return_value=["//:a"]
+        ) as expand:
+            self.expand(0, commit="abcd")
+            self.assertEqual(self.expand(1, commit="other"), ["//:a"])
+            self.assertEqual(self.expand(1, test_flags=["--test_tag_filters=-slow"]), ["//:a"])
+        self.assertEqual(expand.call_count, 3)
+        # Only the first shard uploads results.
+        self.assertEqual(len(os.listdir(self.artifacts)), 1)
+
+
+    def test_key_ignores_startup_flags(self):
+        key = bazelci.get_test_query_key("abcd", ["//..."], [])
+        with mock.patch.object(
+            bazelci, "common_startup_flags", return_value=["--output_user_root=D:/b"]
+        ):
+            self.assertEqual(bazelci.get_test_query_key("abcd", ["//..."], []), key)
+        self.assertNotEqual(bazelci.get_test_query_key("abcd", ["//:x"], []), key)
+
+    def test_failed_upload_does_not_fail_shard(self):
+        os.rmdir(self.artifacts)
+        with mock.patch.object(bazelci, "expand_test_target_patterns", return_value=["//:a"]):
+            self.assertEqual(self.expand(0), ["//:a"])
+            self.assertEqual(self.expand(1), ["//:a"])
+
+
+class QueryCache(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.repo = os.path.join(self._tmp.name, "repo")
+        self.calls = os.path.join(self._tmp.name, "calls")
+        os.makedirs(os.path.join(self.repo, "pkg"))
+        # Prints the version or a fixed query result, and records every query.
+        self.bazel = os.path.join(self._tmp.name, "bazel")
+        with open(self.bazel, "w") as f:
+            f.write(
+                "#!/bin/sh\n"
+                'if [ "$1" = --version ]; then echo "bazel 7.0.0"; exit; fi\n'
+                f"echo query >> {self.calls}\n"
+                "echo //pkg:a_test\n"
+            )
+        os.chmod(self.bazel, 0o755)
+
+        self.git("init", "-q")
+        self.write("pkg/BUILD", "sh_test(name = 'a_test')")
+        self.write("README", "")
+        self.commit()
+
+        cwd = os.getcwd()
+        os.chdir(self.repo)
+        self.addCleanup(os.chdir, cwd)
+        bazelci.get_query_disk_cache.cache_clear()
+        self.addCleanup(bazelci.get_query_disk_cache.cache_clear)
+        patcher = mock.patch.object(
+            bazelci, "BAZELCI_QUERY_CACHE_DIR", os.path.join(self._tmp.name, "cache")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def git(self, *args):
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+            cwd=self.repo,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    def write(self, path, content):
+        with open(os.path.join(self.repo, path), "w") as f:
+            f.write(content)
+
+    def commit(self):
+        self.git("add", "-A")
+        self.git("commit", "-q", "-m", "change")
+
+    def expand(self, test_flags=()):
+        return bazelci.expand_test_target_patterns(self.bazel, ["//..."], list(test_flags))
+
+    def query_count(self):
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def test_unchanged_inputs_skip_query(self):
+        self.assertEqual(self.expand(), ["//pkg:a_test"])
+        self.assertEqual(self.expand(), ["//pkg:a_test"])
+        self.assertEqual(self.query_count(), 1)
+
+        # Different flags need a new query.
+        self.expand(test_flags=["--test_tag_filters=-slow"])
+        self.assertEqual(self.query_count(), 2)
+
+        # Checking out the same tree again reuses the result.
+        self.write("README", "docs")
+        self.commit()
+        self.git("revert", "--no-edit", "HEAD")
+        self.expand()
+        self.assertEqual(self.query_count(), 2)
+
+    def test_new_source_files(self):
+        # e.g. [py_test(...) for f in glob(["*_test.py"])]
+        self.expand()
+        self.write("pkg/new_test.py", "")
+        self.expand()
+        self.assertEqual(self.query_count(), 2)
+
+        self.commit()
+        self.expand()
+        self.expand()
+        self.assertEqual(self.query_count(), 3)
+
+        # Deleting the file restores the first tree, so its result is used again.
+        self.git("rm", "-q", "pkg/new_test.py")
+        self.git("commit", "-q", "-m", "delete")
+        self.expand()
+        self.assertEqual(self.query_count(), 3)
+        self.write("pkg/other_test.py", "")
+        self.commit()
+        self.expand()
+        self.assertEqual(self.query_count(), 4)
+
+    def test_changed_build_files(self):
+        self.expand()
+        self.write("pkg/defs.bzl", "")
+        self.commit()
+        self.expand()
+        self.assertEqual(self.query_count(), 2)
+
+        # Results for uncommitted changes are never cached.
+        self.write("pkg/BUILD", "")
+        self.expand()
+        self.expand()
+        self.assertEqual(self.query_count(), 4)
+
+    def test_disabled_without_directory(self):
+        with mock.patch.object(bazelci, "BAZELCI_QUERY_CACHE_DIR", None):
+            self.expand()
+            self.expand()
+        self.assertEqual(self.query_count(), 2)
+
+
+class TestDurationHistory(unittest.TestCase):
+    DAY = 24 * 60 * 60
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self._tmp.name, name)
+
+    def write_bep(self, name, attempts):
+        path = self.path(name)
+        with open(path, "w") as f:
+            for label, shard, attempt, status, millis in attempts:
+                event = {
+                    "id": {"testResult": {"label": label, "shard": shard, "attempt": attempt}},
+                    "testResult": {"status": status, "testAttemptDurationMillis": str(millis)},
+                }
+                f.write(json.dumps(event) + "\n")
+        return path
+
+    def test_ingest_bep(self):
+        bep = self.write_bep(
+            "test_bep.json",
+            [
+                ("//:sharded", 1, 1, "PASSED", 4000),
+                ("//:sharded", 2, 1, "PASSED", 6000),
+                ("//:flaky", 1, 1, "FAILED", 1000),
+                ("//:flaky", 1, 2, "PASSED", 2000),
+            ],
+        )
+        with bazelci.TestDurationStore(self.path("history.db")) as store:
+            self.assertEqual(store.ingest_bep(bep, "pipeline", "linux", timestamp=0), 2)
+            self.assertEqual(
+                store.lookup("//:sharded"),
+                [bazelci.TestDurationStats("//:sharded", "pipeline", "linux", 1, 0, 0, 6.0, 6.0, 0)],
+            )
+            [flaky] = store.lookup("//:flaky")
+            self.assertEqual((flaky.runs, flaky.flakes, flaky.failures), (1, 1, 0))
+            self.assertEqual(flaky.mean_s, 3.0)
+            self.assertEqual(store.lookup("//:unknown"), [])
+
+    def test_decayed_mean_and_p90(self):
+        with bazelci.TestDurationStore(self.path("history.db"), half_life_s=self.DAY) as store:
+            store.add_results("p", "t", [("//:a", 10.0, "PASSED")], timestamp=0)
+            store.add_results("p", "t", [("//:a", 40.0, "FAILED")], timestamp=self.DAY)
+            [stats] = store.lookup("//:a")
+            # The first run only has half of the weight of the second one.
+            self.assertAlmostEqual(stats.mean_s, (10.0 * 0.5 + 40.0) / 1.5)
+            self.assertEqual(stats.p90_s, 40.0)
+            self.assertEqual((stats.runs, stats.failures), (2, 1))
+            self.assertEqual(store.get_durations(pipeline="p"), {"//:a": stats.mean_s})
+            self.assertEqual(store.get_durations(pipeline="other"), {})
+
+    def test_merge_equals_sequential_ingestion(self):
+        results = [[("//:a", 5.0, "PASSED"), ("//:b", 1.0, "FLAKY")], [("//:a", 7.0, "PASSED")]]
+        with bazelci.TestDurationStore(self.path("all.db")) as store:
+            for ts, r in enumerate(results):
+                store.add_results("p", "t", r, timestamp=ts * self.DAY)
+            expected = store.lookup("//:a") + store.lookup("//:b")
+
+        for ts, r in enumerate(results):
+            with bazelci.TestDurationStore(self.path(f"shard{ts}.db")) as store:
+                store.add_results("p", "t", r, timestamp=ts * self.DAY)
+
+        bazelci.update_test_durations(
+            self.path("merged.db"),
+            "p",
+            "t",
+            merge_paths=[self.path("shard1.db"), self.path("shard0.db")],
+        )
+        with bazelci.TestDurationStore(self.path("merged.db")) as store:
+            actual = store.lookup("//:a") + store.lookup("//:b")
+        self.assertEqual(len(actual), 2)
+        for a, e in zip(actual, expected):
+            self.assertEqual(a._replace(mean_s=0), e._replace(mean_s=0))
+            self.assertAlmostEqual(a.mean_s, e.mean_s)
+
+        # Stores can be used for duration-aware sharding.
+        with mock.patch.dict(os.environ, {"BUILDKITE_PIPELINE_SLUG": "p"}):
+            durations = bazelci.load_test_durations(self.path("merged.db"))
+        self.assertEqual(sorted(durations), ["//:a", "//:b"])
+
+
 class MatrixExpansion(unittest.TestCase):
     _CONFIGS = yaml.safe_load(
         """
@@ -316,6 +922,58 @@ tasks:
             ],
         )
 
+    def test_template_copies_only_expanded_values(self):
+        task = yaml.safe_load(
+            """
+name: "{platform} {flags}"
+platform: ${{ platform }}
+build_flags: ${{ flags }}
+test_flags:
+  - --config=${{ platform }}-${{ platform }}
+  - --keep_going
+environment:
+  A: ${{ platform }}
+  B: b
+build_targets:
+  - //...
+            """
+        )
+        flags = ["--one", "--two"]
+        template = bazelci.MatrixTaskTemplate(task)
+
+        expanded_tasks = [
+            template.expand(
+                [
+                    ("flags", bazelci.AttributeValue(value=flags, alias="set-one")),
+                    ("platform", bazelci.AttributeValue(value=p, alias=p)),
+                ]
+            )
+            for p in ("pf1", "pf2")
+        ]
+
+        self.assertEqual(
+            expanded_tasks[1],
+            dict(
+                name="pf2 set-one",
+                platform="pf2",
+                build_flags=["--one", "--two"],
+                test_flags=["--config=pf2-pf2", "--keep_going"],
+                environment=dict(A="pf2", B="b"),
+                build_targets=["//..."],
+            ),
+        )
+        # The original task is left untouched.
+        self.assertEqual(task["test_flags"][0], "--config=${{ platform }}-${{ platform }}")
+        self.assertEqual(task["environment"]["A"], "${{ platform }}")
+        # Values without placeholders are shared instead of copied, whole-value placeholders
+        # are replaced by the matrix value itself.
+        for expanded_task in expanded_tasks:
+            self.assertIs(expanded_task["build_targets"], task["build_targets"])
+            self.assertIs(expanded_task["build_flags"], flags)
+            self.assertIsNot(expanded_task["test_flags"], task["test_flags"])
+            self.assertIsNot(expanded_task["environment"], task["environment"])
+        self.assertIsNot(expanded_tasks[0]["test_flags"], expanded_tasks[1]["test_flags"])
+
 
 class MatrixExclude(unittest.TestCase):
     _CONFIGS_SINGLE_EXCLUDE = yaml.safe_load(
@@ -451,6 +1109,355 @@ tasks:
             ["--three", "--four"],
         ])
 
+    def test_exclude_rules_and_sort_order(self):
+        matrix = {"b": ["y", "x", "x"], "a": {"two": 2, "one": 1}}
+        excludes = [
+            {"a": "two", "b": "y"},
+            # Attributes that are not part of the combination only match None.
+            {"b": "x", "unused": "z"},
+            {"b": "x", "unused": None, "a": "one"},
+        ]
+
+        combinations = bazelci.get_combinations(matrix, ["b", "a"], excludes)
+
+        a = lambda v, alias: ("a", bazelci.AttributeValue(value=v, alias=alias))
+        b = lambda v: ("b", bazelci.AttributeValue(value=v, alias=v))
+        self.assertEqual(
+            combinations,
+            [(a(1, "one"), b("y")), (a(2, "two"), b("x")), (a(2, "two"), b("x"))],
+        )
+
+    def test_max_tasks(self):
+        config = yaml.safe_load(
+            """
+matrix:
+  a: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  b: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  c: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  d: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  e: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  f: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  g: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+  h: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+tasks:
+  basic:
+    name: "Basic"
+  huge:
+    shell_commands:
+      - echo ${{ a }} ${{ b }} ${{ c }} ${{ d }} ${{ e }} ${{ f }} ${{ g }} ${{ h }}
+            """
+        )
+
+        with self.assertRaisesRegex(bazelci.BuildkiteException, "limited to 128"):
+            bazelci.expand_task_config(config, max_tasks=128)
+
+        config = yaml.safe_load(
+            """
+matrix:
+  a: [1, 2, 3]
+tasks:
+  basic:
+    name: "Basic"
+  small:
+    shell_commands:
+      - echo ${{ a }}
+            """
+        )
+        bazelci.expand_task_config(config, max_tasks=4)
+        self.assertEqual(
+            list(config["tasks"]), ["basic", "small_config_01", "small_config_02", "small_config_03"]
+        )
+
+
+class ConfigCache(unittest.TestCase):
+    _CONFIG = """
+matrix:
+  bazel: ["7.x", "8.x"]
+tasks:
+  ubuntu:
+    bazel: ${{ bazel }}
+    build_targets:
+      - //...
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.multiple(
+            bazelci,
+            BAZELCI_CONFIG_CACHE_DIR=os.path.join(self.tmpdir, "cache"),
+            _CONFIG_MEMORY_CACHE={},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config_path = os.path.join(self.tmpdir, "presubmit.yml")
+        self._write_config(self._CONFIG)
+
+    def _write_config(self, content):
+        with open(self.config_path, "w") as f:
+            f.write(content)
+
+    def test_skips_parsing_of_known_configs(self):
+        expected = bazelci.load_config(None, self.config_path)
+        self.assertEqual(
+            expected["tasks"],
+            {
+                "ubuntu_config_01": {"bazel": "7.x", "build_targets": ["//..."]},
+                "ubuntu_config_02": {"bazel": "8.x", "build_targets": ["//..."]},
+            },
+        )
+        # Callers may modify the returned config.
+        expected["tasks"]["ubuntu_config_01"]["build_targets"].append("modified")
+        expected["tasks"]["ubuntu_config_01"]["build_targets"].pop()
+
+        with mock.patch.object(bazelci, "load_yaml") as load_yaml:
+            self.assertEqual(bazelci.load_config(None, self.config_path), expected)
+            # The in-memory cache is empty in a new process, but the one on disk is not.
+            bazelci._CONFIG_MEMORY_CACHE.clear()
+            self.assertEqual(bazelci.load_config(None, self.config_path), expected)
+        load_yaml.assert_not_called()
+
+    def test_tasks_do_not_share_values(self):
+        self._write_config(
+            self._CONFIG.replace("      - //...", "      - //...\n    build_flags: [--foo]")
+        )
+        for _ in range(2):
+            config = bazelci.load_config(None, self.config_path)
+            tasks = config["tasks"]
+            tasks["ubuntu_config_01"]["build_flags"].append("--bar")
+            tasks["ubuntu_config_01"]["build_targets"].append("//bar")
+            self.assertEqual(tasks["ubuntu_config_02"]["build_flags"], ["--foo"])
+            self.assertEqual(tasks["ubuntu_config_02"]["build_targets"], ["//..."])
+
+    def test_disk_cache_stores_json(self):
+        config = bazelci.load_config(None, self.config_path)
+        [name] = os.listdir(os.path.join(self.tmpdir, "cache"))
+        with gzip.open(os.path.join(self.tmpdir, "cache", name), "rb") as f:
+            self.assertEqual(json.loads(f.read()), config)
+
+        # Values that don't survive a round trip through JSON are only cached in memory.
+        self._write_config("tasks:\n  ubuntu:\n    date: 2024-01-01\n")
+        bazelci.load_config(None, self.config_path)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir, "cache"))), 1)
+
+    def test_disk_cache_is_opt_in(self):
+        self.assertIsNone(bazelci.get_config_disk_cache(None))
+
+    def test_cache_key(self):
+        bazelci.load_config(None, self.config_path)
+
+        with_override = bazelci.load_config(None, self.config_path, bazel_version="9.0.0")
+        self.assertEqual(
+            with_override["tasks"],
+            {
+                "ubuntu_config_01": {
+                    "bazel": "9.0.0",
+                    "old_bazel": "7.x, 8.x",
+                    "build_targets": ["//..."],
+                }
+            },
+        )
+
+        self._write_config(self._CONFIG.replace("//...", "//foo/..."))
+        config = bazelci.load_config(None, self.config_path)
+        self.assertEqual(config["tasks"]["ubuntu_config_01"]["build_targets"], ["//foo/..."])
+
+    def test_imports_are_fetched_in_parallel(self):
+        imports = ["c.yml", "a.yml", "b.yml"]
+        # Every import request blocks until all of them have arrived.
+        barrier = threading.Barrier(len(imports), timeout=5)
+
+        def handler(path, headers):
+            if path == "/presubmit.yml":
+                return 200, {}, yaml.dump({"imports": imports, "tasks": {"main": {}}})
+            barrier.wait()
+            name = path[1:].partition(".")[0]
+            return 200, {}, yaml.dump({"tasks": {"t1": {"platform": name}, "t2": {}}})
+
+        with FakeBuildkiteServer(handler) as server:
+            config = bazelci.load_config(server.url + "/presubmit.yml", None)
+
+        self.assertEqual(
+            list(config["tasks"]), ["main", "c_t1", "c_t2", "a_t1", "a_t2", "b_t1", "b_t2"]
+        )
+        self.assertEqual(
+            config["tasks"]["a_t1"], {"platform": "a", "name": "a", "working_directory": "a"}
+        )
+
+
+class YamlBackend(unittest.TestCase):
+    def test_output_matches_pure_python_dumper(self):
+        class Dumper(bazelci.NoAliasDumper):
+            pass
+
+        class PureDumper(yaml.Dumper):
+            def ignore_aliases(self, _data):
+                return True
+
+        for d in (Dumper, PureDumper):
+            yaml.add_representer(str, bazelci.str_presenter, Dumper=d)
+
+        flags = ["--foo"]
+        data = {"steps": [{"command": "a\nb", "flags": flags}, {"command": "c", "flags": flags}]}
+
+        output = bazelci.dump_yaml(data, Dumper=Dumper)
+        self.assertEqual(output, yaml.dump(data, Dumper=PureDumper))
+        self.assertIn("command: |-\n", output)
+        self.assertNotIn("&id", output)
+        self.assertEqual(bazelci.load_yaml(output), data)
+
+
+class InlineDownstreamPipelines(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch.multiple(bazelci, BAZELCI_CONFIG_CACHE_DIR="", _CONFIG_MEMORY_CACHE={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _git(self, *args):
+        return bazelci.execute_command_and_get_output(
+            ["git", "-C", self.repo] + list(args), print_output=False
+        ).strip()
+
+    def _create_repo(self):
+        self.repo = os.path.join(self.tmpdir, "project.git")
+        os.makedirs(os.path.join(self.repo, ".bazelci"))
+        os.makedirs(os.path.join(self.repo, "src"))
+        files = {
+            ".bazelci/presubmit.yml": yaml.dump(
+                {
+                    "imports": ["other.yml"],
+                    "tasks": {"linux": {"platform": bazelci.DEFAULT_PLATFORM, "name": "Linux"}},
+                }
+            ),
+            ".bazelci/other.yml": yaml.dump({"tasks": {"t": {"platform": "macos"}}}),
+            "src/main.cc": "int main() {}",
+        }
+        for path, content in files.items():
+            with open(os.path.join(self.repo, path), "w") as f:
+                f.write(content)
+        self._git("init", "-q")
+        self._git("add", "-A")
+        self._git("-c", "user.name=a", "-c", "user.email=a@b", "commit", "-qm", "init")
+        self._git("config", "uploadpack.allowFilter", "true")
+        self._git("config", "uploadpack.allowAnySHA1InWant", "true")
+        return self._git("rev-parse", "HEAD")
+
+    def test_fetch_git_config_files(self):
+        commit = self._create_repo()
+        dest = os.path.join(self.tmpdir, "dest")
+        os.makedirs(dest)
+
+        bazelci.fetch_git_config_files("file://" + self.repo, commit, ".bazelci", dest)
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(dest, ".bazelci"))), ["other.yml", "presubmit.yml"]
+        )
+        self.assertFalse(os.path.exists(os.path.join(dest, "src")))
+
+    def test_load_config_from_git(self):
+        commit = self._create_repo()
+
+        configs = bazelci.load_config_from_git("file://" + self.repo, commit, None)
+        self.assertEqual(list(configs["tasks"]), ["linux", "other_t"])
+
+        # Callers fall back to a full clone if the config cannot be fetched on its own.
+        self.assertIsNone(
+            bazelci.load_config_from_git("file://" + self.repo, commit, ".bazelci/missing.yml")
+        )
+        self.assertIsNone(
+            bazelci.load_config_from_git("file://" + self.repo + "/missing", commit, None)
+        )
+
+    def test_project_steps_are_grouped(self):
+        commit = self._create_repo()
+        projects = {
+            "Project": {
+                "git_repository": "file://" + self.repo,
+                "file_config": ".bazelci/presubmit.yml",
+                "pipeline_slug": "project",
+            },
+            "Broken": {
+                "git_repository": "file://" + os.path.join(self.tmpdir, "missing.git"),
+                "file_config": ".bazelci/presubmit.yml",
+                "pipeline_slug": "broken",
+            },
+        }
+
+        with mock.patch.object(bazelci, "DOWNSTREAM_PROJECTS", projects), mock.patch.object(
+            bazelci, "get_last_green_commit", return_value=commit
+        ):
+            steps = bazelci.create_downstream_project_steps(["Project", "Broken"])
+
+        group, fallback = steps
+        self.assertEqual(group["group"], "Project")
+        commands = [step["command"][-1] for step in group["steps"]]
+        self.assertEqual(len(commands), 2)
+        self.assertIn("--task=linux", commands[0])
+        self.assertIn("--task=other_t", commands[1])
+        for command in commands:
+            self.assertIn("--file_config=.bazelci/presubmit.yml", command)
+            self.assertIn("--git_commit=" + commit, command)
+            self.assertIn("--use_but", command)
+        # Projects whose config cannot be fetched still get a setup job.
+        self.assertEqual(fallback["label"], "Setup Broken")
+
+    def _run_project_pipeline(self, commit, branch):
+        cloned = []
+        modified_files_cwd = []
+
+        def fake_clone(repository, git_commit, suppress_stdout=False):
+            cloned.append(repository)
+            os.chdir(self.repo)
+
+        def fake_get_modified_files(git_commit):
+            modified_files_cwd.append(os.getcwd())
+            return [".bazelci/presubmit.yml"]
+
+        env = {
+            "BUILDKITE_BRANCH": branch,
+            "BUILDKITE_PIPELINE_DEFAULT_BRANCH": "main",
+            "BUILDKITE_COMMIT": commit,
+        }
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        output = io.StringIO()
+        with mock.patch.dict(os.environ, env), mock.patch.object(
+            bazelci, "clone_git_repository", side_effect=fake_clone
+        ), mock.patch.object(
+            bazelci, "get_modified_files", side_effect=fake_get_modified_files
+        ), mock.patch.object(
+            bazelci, "create_emergency_announcement_step_if_necessary", return_value=None
+        ), contextlib.redirect_stdout(
+            output
+        ):
+            exit_code = bazelci.main(
+                [
+                    "project_pipeline",
+                    "--git_repository=file://" + self.repo,
+                    "--git_commit=" + commit,
+                    "--file_config=.bazelci/presubmit.yml",
+                ]
+            )
+        self.assertEqual(exit_code, 0)
+        return cloned, modified_files_cwd, yaml.safe_load(output.getvalue())["steps"]
+
+    def test_project_pipeline_without_clone(self):
+        commit = self._create_repo()
+        cloned, modified_files_cwd, steps = self._run_project_pipeline(commit, "main")
+        self.assertEqual(cloned, [])
+        self.assertEqual(modified_files_cwd, [])
+        self.assertNotIn("block", steps[0])
+
+    def test_project_pipeline_clones_to_find_modified_files(self):
+        commit = self._create_repo()
+        cloned, modified_files_cwd, steps = self._run_project_pipeline(commit, "feature")
+        self.assertEqual(cloned, ["file://" + self.repo])
+        # Modified files are computed inside the repository.
+        self.assertEqual(modified_files_cwd, [self.repo])
+        self.assertIn(".bazelci/presubmit.yml", steps[0]["block"])
+
 
 class ShellQuoting(unittest.TestCase):
     """Regression tests: values interpolated into generated Buildkite step
@@ -579,7 +1586,7 @@ class FetchCiScripts(unittest.TestCase):
         )
 
     def test_fetch_ci_scripts_command_returns_list_of_curl_commands(self):
-        cmds = bazelci.fetch_ci_scripts_command()
+        cmds = bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM)
         self.assertIsInstance(cmds, list)
         self.assertEqual(len(cmds), 2)
         self.assertTrue(cmds[0].startswith(f"curl {bazelci.CURL_FLAGS_STR}"))
@@ -594,7 +1601,7 @@ class FetchCiScripts(unittest.TestCase):
         step = bazelci.create_step(
             label="test",
             commands=[
-                bazelci.fetch_ci_scripts_command(),
+                bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM),
                 "echo hello",
             ],
             platform=bazelci.DEFAULT_PLATFORM,
@@ -617,6 +1624,136 @@ class FetchCiScripts(unittest.TestCase):
         self.assertIn("--task=basic", commands[2])
 
 
+class PinnedCiScripts(unittest.TestCase):
+    COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.cache_root = os.path.join(self._tmp.name, "cache")
+        self.workdir = os.path.join(self._tmp.name, "work")
+        self.origin = os.path.join(self._tmp.name, "origin")
+        os.makedirs(self.workdir)
+        os.makedirs(self.origin)
+        for script in ("bazelci.py", "collect_metrics.py"):
+            self.write_origin(script, script)
+
+        self.downloads = []
+
+        def fake_download(url, output_file):
+            self.downloads.append(url)
+            script = url.rsplit("/", 1)[-1]
+            return f"cp {self.origin}/{script} {output_file}"
+
+        def fake_fetch(url):
+            with open(os.path.join(self.origin, url.rsplit("/", 1)[-1]), "rb") as f:
+                return f.read()
+
+        bazelci.get_ci_script_digests.cache_clear()
+        self.addCleanup(bazelci.get_ci_script_digests.cache_clear)
+        for patcher in (
+            mock.patch.dict(os.environ, {"BAZELCI_PIN_CI_SCRIPTS": "1"}),
+            mock.patch.object(bazelci, "GITHUB_REF", self.COMMIT),
+            mock.patch.object(bazelci, "curl_download_command", side_effect=fake_download),
+            mock.patch.object(bazelci, "fetch_remote_file", side_effect=fake_fetch),
+            mock.patch.dict(bazelci.CI_SCRIPT_CACHE_DIRS, {"linux": self.cache_root}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_origin(self, script, content):
+        with open(os.path.join(self.origin, script), "w") as f:
+            f.write(content)
+
+    def cache_path(self, script):
+        digest = bazelci.get_ci_script_digests(self.COMMIT, ("bazelci.py", "collect_metrics.py"))
+        return os.path.join(self.cache_root, digest[script], script)
+
+    def read_workdir(self, script):
+        with open(os.path.join(self.workdir, script)) as f:
+            return f.read()
+
+    def run_commands(self, commands):
+        for cmd in commands:
+            # `buildkite-agent pipeline upload` turns "$$" into "$".
+            subprocess.run(["sh", "-c", cmd.replace("$$", "$")], cwd=self.workdir, check=True)
+
+    def test_disabled_by_default(self):
+        with mock.patch.dict(os.environ, {"BAZELCI_PIN_CI_SCRIPTS": ""}):
+            cmds = bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM)
+        self.assertEqual(len(self.downloads), 2)
+        self.assertIn("?", self.downloads[0])
+        self.assertEqual(len(cmds), 2)
+
+    def test_downloads_only_unknown_scripts(self):
+        self.run_commands(bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM))
+        self.assertEqual(
+            self.downloads,
+            [
+                bazelci.CI_SCRIPT_URL_TEMPLATE.format(ref=self.COMMIT, script="bazelci.py"),
+                bazelci.CI_SCRIPT_URL_TEMPLATE.format(ref=self.COMMIT, script="collect_metrics.py"),
+            ],
+        )
+        self.assertTrue(os.path.isfile(self.cache_path("bazelci.py")))
+        self.assertTrue(os.path.isfile(self.cache_path("collect_metrics.py")))
+
+        # A later job on the same machine copies the scripts without downloading them.
+        os.remove(os.path.join(self.origin, "bazelci.py"))
+        os.remove(os.path.join(self.workdir, "bazelci.py"))
+        self.run_commands(bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM))
+        self.assertEqual(self.read_workdir("bazelci.py"), "bazelci.py")
+
+    def test_corrupted_cache_entry_is_replaced(self):
+        cmds = bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM)
+        self.run_commands(cmds)
+        with open(self.cache_path("bazelci.py"), "w") as f:
+            f.write("malicious")
+
+        self.run_commands(cmds)
+        self.assertEqual(self.read_workdir("bazelci.py"), "bazelci.py")
+        with open(self.cache_path("bazelci.py")) as f:
+            self.assertEqual(f.read(), "bazelci.py")
+
+    def test_download_with_unexpected_content_fails(self):
+        cmds = bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM)
+        self.write_origin("bazelci.py", "tampered")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_commands(cmds[:1])
+        self.assertFalse(os.path.exists(self.cache_path("bazelci.py")))
+
+    def test_old_entries_are_evicted(self):
+        stale = os.path.join(self.cache_root, "0" * 64)
+        os.makedirs(stale)
+        old = time.time() - (bazelci.CI_SCRIPT_CACHE_MAX_AGE_DAYS + 2) * 24 * 3600
+        os.utime(stale, (old, old))
+
+        self.run_commands(bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.isfile(self.cache_path("bazelci.py")))
+
+    def test_windows_uses_pinned_urls_without_cache(self):
+        cmds = bazelci.fetch_ci_scripts_command("windows")
+        self.assertEqual(
+            cmds,
+            [
+                f"cp {self.origin}/bazelci.py bazelci.py",
+                f"cp {self.origin}/collect_metrics.py collect_metrics.py",
+            ],
+        )
+        self.assertNotIn("?", self.downloads[0])
+        self.assertIn(self.COMMIT, self.downloads[0])
+
+    def test_unresolved_ref_falls_back_to_unpinned_scripts(self):
+        with mock.patch.object(bazelci, "resolve_ci_script_commit", return_value=None):
+            bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM)
+        self.assertTrue(all("?" in url for url in self.downloads))
+
+    def test_unavailable_scripts_fall_back_to_unpinned_scripts(self):
+        os.remove(os.path.join(self.origin, "collect_metrics.py"))
+        bazelci.fetch_ci_scripts_command(bazelci.DEFAULT_PLATFORM)
+        self.assertTrue(all("?" in url for url in self.downloads))
+
+
 class GetCiScriptRefTest(unittest.TestCase):
 
     def test_production_returns_master(self):
@@ -750,6 +1887,558 @@ class GitBranchHandlingTest(unittest.TestCase):
         self.assertIn(["git", "reset", "origin/35.x", "--hard"], executed_commands)
 
 
+class GitCheckoutReuse(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+
+        self.repo = os.path.join(self.tmpdir, "project.git")
+        os.makedirs(self.repo)
+        self._git("init", "-q")
+        self.commits = []
+        for i in range(2):
+            with open(os.path.join(self.repo, "file"), "w") as f:
+                f.write(str(i))
+            self._git("add", "-A")
+            self._git("-c", "user.name=a", "-c", "user.email=a@b", "commit", "-qm", str(i))
+            self.commits.append(self._git("rev-parse", "HEAD"))
+
+        root = os.path.join(self.tmpdir, "root")
+        os.makedirs(root)
+        for name, value in [("get_repositories_root", root), ("get_mirror_root", "/nonexistent/")]:
+            patcher = mock.patch.object(bazelci, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _git(self, *args, cwd=None):
+        return bazelci.execute_command_and_get_output(
+            ["git", "-C", cwd or self.repo] + list(args), print_output=False
+        ).strip()
+
+    def _checkout(self, git_commit):
+        executed_commands = []
+        execute_command = bazelci.execute_command
+
+        def record(args, **kwargs):
+            executed_commands.append(args[:2])
+            return execute_command(args, **kwargs)
+
+        with mock.patch.object(bazelci, "execute_command", side_effect=record):
+            clone_path = bazelci.clone_git_repository(
+                "file://" + self.repo, git_commit, suppress_stdout=True
+            )
+        head = self._git("rev-parse", "HEAD", cwd=clone_path)
+        self.assertEqual(head, git_commit or self.commits[-1])
+        return clone_path, executed_commands
+
+    def test_skips_redundant_checkouts(self):
+        clone_path, commands = self._checkout(self.commits[0])
+        self.assertIn(["git", "reset"], commands)
+
+        # Nothing changed, so there is nothing to fetch or reset.
+        _, commands = self._checkout(self.commits[0])
+        self.assertNotIn(["git", "fetch"], commands)
+        self.assertNotIn(["git", "reset"], commands)
+
+        # Ignored build outputs don't require a reset, but are cleaned up.
+        with open(os.path.join(clone_path, ".git", "info", "exclude"), "a") as f:
+            f.write("bazel-*\n")
+        with open(os.path.join(clone_path, "bazel-out"), "w") as f:
+            f.write("")
+        _, commands = self._checkout(self.commits[0])
+        self.assertNotIn(["git", "reset"], commands)
+        self.assertIn(["git", "clean"], commands)
+        self.assertFalse(os.path.exists(os.path.join(clone_path, "bazel-out")))
+
+        # Untracked files that are not ignored, as well as modified files, do.
+        with open(os.path.join(clone_path, "new"), "w") as f:
+            f.write("")
+        _, commands = self._checkout(self.commits[0])
+        self.assertIn(["git", "reset"], commands)
+        self.assertFalse(os.path.exists(os.path.join(clone_path, "new")))
+
+        _, commands = self._checkout(self.commits[1])
+        self.assertIn(["git", "reset"], commands)
+        _, commands = self._checkout(None)
+        self.assertIn(["git", "fetch"], commands)
+        self.assertNotIn(["git", "reset"], commands)
+
+    def test_submodules_use_mirrors(self):
+        sub_repo = os.path.join(self.tmpdir, "sub.git")
+        os.makedirs(sub_repo)
+        self._git("init", "-q", cwd=sub_repo)
+        self._git(
+            "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "--allow-empty", "-m", "s",
+            cwd=sub_repo,
+        )
+
+        mirror_root = os.path.join(self.tmpdir, "mirrors") + os.sep
+        with mock.patch.object(bazelci, "get_mirror_root", return_value=mirror_root):
+            mirror_path = bazelci.get_mirror_path("file://" + sub_repo)
+        self._git("clone", "-q", "--mirror", sub_repo, mirror_path, cwd=self.tmpdir)
+
+        env = {
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": "protocol.file.allow",
+            "GIT_CONFIG_VALUE_0": "always",
+        }
+        with mock.patch.dict(os.environ, env):
+            self._git("submodule", "add", "-q", "file://" + sub_repo, "sub")
+            self._git("-c", "user.name=a", "-c", "user.email=a@b", "commit", "-qm", "add sub")
+            commit = self._git("rev-parse", "HEAD")
+
+            with mock.patch.object(bazelci, "get_mirror_root", return_value=mirror_root), \
+                 mock.patch.dict(os.environ, {"BAZELCI_USE_SUBMODULE_MIRRORS": "1"}):
+                clone_path, commands = self._checkout(commit)
+
+        # sync, update with reference, update of all submodules, a single foreach pass.
+        self.assertEqual(commands.count(["git", "submodule"]), 4)
+        alternates = os.path.join(clone_path, ".git", "modules", "sub", "objects", "info", "alternates")
+        with open(alternates) as f:
+            self.assertIn(mirror_path, f.read())
+
+
+class BuildkiteClientSession(unittest.TestCase):
+    def test_requests_reuse_one_connection(self):
+        def handler(path, headers):
+            return 200, {"Content-Type": "application/json"}, json.dumps({"path": path})
+
+        with FakeBuildkiteServer(handler) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            for i in range(5):
+                data = json.loads(client._fetch_data_as_text("{}/builds/{}".format(server.url, i)))
+                self.assertEqual(data["path"], "/builds/{}?access_token=token".format(i))
+            client._session.post(server.url + "/builds", json={})
+
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.requests), 6)
+        self.assertIn("gzip", server.requests[0][2]["Accept-Encoding"])
+
+    def test_clients_share_session_by_default(self):
+        self.assertIs(create_test_client()._session, create_test_client("other")._session)
+
+    def test_retries_after_rate_limit(self):
+        responses = [
+            (429, {"RateLimit-Reset": "0"}, ""),
+            (200, {}, "[1, 2]"),
+        ]
+
+        with FakeBuildkiteServer(lambda path, headers: responses.pop(0)) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            self.assertEqual(client._fetch_data_as_text(server.url + "/agents"), "[1, 2]")
+
+    def test_raises_on_http_error(self):
+        with FakeBuildkiteServer(lambda path, headers: (404, {}, "")) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            with self.assertRaisesRegex(bazelci.BuildkiteException, "404"):
+                client._fetch_data_as_text(server.url + "/agents")
+
+    def test_retries_server_errors(self):
+        responses = [(503, {}, ""), (502, {}, ""), (200, {}, "[]")]
+
+        with FakeBuildkiteServer(lambda path, headers: responses.pop(0)) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            with mock.patch.object(client._rate_limiter, "backoff", return_value=0) as backoff:
+                self.assertEqual(client._fetch_data_as_text(server.url + "/agents"), "[]")
+            self.assertEqual(backoff.call_count, 2)
+
+
+class BuildkiteRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.sleeps = []
+        patcher = mock.patch.multiple(
+            bazelci.time, time=lambda: self.now, sleep=self.sleeps.append
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_delay_without_rate_limit_headers(self):
+        limiter = bazelci.BuildkiteRateLimiter()
+        limiter.update({})
+        limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+    def test_no_delay_while_plenty_remaining(self):
+        limiter = bazelci.BuildkiteRateLimiter()
+        limiter.update({"RateLimit-Limit": "200", "RateLimit-Remaining": "150", "RateLimit-Reset": "30"})
+        for _ in range(10):
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+    def test_paces_requests_when_few_remaining(self):
+        limiter = bazelci.BuildkiteRateLimiter()
+        limiter.update({"RateLimit-Limit": "200", "RateLimit-Remaining": "10", "RateLimit-Reset": "20"})
+        for _ in range(3):
+            limiter.acquire()
+        # The first request goes out immediately, the others are spread over the window.
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertAlmostEqual(self.sleeps[0], 2.0)
+        self.assertAlmostEqual(self.sleeps[1], 2.0 + 20 / 9)
+
+    def test_waits_for_reset_after_429(self):
+        limiter = bazelci.BuildkiteRateLimiter()
+        with mock.patch.object(bazelci.random, "uniform", return_value=0.5):
+            self.assertEqual(limiter.backoff(0, {"RateLimit-Reset": "7"}), 7.5)
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [7.5])
+
+    def test_is_shared_per_org(self):
+        self.assertIs(bazelci.BuildkiteRateLimiter.get("bazel"), bazelci.BuildkiteRateLimiter.get("bazel"))
+        self.assertIsNot(
+            bazelci.BuildkiteRateLimiter.get("bazel"), bazelci.BuildkiteRateLimiter.get("bazel-testing")
+        )
+
+
+class BuildkiteClientPagination(unittest.TestCase):
+    _PAGES = 5
+
+    def _handler(self, path, headers):
+        query = dict(p.split("=", 1) for p in path.split("?", 1)[1].split("&"))
+        page = int(query.get("page", "1"))
+        links = []
+        if page < self._PAGES:
+            links.append('<{}/agents?page={}&per_page=100>; rel="next"'.format(self.url, page + 1))
+            links.append('<{}/agents?page={}&per_page=100>; rel="last"'.format(self.url, self._PAGES))
+        items = [page * 10 + i for i in range(3)]
+        return 200, {"Link": ", ".join(links)} if links else {}, json.dumps(items)
+
+    def _fetch(self, max_workers):
+        with FakeBuildkiteServer(self._handler) as server:
+            self.url = server.url
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            items = client._fetch_all_pages_as_json(server.url + "/agents", max_workers=max_workers)
+        return items, server.requests
+
+    def test_serial(self):
+        items, requests = self._fetch(max_workers=1)
+        self.assertEqual(items, [p * 10 + i for p in range(1, self._PAGES + 1) for i in range(3)])
+        self.assertEqual(len(requests), self._PAGES)
+
+    def test_concurrent_returns_items_in_order(self):
+        items, requests = self._fetch(max_workers=4)
+        self.assertEqual(items, [p * 10 + i for p in range(1, self._PAGES + 1) for i in range(3)])
+        self.assertEqual(len(requests), self._PAGES)
+        self.assertTrue(all("per_page=100" in path for _, path, _ in requests))
+
+    def test_iterator_fetches_pages_lazily(self):
+        with FakeBuildkiteServer(self._handler) as server:
+            self.url = server.url
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            items = client._iter_all_pages_as_json(server.url + "/agents")
+            self.assertEqual(len(server.requests), 0)
+            self.assertEqual([next(items) for _ in range(4)], [10, 11, 12, 20])
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(len(list(items)), self._PAGES * 3 - 4)
+
+
+class BuildkiteClientConditionalRequests(unittest.TestCase):
+    def test_get_build_info_uses_etag(self):
+        build = {"number": 42, "state": "running", "jobs": []}
+
+        def handler(path, headers):
+            etag = '"v{}"'.format(build["state"])
+            if headers.get("If-None-Match") == etag:
+                return 304, {"ETag": etag}, ""
+            return 200, {"ETag": etag}, json.dumps(build)
+
+        with FakeBuildkiteServer(handler) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            client._BUILD_STATUS_URL_TEMPLATE = server.url + "/{}/{}/builds/{}"
+
+            first = client.get_build_info(42)
+            first["jobs"].append("modified by caller")
+            self.assertEqual(client.get_build_info(42), build)
+            self.assertEqual(client.get_build_info(42), build)
+            self.assertEqual(client.not_modified_count, 2)
+
+            build["state"] = "passed"
+            self.assertEqual(client.get_build_info(42)["state"], "passed")
+            self.assertEqual(client.not_modified_count, 2)
+
+        self.assertNotIn("If-None-Match", server.requests[0][2])
+        self.assertEqual(server.requests[1][2]["If-None-Match"], '"vrunning"')
+
+
+class BuildkiteResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_round_trip(self):
+        cache = bazelci.BuildkiteResponseCache(self.tmpdir)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"x" * 1000)
+        self.assertEqual(cache.get("a"), b"x" * 1000)
+        # Entries are stored compressed.
+        (entry,) = os.listdir(self.tmpdir)
+        self.assertLess(os.path.getsize(os.path.join(self.tmpdir, entry)), 1000)
+
+    def test_evicts_least_recently_used(self):
+        cache = bazelci.BuildkiteResponseCache(self.tmpdir, max_size_bytes=10**6)
+        for i, key in enumerate(["a", "b", "c"]):
+            cache.put(key, os.urandom(1000))
+            os.utime(cache._path(key), (i, i))
+        cache.get("a")  # refreshes "a"
+        cache._max_size_bytes = 2500
+        cache._evict()
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_client_caches_finished_builds_and_logs(self):
+        builds = {"1": {"state": "running", "jobs": []}, "2": {"state": "passed", "jobs": []}}
+
+        def handler(path, headers):
+            if path.startswith("/log"):
+                return 200, {}, "log content"
+            return 200, {}, json.dumps(builds[path.split("?")[0].rsplit("/", 1)[1]])
+
+        with FakeBuildkiteServer(handler) as server:
+            client = create_test_client(
+                session=bazelci.BuildkiteClient.create_session(), cache_dir=self.tmpdir
+            )
+            client._BUILD_STATUS_URL_TEMPLATE = server.url + "/{}/{}/builds/{}"
+            for _ in range(2):
+                self.assertEqual(client.get_build_info(1)["state"], "running")
+                self.assertEqual(client.get_build_info(2)["state"], "passed")
+                self.assertEqual(
+                    client.get_build_log({"state": "passed", "raw_log_url": server.url + "/log1"}),
+                    "log content",
+                )
+                client.get_build_log({"state": "running", "raw_log_url": server.url + "/log2"})
+
+        paths = [path.split("?")[0] for _, path, _ in server.requests]
+        self.assertEqual(
+            paths,
+            [
+                "/bazel/test/builds/1",
+                "/bazel/test/builds/2",
+                "/log1",
+                "/log2",
+                "/bazel/test/builds/1",
+                "/log2",
+            ],
+        )
+
+
+class StreamingBuildLog(unittest.TestCase):
+    _LOG = "first line\r\nDownload from https://a failed\n" + "x" * 1000 + "\nDownload from https://b failed"
+
+    def test_iter_build_log_lines(self):
+        with FakeBuildkiteServer(lambda path, headers: (200, {}, self._LOG)) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            job = {"state": "passed", "raw_log_url": server.url + "/log"}
+            lines = list(client.iter_build_log_lines(job, chunk_size=7))
+        self.assertEqual(lines, self._LOG.replace("\r", "").split("\n"))
+
+    def test_iter_build_log_lines_splits_long_lines(self):
+        log = "start\n" + "progress\r" * 30 + "\n\nend"
+        expected = ["start"] + [l.rstrip("\r") for l in ["progress\r" * 10] * 3] + ["", "end"]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with FakeBuildkiteServer(lambda path, headers: (200, {}, log)) as server:
+            client = create_test_client(
+                session=bazelci.BuildkiteClient.create_session(), cache_dir=tmpdir
+            )
+            job = {"state": "passed", "raw_log_url": server.url + "/log"}
+            for chunk_size in (3, 7, 90, 1000):
+                self.assertEqual(
+                    list(
+                        client.iter_build_log_lines(
+                            job, chunk_size=chunk_size, max_line_bytes=90
+                        )
+                    ),
+                    expected,
+                )
+
+    def test_iter_build_log_lines_uses_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with FakeBuildkiteServer(lambda path, headers: (200, {}, self._LOG)) as server:
+            client = create_test_client(
+                session=bazelci.BuildkiteClient.create_session(), cache_dir=tmpdir
+            )
+            job = {"state": "passed", "raw_log_url": server.url + "/log"}
+            first = list(client.iter_build_log_lines(job, chunk_size=7))
+            second = list(client.iter_build_log_lines(job))
+            self.assertEqual(client.get_build_log(job), self._LOG)
+        self.assertEqual(first, second)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_scan_lines(self):
+        patterns = {
+            "download": bazelci.re.compile(r"Download from (\S+) failed"),
+            "first": bazelci.re.compile(r"^first"),
+        }
+        matches = [
+            (name, match.group(0 if name == "first" else 1))
+            for name, match in bazelci.scan_lines(self._LOG.split("\n"), patterns)
+        ]
+        self.assertEqual(
+            matches, [("first", "first"), ("download", "https://a"), ("download", "https://b")]
+        )
+
+
+class BuildkiteClientGraphQL(unittest.TestCase):
+    @staticmethod
+    def _build(number, jobs):
+        return {
+            "number": number,
+            "state": "FAILED",
+            "commit": "abc",
+            "branch": "main",
+            "url": "https://buildkite.com/bazel/p/builds/{}".format(number),
+            "jobs": {"edges": [{"node": job} for job in jobs]},
+        }
+
+    def test_get_latest_builds(self):
+        def handler(path, headers):
+            query = json.loads(server.bodies[-1])
+            if "DefaultBranches" in query["query"]:
+                return 200, {}, json.dumps(
+                    {"data": {"p0": {"defaultBranch": "main"}, "p1": {"defaultBranch": None}}}
+                )
+            self.assertEqual(query["variables"]["slug1"], "bazel/two")
+            self.assertEqual(query["variables"]["branch0"], ["main"])
+            self.assertEqual(query["variables"]["branch1"], ["master"])
+            self.assertEqual(query["variables"]["states"], ["PASSED", "FAILED"])
+            command_job = {
+                "uuid": "j1",
+                "label": "Job",
+                "command": "bazelci.py runner",
+                "state": "FINISHED",
+                "passed": False,
+                "softFailed": False,
+                "url": "u",
+            }
+            data = {
+                "p0": {"builds": {"edges": [{"node": self._build(7, [command_job, {}])}]}},
+                "p1": {"builds": {"edges": []}},
+            }
+            return 200, {}, json.dumps({"data": data})
+
+        with FakeBuildkiteServer(handler) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            client._GRAPHQL_URL = server.url + "/graphql"
+            builds = client.get_latest_builds(["one", "two"])
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[0][2]["Authorization"], "Bearer token")
+        self.assertIsNone(builds["two"])
+        self.assertEqual(builds["one"]["number"], 7)
+        self.assertEqual(builds["one"]["state"], "failed")
+        self.assertEqual(
+            builds["one"]["jobs"],
+            [
+                {
+                    "id": "j1",
+                    "name": "Job",
+                    "command": "bazelci.py runner",
+                    "state": "failed",
+                    "soft_failed": False,
+                    "web_url": "u",
+                }
+            ],
+        )
+
+    def test_graphql_errors_raise(self):
+        response = json.dumps({"errors": [{"message": "Field 'foo' doesn't exist"}]})
+        with FakeBuildkiteServer(lambda path, headers: (200, {}, response)) as server:
+            client = create_test_client(session=bazelci.BuildkiteClient.create_session())
+            client._GRAPHQL_URL = server.url + "/graphql"
+            with self.assertRaisesRegex(bazelci.BuildkiteException, "foo"):
+                client.get_build_jobs(1)
+
+
+class BuildkitePollerTest(unittest.TestCase):
+    class FakeClient:
+        _org = "bazel"
+        _pipeline = "test"
+
+        def __init__(self, states):
+            self.states = states
+            self.calls = 0
+
+        def get_build_info(self, build_number):
+            states = self.states[min(self.calls, len(self.states) - 1)]
+            self.calls += 1
+            return {
+                "state": states[0],
+                "web_url": "https://buildkite.com/bazel/test/builds/1",
+                "jobs": [{"id": "job{}".format(i), "state": s} for i, s in enumerate(states[1:])],
+            }
+
+    def test_waits_share_fetches(self):
+        client = self.FakeClient(
+            [
+                ("running", "scheduled", "running"),
+                ("running", "running", "passed"),
+                ("failed", "failed", "passed"),
+            ]
+        )
+        poller = bazelci.BuildkitePoller(min_interval=0.01, max_interval=0.05)
+        job0 = poller.wait_for_job(client, 1, "job0")
+        job1 = poller.wait_for_job(client, 1, "job1")
+        build = poller.wait_for_build(client, 1)
+
+        self.assertEqual(job0.result(timeout=5)["state"], "failed")
+        self.assertEqual(job1.result(timeout=5)["state"], "passed")
+        self.assertEqual(build.result(timeout=5)["state"], "failed")
+        self.assertEqual(client.calls, 3)
+
+    def test_missing_job_raises(self):
+        client = self.FakeClient([("running", "running")])
+        poller = bazelci.BuildkitePoller(min_interval=0.01)
+        with self.assertRaisesRegex(bazelci.BuildkiteException, "doesn't exist"):
+            poller.wait_for_job(client, 1, "job5").result(timeout=5)
+
+    def test_backs_off_while_nothing_changes(self):
+        client = self.FakeClient([("running", "scheduled")])
+        poller = bazelci.BuildkitePoller(min_interval=1, max_interval=100)
+        build = {
+            "client": client,
+            "build_number": 1,
+            "waiters": [("job0", None, None, mock.Mock())],
+            "next_poll": 0,
+            "interval": 1,
+            "states": None,
+            "first_poll": None,
+        }
+        intervals = []
+        for _ in range(4):
+            poller._poll(build)
+            intervals.append(build["interval"])
+        self.assertEqual(intervals, [1, 1.5, 2.25, 3.375])
+
+
+class AsyncBuildkiteClientTest(unittest.TestCase):
+    def test_fans_out_to_sync_client(self):
+        client = mock.Mock()
+        client.get_build_log.side_effect = lambda job, retries: "log of {}".format(job["id"])
+        async_client = bazelci.AsyncBuildkiteClient("bazel", client=client)
+
+        async def fetch():
+            jobs = [{"id": i} for i in range(100)]
+            return await asyncio.gather(*(async_client.get_build_log(job) for job in jobs))
+
+        logs = asyncio.run(fetch())
+        self.assertEqual(logs, ["log of {}".format(i) for i in range(100)])
+
+    def test_wait_build_to_finish(self):
+        client = mock.Mock()
+        client.get_build_info.side_effect = [
+            {"state": "scheduled", "web_url": "url"},
+            {"state": "running", "web_url": "url"},
+            {"state": "passed", "web_url": "url"},
+        ]
+        async_client = bazelci.AsyncBuildkiteClient("bazel", client=client)
+        build = asyncio.run(async_client.wait_build_to_finish(1, interval_time=0))
+        self.assertEqual(build["state"], "passed")
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -13,6 +13,8 @@ ORGs = ["bazel-testing", "bazel", "bazel-trusted"]
 PROJECT_ID = "bazel-untrusted"
 DATASET_ID = "bazel_ci_metrics"
 TABLE_ID = "infra_stats"
+# Maximum number of result pages that are fetched from the Buildkite API in parallel.
+PAGE_FETCH_WORKERS = 8
 
 
 def setup_logging(level=logging.INFO):
@@ -81,15 +83,15 @@ def get_org_metrics(org):
   logging.info(f"Pulling Data for Org: {org}")
   bk_client = BuildkiteClient(org=org)
 
-  # 1. Fetch & Calculate Agent Stats
-  agents = bk_client.get_agents()
-  logging.info(f"Agent data pulled successfully")
+  # 1. Fetch & Calculate Agent Stats (page by page, so that we never hold all agents in memory)
+  agents = bk_client.iter_agents(max_workers=PAGE_FETCH_WORKERS)
   agents_by_platform = calculate_agent_stats(agents)
+  logging.info(f"Agent data pulled successfully")
 
   # 2. Fetch & Count Scheduled Jobs (Queue Depth)
-  builds = bk_client.get_active_builds()
-  logging.info(f"Active builds data pulled successfully")
+  builds = bk_client.iter_active_builds(max_workers=PAGE_FETCH_WORKERS)
   scheduled_by_platform = count_scheduled_jobs(builds)
+  logging.info(f"Active builds data pulled successfully")
 
   timestamp = datetime.utcnow().isoformat()
   rows = []
@@ -156,6 +156,10 @@ def parse_bep(filepath):
     """
     Parses the Build Event Protocol (BEP) JSON file to extract build/test metrics.
 
+    The file may contain the concatenated streams of several Bazel invocations that ran one after
+    another (e.g. the batches of a shard queue). In this case the build metrics are summed up, and
+    the exit code is the first non-zero one.
+
     Returns:
         BazelMetrics: An object containing aggregated build metrics and test targets.
         None: If the file does not exist.
@@ -202,12 +206,12 @@ def parse_bep(filepath):
             # --- 2. Build Metrics ---
             elif "buildMetrics" in event:
                 buildMetrics = event["buildMetrics"]
-                bazel_metrics.wall_time_ms = int(
+                bazel_metrics.wall_time_ms += int(
                     buildMetrics.get("timingMetrics", {}).get("wallTimeInMs", 0)
                 )
 
                 action_summary = buildMetrics.get("actionSummary", {})
-                bazel_metrics.total_actions = int(action_summary.get("actionsExecuted", 0))
+                bazel_metrics.total_actions += int(action_summary.get("actionsExecuted", 0))
 
                 for runner in action_summary.get("runnerCount", []):
                     name = runner.get("name", "").lower()
@@ -215,27 +219,29 @@ def parse_bep(filepath):
                         bazel_metrics.remote_and_disk_cache_hits += int(runner.get("count", 0))
 
                 artifacts = buildMetrics.get("artifactMetrics", {})
-                bazel_metrics.output_size_bytes = int(
+                output_size_bytes = int(
                     artifacts.get("topLevelArtifacts", {}).get("sizeInBytes", 0)
                 )
-                if bazel_metrics.output_size_bytes == 0:
-                    bazel_metrics.output_size_bytes = int(
+                if output_size_bytes == 0:
+                    output_size_bytes = int(
                         artifacts.get("outputArtifactsSeen", {}).get("sizeInBytes", 0)
                     )
+                bazel_metrics.output_size_bytes += output_size_bytes
 
                 # Network
                 net = buildMetrics.get("networkMetrics", {}).get("systemNetworkStats", {})
-                bazel_metrics.bytes_downloaded = int(net.get("bytesRecv", 0))
+                bazel_metrics.bytes_downloaded += int(net.get("bytesRecv", 0))
 
             # --- 3. Build Tool Logs ---
             elif "buildToolLogs" in event:
                 logs = event["buildToolLogs"].get("log", [])
-                bazel_metrics.critical_path_s = extract_critical_path(logs)
+                bazel_metrics.critical_path_s += extract_critical_path(logs)
 
             # --- Build Finished (Exit Code) ---
             if "buildFinished" in event_id:
                 exit_data = event.get("finished").get("exitCode", {})
-                bazel_metrics.exit_code = int(exit_data.get("code", 0))
+                if not bazel_metrics.exit_code:
+                    bazel_metrics.exit_code = int(exit_data.get("code", 0))
 
     # --- 4. Post-Process Nested Targets ---
     for label, shards in target_map.items():
@@ -176,6 +176,37 @@ class TestPublishMetrics(unittest.TestCase):
             if os.path.exists(temp_path):
                 os.remove(temp_path)
 
+    def test_parse_bep_concatenated_streams(self):
+        # Two invocations, e.g. two batches of a shard queue, in a single file
+        mock_bep_content = create_mock_bep_content(
+            test_results=[{"label": "//pkg:test1", "status": "PASSED", "duration_ms": 1500}]
+        ) + create_mock_bep_content(
+            test_results=[{"label": "//pkg:test2", "status": "FAILED", "duration_ms": 5000}],
+            exit_code=3,
+        )
+
+        with tempfile.NamedTemporaryFile(mode="w", delete=False) as tf:
+            tf.write("\n".join(mock_bep_content))
+            temp_path = tf.name
+
+        try:
+            bep_metrics = collect_metrics.parse_bep(temp_path)
+
+            self.assertEqual(bep_metrics.wall_time_ms, 20000)
+            self.assertEqual(bep_metrics.total_actions, 200)
+            self.assertEqual(bep_metrics.remote_and_disk_cache_hits, 100)
+            self.assertEqual(bep_metrics.output_size_bytes, 2048)
+            self.assertEqual(bep_metrics.bytes_downloaded, 1024)
+            self.assertEqual(bep_metrics.critical_path_s, 30.0)
+            self.assertEqual(bep_metrics.failed_test_count, 1)
+            self.assertEqual(bep_metrics.exit_code, 3)
+            self.assertEqual(
+                sorted(t.label for t in bep_metrics.targets), ["//pkg:test1", "//pkg:test2"]
+            )
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
     def test_extract_critical_path(self):
         # Mock a Base64 encoded critical path log
         raw_log = "Critical Path: 12.5s\n  Action A..."
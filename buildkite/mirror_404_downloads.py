@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import hashlib
 import logging
 import os
@@ -25,7 +26,13 @@ from collections import namedtuple
 from typing import Dict, Set
 
 import requests
-from bazelci import BuildkiteClient, BuildkiteException, execute_command
+from bazelci import (
+    BUILDKITE_API_CACHE_DIR,
+    AsyncBuildkiteClient,
+    BuildkiteClient,
+    BuildkiteException,
+    execute_command,
+)
 
 # --- Color Constants for Terminal Output ---
 # These work best in terminals that support ANSI escape codes.
@@ -69,14 +76,6 @@ def get_latest_build(client: BuildkiteClient) -> Dict:
     return builds[0]
 
 
-def parse_urls_from_logs(logs: str) -> Set[str]:
-    """Parses failed download URLs from the given logs."""
-    found_urls = URL_RE.findall(logs)
-    # URL-decode the found URLs to handle characters like %2B
-    decoded_urls = {requests.utils.unquote(url) for url in found_urls}
-    return decoded_urls
-
-
 def mirror_url(url: str, bucket: str) -> MirrorResult:
     """
     Mirrors a single URL to the GCS bucket and returns the result.
@@ -133,26 +132,34 @@ def get_urls_from_buildkite(client: BuildkiteClient) -> Set[str]:
     logging.info(f"Found latest build: #{build_number} ({latest_build['web_url']})")
 
     logging.info(f"Fetching and parsing logs for build #{build_number}...")
-    all_urls_to_mirror: Set[str] = set()
-    for job in latest_build.get("jobs", []):
-        if job.get("raw_log_url"):
-            job_id = job.get("id", "N/A")
-            try:
-                log_content = client.get_build_log(job)
-                if not log_content:
-                    logging.warning(f"Log content for job {job_id} is empty. Skipping.")
-                    continue
-
-                urls_in_job = parse_urls_from_logs(log_content)
-                if urls_in_job:
-                    job_url = job.get("web_url", f"job_id: {job_id}")
-                    logging.info(f"Found {len(urls_in_job)} failed URL(s) in job: {job_url}")
-                    all_urls_to_mirror.update(urls_in_job)
-
-            except BuildkiteException as e:
-                logging.error(f"Failed to fetch log for job ID {job_id}: {e}")
-                # Continue to next job instead of aborting all
+    jobs = [job for job in latest_build.get("jobs", []) if job.get("raw_log_url")]
+    return asyncio.run(get_urls_from_jobs(client, jobs))
+
+
+async def get_urls_from_jobs(client: BuildkiteClient, jobs) -> Set[str]:
+    """Fetches the logs of all given jobs concurrently and parses them for failed URLs."""
+    async_client = AsyncBuildkiteClient(org=BUILDKITE_ORG, client=client)
+
+    async def get_urls_from_job(job) -> Set[str]:
+        job_id = job.get("id", "N/A")
+        try:
+            # Scan the log line by line instead of downloading all of it into memory.
+            matches = await async_client.scan_build_log(job, {"url": URL_RE})
+        except BuildkiteException as e:
+            logging.error(f"Failed to fetch log for job ID {job_id}: {e}")
+            # Continue to next job instead of aborting all
+            return set()
+
+        # URL-decode the found URLs to handle characters like %2B
+        urls_in_job = {requests.utils.unquote(match.group(1)) for _, match in matches}
+        if urls_in_job:
+            job_url = job.get("web_url", f"job_id: {job_id}")
+            logging.info(f"Found {len(urls_in_job)} failed URL(s) in job: {job_url}")
+        return urls_in_job
 
+    all_urls_to_mirror: Set[str] = set()
+    for urls_in_job in await asyncio.gather(*(get_urls_from_job(job) for job in jobs)):
+        all_urls_to_mirror.update(urls_in_job)
     return all_urls_to_mirror
 
 
@@ -197,7 +204,9 @@ def main():
     setup_logging()
 
     try:
-        client = BuildkiteClient(org=BUILDKITE_ORG, pipeline=BUILDKITE_PIPELINE)
+        client = BuildkiteClient(
+            org=BUILDKITE_ORG, pipeline=BUILDKITE_PIPELINE, cache_dir=BUILDKITE_API_CACHE_DIR
+        )
         urls = get_urls_from_buildkite(client)
         mirror_artifacts(urls, GCS_BUCKET)
 